@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+کنترل پذیرش ورودی (backpressure) برای webhook و polling
+
+هر آپدیت از لحظه پذیرش تا پایان پردازش یک واحد «در جریان» برای ربات
+خودش و برای کل سرویس حساب می‌شود. با پر شدن ظرفیت:
+
+    webhook   پذیرش try_acquire شکست می‌خورد و پاسخ 503 فوری برگردانده
+              می‌شود (تلگرام آپدیت را بعداً دوباره ارسال می‌کند)
+    polling   getUpdates تا آزاد شدن ظرفیت به تعویق می‌افتد و اندازه هر
+              دسته به ظرفیت آزاد همان ربات محدود می‌شود
+    کار کم‌اهمیت  (تایید به فرستنده، پیام تست، ویرایش شمارنده تکرار،
+              ارسال همگانی) از آستانه shed_ratio به بعد کنار گذاشته یا
+              به تعویق انداخته می‌شود
+
+شمارنده‌ها از چند thread (loop هر ربات فرزند و سرور HTTP) به‌روز
+می‌شوند و با یک قفل محافظت می‌شوند.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+
+MASTER_KEY = 'master'
+
+
+class AdmissionController:
+    """ظرفیت آپدیت‌های در جریان به تفکیک ربات و در کل سرویس"""
+
+    def __init__(self, max_inflight: int = 1000, max_per_bot: int = 50,
+                 shed_ratio: float = 0.8, max_pause: float = 5.0):
+        self.max_inflight = max(1, max_inflight)
+        self.max_per_bot = max(1, max_per_bot)
+        self.shed_ratio = shed_ratio
+        self.max_pause = max_pause
+        self.inflight = 0
+        self.per_bot: Dict[str, int] = {}
+        self.peak = 0
+        self.rejected = 0          # پاسخ‌های 503 webhook
+        self.fetch_pauses = 0      # getUpdateهای به تعویق افتاده
+        self.shed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def free(self, key: str) -> int:
+        """ظرفیت آزاد برای یک ربات (کمینه ظرفیت ربات و کل سرویس)"""
+        return max(0, min(self.max_per_bot - self.per_bot.get(key, 0),
+                          self.max_inflight - self.inflight))
+
+    def try_acquire(self, key: str, count: int = 1) -> bool:
+        """پذیرش در صورت وجود ظرفیت (مسیر webhook)"""
+        with self._lock:
+            if self.free(key) < count:
+                self.rejected += count
+                return False
+            self._add(key, count)
+            return True
+
+    def acquire(self, key: str, count: int = 1):
+        """ثبت آپدیت‌هایی که از قبل دریافت شده‌اند (مسیر polling)"""
+        with self._lock:
+            self._add(key, count)
+
+    def _add(self, key: str, count: int):
+        self.inflight += count
+        self.per_bot[key] = self.per_bot.get(key, 0) + count
+        if self.inflight > self.peak:
+            self.peak = self.inflight
+
+    def release(self, key: str, count: int = 1):
+        with self._lock:
+            self.inflight -= count
+            remaining = self.per_bot.get(key, 0) - count
+            if remaining > 0:
+                self.per_bot[key] = remaining
+            else:
+                self.per_bot.pop(key, None)
+
+    def overloaded(self, key: Optional[str] = None) -> bool:
+        """آیا فشار کل سرویس (یا این ربات) از آستانه shed_ratio گذشته است؟"""
+        if self.inflight >= self.max_inflight * self.shed_ratio:
+            return True
+        return key is not None and self.per_bot.get(key, 0) >= self.max_per_bot * self.shed_ratio
+
+    def should_shed(self, kind: str, key: Optional[str] = None) -> bool:
+        """کنار گذاشتن کار کم‌اهمیت در زمان فشار (با شمارش به تفکیک نوع)"""
+        if not self.overloaded(key):
+            return False
+        with self._lock:
+            self.shed[kind] = self.shed.get(kind, 0) + 1
+        return True
+
+    async def wait_to_fetch(self, key: str) -> int:
+        """
+        انتظار تا آزاد شدن ظرفیت پیش از getUpdates
+
+        Returns:
+            تعداد آپدیت قابل دریافت (حداقل 1 پس از max_pause ثانیه تا
+            polling برای همیشه متوقف نماند)
+        """
+        free = self.free(key)
+        if free > 0:
+            return free
+        with self._lock:
+            self.fetch_pauses += 1
+        deadline = time.monotonic() + self.max_pause
+        delay = 0.01
+        while free <= 0 and time.monotonic() < deadline:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+            free = self.free(key)
+        return max(1, free)
+
+    def stats(self) -> Dict:
+        busiest = sorted(self.per_bot.items(), key=lambda item: item[1], reverse=True)[:5]
+        return {
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            'peak': self.peak,
+            'busiest': dict(busiest),
+            'webhook_rejected': self.rejected,
+            'fetch_pauses': self.fetch_pauses,
+            'shed': dict(self.shed),
+        }
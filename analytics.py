@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+آمار ترافیک هر ربات فرزند با حافظه ثابت
+
+برای هر ربات سه سری زمانی حلقوی (دقیقه‌ای، ساعتی، روزانه) از شمارنده‌های
+پیام دریافتی، پاسخ و مسدودسازی نگهداری می‌شود. فرستندگان یکتا با
+HyperLogLog تخمین زده می‌شوند: یک HLL برای هر روز از هفته اخیر و یک HLL
+کلی. ثبت هر رویداد O(1) است و حافظه هر ربات به تعداد پیام‌ها بستگی ندارد.
+"""
+
+import math
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+EVENTS = ('inbound', 'replies', 'blocks')
+
+# (نام، طول هر بازه به ثانیه، تعداد بازه‌ها)
+RESOLUTIONS = (
+    ('minute', 60, 60),
+    ('hour', 3600, 48),
+    ('day', 86400, 30),
+)
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    """هش 64 بیتی splitmix64 (ارزان‌تر از hashlib برای شناسه‌های عددی)"""
+    z = (value + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+# ========== HyperLogLog ==========
+class HyperLogLog:
+    """شمارنده تقریبی عناصر یکتا با 2**precision بایت حافظه"""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision: int = 10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: int):
+        h = _mix64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def clear(self):
+        self.registers = bytearray(len(self.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # تصحیح بازه کوچک (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+# ========== سری زمانی حلقوی ==========
+class RingSeries:
+    """
+    شمارنده‌های آخرین size بازه با طول width ثانیه
+
+    خانه‌ها با شماره بازه (t // width) % size آدرس‌دهی می‌شوند و با جلو رفتن
+    زمان، خانه‌های بازه‌های گذشته صفر می‌شوند.
+    """
+
+    __slots__ = ('width', 'values', 'head')
+
+    def __init__(self, width: int, size: int):
+        self.width = width
+        self.values = array('I', bytes(4 * size))
+        self.head = 0  # شماره آخرین بازه نوشته شده
+
+    def _advance(self, bucket: int):
+        size = len(self.values)
+        if bucket <= self.head:
+            return
+        if bucket - self.head >= size:
+            for i in range(size):
+                self.values[i] = 0
+        else:
+            for b in range(self.head + 1, bucket + 1):
+                self.values[b % size] = 0
+        self.head = bucket
+
+    def add(self, now: float, count: int = 1):
+        bucket = int(now // self.width)
+        self._advance(bucket)
+        if bucket > self.head - len(self.values):
+            self.values[bucket % len(self.values)] += count
+
+    def series(self, now: float, last: Optional[int] = None) -> List[int]:
+        """مقادیر last بازه اخیر از قدیمی به جدید"""
+        size = len(self.values)
+        last = min(last or size, size)
+        current = int(now // self.width)
+        result = []
+        for bucket in range(current - last + 1, current + 1):
+            if self.head - size < bucket <= self.head:
+                result.append(self.values[bucket % size])
+            else:
+                result.append(0)
+        return result
+
+
+# ========== آمار یک ربات ==========
+class BotAnalytics:
+    """شمارنده‌ها و تخمین فرستندگان یکتای یک ربات"""
+
+    __slots__ = ('series', 'daily_uniques', 'daily_head', 'total_uniques', 'totals', '_lock')
+
+    UNIQUE_DAYS = 7
+
+    def __init__(self):
+        self.series: Dict[str, Dict[str, RingSeries]] = {
+            event: {name: RingSeries(width, size) for name, width, size in RESOLUTIONS}
+            for event in EVENTS
+        }
+        self.daily_uniques = [HyperLogLog(8) for _ in range(self.UNIQUE_DAYS)]
+        self.daily_head = 0
+        self.total_uniques = HyperLogLog(10)
+        self.totals = dict.fromkeys(EVENTS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, event: str, now: float, sender_id: Optional[int] = None):
+        with self._lock:
+            self.totals[event] += 1
+            for ring in self.series[event].values():
+                ring.add(now)
+            if sender_id is not None:
+                day = int(now // 86400)
+                if day > self.daily_head:
+                    for d in range(max(self.daily_head + 1, day - self.UNIQUE_DAYS + 1), day + 1):
+                        self.daily_uniques[d % self.UNIQUE_DAYS].clear()
+                    self.daily_head = day
+                self.daily_uniques[day % self.UNIQUE_DAYS].add(sender_id)
+                self.total_uniques.add(sender_id)
+
+    def unique_senders(self, now: float, days: int = 1) -> int:
+        """تخمین فرستندگان یکتا در days روز اخیر (حداکثر UNIQUE_DAYS)"""
+        with self._lock:
+            current = int(now // 86400)
+            merged = HyperLogLog(8)
+            for d in range(current - min(days, self.UNIQUE_DAYS) + 1, current + 1):
+                if self.daily_head - self.UNIQUE_DAYS < d <= self.daily_head:
+                    merged.merge(self.daily_uniques[d % self.UNIQUE_DAYS])
+        return merged.count()
+
+    def recent(self, event: str, resolution: str, now: float, last: int) -> List[int]:
+        with self._lock:
+            return self.series[event][resolution].series(now, last)
+
+    def window_total(self, event: str, resolution: str, now: float, last: int) -> int:
+        return sum(self.recent(event, resolution, now, last))
+
+    def to_dict(self, now: float) -> Dict:
+        with self._lock:
+            series = {
+                event: {name: ring.series(now) for name, ring in rings.items()}
+                for event, rings in self.series.items()
+            }
+            totals = dict(self.totals)
+            all_time = self.total_uniques.count()
+        return {
+            'totals': totals,
+            'unique_senders': {
+                'day': self.unique_senders(now, 1),
+                'week': self.unique_senders(now, 7),
+                'all_time': all_time,
+            },
+            'series': series,
+        }
+
+
+class AnalyticsStore:
+    """آمار همه ربات‌ها (رکورد هر ربات با اولین رویداد ساخته می‌شود)"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._bots: Dict[str, BotAnalytics] = {}
+
+    def record(self, bot_username: str, event: str, sender_id: Optional[int] = None):
+        analytics = self._bots.get(bot_username)
+        if analytics is None:
+            analytics = self._bots.setdefault(bot_username, BotAnalytics())
+        analytics.record(event, self.clock(), sender_id)
+
+    def get(self, bot_username: str) -> Optional[BotAnalytics]:
+        return self._bots.get(bot_username)
+
+    def forget(self, bot_username: str):
+        self._bots.pop(bot_username, None)
+
+    def summary(self, bot_username: str) -> Dict:
+        """خلاصه ساعت، روز و هفته اخیر برای منوی مدیریت"""
+        analytics = self._bots.get(bot_username)
+        now = self.clock()
+        if analytics is None:
+            return {
+                'inbound_hour': 0, 'inbound_day': 0, 'inbound_week': 0,
+                'replies_day': 0, 'blocks_day': 0,
+                'uniques_day': 0, 'uniques_week': 0, 'hourly': [0] * 24,
+            }
+        return {
+            'inbound_hour': analytics.window_total('inbound', 'minute', now, 60),
+            'inbound_day': analytics.window_total('inbound', 'hour', now, 24),
+            'inbound_week': analytics.window_total('inbound', 'day', now, 7),
+            'replies_day': analytics.window_total('replies', 'hour', now, 24),
+            'blocks_day': analytics.window_total('blocks', 'hour', now, 24),
+            'uniques_day': analytics.unique_senders(now, 1),
+            'uniques_week': analytics.unique_senders(now, 7),
+            'hourly': analytics.recent('inbound', 'hour', now, 24),
+        }
+
+    def to_dict(self, bot_username: str) -> Optional[Dict]:
+        analytics = self._bots.get(bot_username)
+        return analytics.to_dict(self.clock()) if analytics else None
+
+
+def sparkline(values: List[int]) -> str:
+    """نمودار یک خطی با کاراکترهای بلوکی"""
+    blocks = '▁▂▃▄▅▆▇█'
+    peak = max(values) if values else 0
+    if not peak:
+        return blocks[0] * len(values)
+    return ''.join(blocks[min(len(blocks) - 1, v * len(blocks) // (peak + 1))] for v in values)
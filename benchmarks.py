@@ -0,0 +1,876 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+بنچمارک‌های ربات چت ناشناس
+
+اجرا:
+    python benchmarks.py bot-records --count 10000
+    python benchmarks.py state-store --iterations 5000
+    python benchmarks.py startup --runs 5
+    python benchmarks.py bulk-import --count 200 --latency-ms 50
+    python benchmarks.py blocklist --count 1000000
+    python benchmarks.py inbox --count 1000000
+    python benchmarks.py soak --duration 14400 --rate 5
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import tracemalloc
+from datetime import datetime
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+
+def _measure(build):
+    """اندازه‌گیری حافظه تخصیص یافته توسط build() با tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return result, size
+
+
+# ========== بنچمارک رکورد ربات‌ها ==========
+def bench_bot_records(count: int, with_clients: bool) -> dict:
+    """
+    مقایسه حافظه رکورد dict قدیمی با BotRecord
+
+    با کلاینت، علاوه بر مقایسه هم‌شرایط (هر دو با کلاینت زنده)، حالت
+    hibernated هم اندازه‌گیری می‌شود: BotRecord بدون کلاینت، همان‌طور که
+    ربات‌های خوابیده نگه داشته می‌شوند، در برابر dict قدیمی که برای همه
+    ربات‌ها کلاینت زنده نگه می‌داشت.
+    """
+    from main import BotRecord
+    from telebot.async_telebot import AsyncTeleBot
+
+    def token(i):
+        return f"{1000000000 + i}:AAH{i:032d}"
+
+    # رشته‌های ورودی (مشترک بین دو حالت) بیرون از اندازه‌گیری ساخته می‌شوند؛
+    # intern از پیش انجام می‌شود تا رشد جدول intern مفسر به حساب رکوردها نیاید
+    tokens = [token(i) for i in range(count)]
+    usernames = [sys.intern(f"anon_{i}_bot") for i in range(count)]
+
+    def legacy():
+        records = []
+        for i in range(count):
+            full_token = tokens[i]
+            records.append({
+                'bot_instance': AsyncTeleBot(full_token) if with_clients else None,
+                'token': full_token[:10] + '...',
+                'username': usernames[i],
+                'owner_id': 500000000 + i,
+                'active': True,
+                'created_at': datetime.now().strftime('%Y/%m/%d %H:%M'),
+                'full_token': full_token,
+                'bot_id': 1000000000 + i
+            })
+        return records
+
+    def compact(attach: bool):
+        return [
+            BotRecord(
+                username=usernames[i],
+                owner_id=500000000 + i,
+                token=tokens[i],
+                bot_id=1000000000 + i,
+                client=AsyncTeleBot(tokens[i]) if attach else None
+            )
+            for i in range(count)
+        ]
+
+    legacy_records, legacy_bytes = _measure(legacy)
+    del legacy_records
+    # هر دو طرف با شرایط یکسان (با یا بدون کلاینت)
+    compact_records, compact_bytes = _measure(lambda: compact(with_clients))
+    del compact_records
+
+    result = {
+        'count': count,
+        'with_clients': with_clients,
+        'legacy_bytes_per_bot': round(legacy_bytes / count, 1),
+        'bot_record_bytes_per_bot': round(compact_bytes / count, 1),
+        'reduction': round(legacy_bytes / compact_bytes, 2) if compact_bytes else None
+    }
+    if with_clients:
+        hibernated_records, hibernated_bytes = _measure(lambda: compact(False))
+        del hibernated_records
+        result['hibernated_bytes_per_bot'] = round(hibernated_bytes / count, 1)
+        result['hibernated_reduction'] = round(legacy_bytes / hibernated_bytes, 2) if hibernated_bytes else None
+    return result
+
+
+# ========== بنچمارک ذخیره‌سازی وضعیت ==========
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * (len(samples) - 1)))]
+    return {
+        'p50_us': round(pick(0.50) * 1e6, 1),
+        'p99_us': round(pick(0.99) * 1e6, 1),
+        'max_us': round(samples[-1] * 1e6, 1),
+    }
+
+
+async def _relay_path(store, iterations: int) -> dict:
+    """اجرای عملیات وضعیت: خواندن مسدودی + ثبت فرستنده تازه (write-behind)"""
+    for user_id in range(0, iterations, 10):
+        await store.add_block(user_id, 'bench_bot')
+
+    read_latency = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        await store.is_blocked(i, 'bench_bot')
+        read_latency.append(time.perf_counter() - t0)
+        store.add_sender('bench_bot', i, i)
+    store.flush_pending()
+    relay_elapsed = time.perf_counter() - started
+
+    batch_latency = []
+    for i in range(50):
+        ops = [('put', 'bench', f"{i}:{j}", 'x' * 64) for j in range(100)]
+        t0 = time.perf_counter()
+        await store.execute(ops)
+        batch_latency.append(time.perf_counter() - t0)
+
+    return {
+        'relay_ops_per_s': round(iterations / relay_elapsed),
+        'is_blocked': _percentiles(read_latency),
+        'batch_put_100': _percentiles(batch_latency),
+    }
+
+
+def bench_state_store(iterations: int) -> dict:
+    """مقایسه backendهای ذخیره‌سازی روی مسیر رله"""
+    from state_store import MemoryStateStore, SQLiteStateStore, RedisStateStore, RespStandInServer
+
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix='state_bench_')
+    redis_url = os.environ.get('BENCH_REDIS_URL')
+    stand_in = None
+    if not redis_url:
+        stand_in = RespStandInServer().start()
+
+    backends = {
+        'memory': lambda: MemoryStateStore(),
+        'sqlite': lambda: SQLiteStateStore(os.path.join(tmp_dir, 'state.db')),
+        'redis': lambda: RedisStateStore(port=stand_in.port) if stand_in else None,
+    }
+    if redis_url:
+        from state_store import create_state_store
+        backends['redis'] = lambda: create_state_store(redis_url)
+
+    for name, factory in backends.items():
+        store = factory()
+        try:
+            results[name] = asyncio.run(_relay_path(store, iterations))
+        finally:
+            store.close()
+
+    if stand_in:
+        stand_in.stop()
+        results['redis']['server'] = 'RespStandInServer (local)'
+    return {'iterations': iterations, 'backends': results}
+
+
+# ========== بنچمارک فهرست مسدودی ==========
+def bench_blocklist(count: int, lookups: int) -> dict:
+    """حافظه و تاخیر Blocklist در برابر مجموعه (user_id, bot) برای هر ربات"""
+    import random
+    from blocklist import Blocklist
+
+    user_ids = random.sample(range(10 ** 9, 8 * 10 ** 9), count)
+    blocklist, blocklist_bytes = _measure(lambda: _build_blocklist(Blocklist(), user_ids))
+    pairs, pairs_bytes = _measure(lambda: {(user_id, 'anon_bot') for user_id in user_ids})
+    del pairs
+
+    probes = [random.randrange(10 ** 9) for _ in range(lookups)]
+    started = time.perf_counter()
+    for user_id in probes:
+        blocklist.match(user_id, 42)
+    miss = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id in user_ids[:lookups]:
+        blocklist.match(user_id, 42)
+    hit = time.perf_counter() - started
+
+    return {
+        'entries': count,
+        'blocklist_bytes_per_entry': round(blocklist_bytes / count, 1),
+        'tuple_set_bytes_per_entry': round(pairs_bytes / count, 1),
+        'miss_us': round(miss / lookups * 1e6, 2),
+        'hit_us': round(hit / lookups * 1e6, 2),
+        'stats': blocklist.stats(),
+    }
+
+
+def _build_blocklist(blocklist, user_ids):
+    blocklist.update((0, user_id) for user_id in user_ids)
+    return blocklist
+
+
+# ========== بنچمارک صندوق پیام ==========
+def bench_inbox(count: int, queries: int) -> dict:
+    """توان نوشتن و تاخیر صفحه‌بندی/جستجوی InboxStore با count پیام"""
+    import random
+    from inbox import InboxStore
+
+    words = ['سلام', 'hello', 'world', 'دوست', 'photo', 'test', 'ممنون', 'کجایی']
+    path = os.path.join(tempfile.mkdtemp(prefix='inbox_bench_'), 'inbox.db')
+    store = InboxStore(path, retention_days=365, queue_size=100000)
+    now = time.time()
+    span = 60 * 86400
+
+    started = time.perf_counter()
+    for i in range(count):
+        body = ' '.join(random.choices(words, k=6)) + f" m{i}"
+        while not store.append(500 + i % 4, f"bot{i % 4}_bot", i % 5000, 'text', body,
+                               ts=now - span + i * span / count):
+            time.sleep(0.001)
+    store.flush(timeout=600)
+    write_elapsed = time.perf_counter() - started
+
+    async def read() -> dict:
+        first, deep, search, rare = [], [], [], []
+        for _ in range(queries):
+            t0 = time.perf_counter()
+            rows, cursor = await store.page(501)
+            first.append(time.perf_counter() - t0)
+            for _ in range(20):
+                rows, cursor = await store.page(501, before=cursor)
+            t0 = time.perf_counter()
+            await store.page(501, before=cursor)
+            deep.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            await store.search(501, random.choice(words))
+            search.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            await store.search(501, f"m{random.randrange(count)}")
+            rare.append(time.perf_counter() - t0)
+        return {
+            'first_page': _percentiles(first),
+            'page_21': _percentiles(deep),
+            'search_common_word': _percentiles(search),
+            'search_rare_word': _percentiles(rare),
+        }
+
+    try:
+        reads = asyncio.run(read())
+        stats = store.stats()
+    finally:
+        store.close()
+    return {
+        'messages': count,
+        'writes_per_s': round(count / write_elapsed),
+        'queue_full_retries': stats['dropped'],
+        'file_mb': round(stats['file_bytes'] / 1e6, 1),
+        'partitions': stats['partitions'],
+        'reads': reads,
+    }
+
+
+# ========== بنچمارک تکراری‌ها ==========
+def bench_dedup(count: int, campaigns: int, max_entries: int) -> dict:
+    """تاخیر هر بررسی و حافظه DuplicateIndex با ترکیبی از پیام یکتا و کمپین اسپم"""
+    import random
+    import types
+    from dedup import DuplicateIndex
+
+    words = ['سلام', 'تخفیف', 'ویژه', 'hello', 'crypto', 'offer', 'عضو', 'کانال', 'رایگان', 'link']
+    words += [f"w{i}" for i in range(5000)]
+    templates = [' '.join(random.choices(words, k=12)) + f" c{c}" for c in range(campaigns)]
+
+    def message(i: int):
+        if i % 2:
+            # کمپین با تغییر جزئی (نزدیک به تکراری)
+            text = random.choice(templates) + random.choice(['', '!', ' 🔥', '.'])
+        else:
+            text = ' '.join(random.choices(words, k=12)) + f" u{i}"
+        return types.SimpleNamespace(text=text, caption=None, photo=None)
+
+    messages = [message(i) for i in range(count)]
+    index = DuplicateIndex(max_entries=max_entries)
+    started = time.perf_counter()
+    for i, msg in enumerate(messages):
+        fingerprint = index.fingerprint(msg)
+        if index.claim(i % 50, fingerprint, i, 'anon_bot') is None:
+            index.bind(i % 50, fingerprint, i, i, False)
+    elapsed = time.perf_counter() - started
+
+    _, index_bytes = _measure(lambda: _fill_dedup(DuplicateIndex(max_entries=max_entries), messages))
+    return {
+        'messages': count,
+        'campaigns': campaigns,
+        'check_us': round(elapsed / count * 1e6, 1),
+        'collapsed_ratio': round(index.collapsed / count, 3),
+        'index_bytes': index_bytes,
+        'stats': index.stats(),
+    }
+
+
+def _fill_dedup(index, messages):
+    for i, msg in enumerate(messages):
+        index.claim(i % 50, index.fingerprint(msg), i, 'anon_bot')
+    return index
+
+
+# ========== API جعلی تلگرام ==========
+class FakeTelegramApi:
+    """
+    پیاده‌سازی حداقلی Bot API روی localhost برای بنچمارک‌ها
+
+    با TELEGRAM_API_URL=<url> به سرویس داده می‌شود. آپدیت‌های صف شده با
+    queue_update در پاسخ getUpdates بعدی برگردانده می‌شوند (با bot_id فقط
+    برای همان ربات، بدون آن برای هر رباتی) و زمان آخرین max_calls
+    فراخوانی متدها در calls ثبت می‌شود. latency تاخیر شبکه هر درخواست را
+    شبیه‌سازی می‌کند و توکن‌هایی که بخش دوم آن‌ها با BAD شروع شود 401
+    می‌گیرند.
+    """
+
+    def __init__(self, latency: float = 0.0, max_calls: Optional[int] = None):
+        self.latency = latency
+        self.calls = deque(maxlen=max_calls)
+        self.call_count = 0
+        self._updates: Dict[Optional[int], list] = {}
+        self._next_update_id = 100
+        self._next_message_id = 1
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> 'FakeTelegramApi':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def queue_update(self, update: dict, bot_id: Optional[int] = None):
+        with self._lock:
+            update['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.setdefault(bot_id, []).append(update)
+
+    def pending_updates(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._updates.values())
+
+    def queue_message(self, user_id: int, text: str, bot_id: Optional[int] = None):
+        self.queue_update({'message': {
+            'message_id': self._next_update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'bench'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+        }}, bot_id)
+
+    def first_call(self, method: str):
+        """زمان اولین فراخوانی method (perf_counter) یا None"""
+        with self._lock:
+            return next((at for name, at in self.calls if name == method), None)
+
+    def _respond(self, token: str, method: str, params: dict):
+        bot_id = int(token.split(':')[0])
+        if method == 'getMe':
+            return {'id': bot_id, 'is_bot': True, 'first_name': 'bench', 'username': f"bench{bot_id}_bot"}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            if offset < 0:
+                return []
+            with self._lock:
+                pending = []
+                for key in (bot_id, None):
+                    queue = [u for u in self._updates.get(key, ()) if u['update_id'] >= offset]
+                    self._updates[key] = queue
+                    pending.extend(queue)
+                pending.sort(key=lambda u: u['update_id'])
+            if not pending:
+                # long polling کوتاه تا حلقه دریافت CPU مصرف نکند
+                time.sleep(min(float(params.get('timeout') or 0), 0.2))
+            return pending[:int(params.get('limit') or 100)]
+        if method in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument', 'copyMessage'):
+            with self._lock:
+                message_id = self._next_message_id
+                self._next_message_id += 1
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        return True
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _serve(self, body: bytes):
+                _, token, method = self.path.split('?')[0].rsplit('/', 2)
+                token = token[3:]
+                params = {k: v[-1] for k, v in parse_qs(self.path.partition('?')[2]).items()}
+                content_type = self.headers.get('Content-Type', '')
+                if body and 'json' in content_type:
+                    params.update(json.loads(body))
+                elif body and 'urlencoded' in content_type:
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+                with api._lock:
+                    api.calls.append((method, time.perf_counter()))
+                    api.call_count += 1
+                if api.latency:
+                    time.sleep(api.latency)
+                if token.partition(':')[2].startswith('BAD'):
+                    status = 401
+                    payload = json.dumps({'ok': False, 'error_code': 401, 'description': 'Unauthorized'}).encode()
+                else:
+                    status = 200
+                    payload = json.dumps({'ok': True, 'result': api._respond(token, method, params)}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # کلاینت (polling لغو شده) اتصال را بسته است
+
+            def _body(self) -> bytes:
+                # telebot پارامترها را به صورت فرم (حتی برای GET و به صورت chunked) می‌فرستد
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunk = self.rfile.read(size + 2)[:size]
+                        if not size:
+                            return body
+                        body += chunk
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def do_GET(self):
+                self._serve(self._body())
+
+            def do_POST(self):
+                self._serve(self._body())
+
+        return Handler
+
+
+# ========== بنچمارک راه‌اندازی ==========
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _import_time(module: str) -> float:
+    """زمان import ماژول در یک مفسر تازه (ثانیه)"""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True,
+                            text=True, check=True).stdout
+    return float(output.strip())
+
+
+def _cold_start(timeout: float) -> dict:
+    """اجرای main.py روی API جعلی: زمان تا /ready و تا پاسخ اولین آپدیت"""
+    api = FakeTelegramApi().start()
+    api.queue_message(777000001, '/start')
+    port = _free_port()
+    data_dir = tempfile.mkdtemp(prefix='startup_bench_')
+    env = dict(
+        os.environ,
+        MASTER_BOT_TOKEN='123456:' + 'A' * 35,
+        TELEGRAM_API_URL=api.url,
+        PORT=str(port),
+        DATA_DIR=data_dir,
+        LOG_FORMAT='text',
+        LOG_LEVEL='WARNING',
+    )
+    env.pop('WEBHOOK_URL', None)
+    env.pop('STATE_STORE_URL', None)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script], cwd=data_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ready_at = None
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline and process.poll() is None:
+            if ready_at is None:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                        if response.status == 200:
+                            ready_at = time.perf_counter()
+                except OSError:
+                    pass
+            if ready_at is not None and api.first_call('sendMessage') is not None:
+                break
+            time.sleep(0.005)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        api.stop()
+
+    first_reply = api.first_call('sendMessage')
+    return {
+        'ready_ms': round((ready_at - started) * 1000, 1) if ready_at else None,
+        'first_update_ms': round((first_reply - started) * 1000, 1) if first_reply else None,
+    }
+
+
+def bench_startup(runs: int, timeout: float) -> dict:
+    """زمان import و زمان راه‌اندازی سرد تا پاسخ اولین آپدیت"""
+    median = lambda values: sorted(values)[len(values) // 2] if values else None
+    imports = [_import_time('main') for _ in range(runs)]
+    starts = [_cold_start(timeout) for _ in range(runs)]
+    ready = [s['ready_ms'] for s in starts if s['ready_ms'] is not None]
+    first = [s['first_update_ms'] for s in starts if s['first_update_ms'] is not None]
+    return {
+        'runs': runs,
+        'import_main_ms': round(median(imports) * 1000, 1),
+        'ready_ms': median(ready),
+        'first_update_ms': median(first),
+        'failed_runs': runs - len(first),
+        'samples': starts,
+    }
+
+
+# ========== بنچمارک کنترل پذیرش ==========
+def bench_ingress(count: int, work_ms: float, max_per_bot: int) -> dict:
+    """هجوم آپدیت‌های یک ربات: همزمانی هندلرها با و بدون کنترل پذیرش"""
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_helper
+    from admission import AdmissionController
+    from main import AdmittedTeleBot, configure_api_url
+
+    api = FakeTelegramApi().start()
+    configure_api_url(api.url)
+
+    async def flood(bot) -> dict:
+        active = peak = handled = 0
+        done = asyncio.Event()
+
+        @bot.message_handler(func=lambda m: True)
+        async def handler(message):
+            nonlocal active, peak, handled
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(work_ms / 1000)
+            active -= 1
+            handled += 1
+            if handled >= count:
+                done.set()
+
+        for i in range(count):
+            api.queue_message(1000 + i, f"flood {i}")
+        started = time.perf_counter()
+        task = asyncio.ensure_future(bot.polling(non_stop=True, timeout=1))
+        await asyncio.wait_for(done.wait(), timeout=600)
+        elapsed = time.perf_counter() - started
+        task.cancel()
+        return {'peak_handlers': peak, 'elapsed_s': round(elapsed, 2)}
+
+    async def run() -> dict:
+        admission = AdmissionController(max_per_bot=max_per_bot)
+        result = {
+            'unbounded': await flood(AsyncTeleBot('1001:' + 'A' * 35)),
+            'admitted': await flood(AdmittedTeleBot('1002:' + 'A' * 35, admission=admission,
+                                                    ingress_key='flood_bot')),
+        }
+        result['admission'] = admission.stats()
+        await asyncio_helper.session_manager.session.close()
+        return result
+
+    try:
+        result = asyncio.run(run())
+    finally:
+        api.stop()
+    return {'count': count, 'work_ms': work_ms, 'max_per_bot': max_per_bot, **result}
+
+
+# ========== بنچمارک ورود دسته‌ای ==========
+def bench_bulk_import(count: int, latency: float, concurrency: int) -> dict:
+    """توان عملیاتی ورود دسته‌ای توکن‌ها روی API جعلی با تاخیر شبکه"""
+    from bulk_import import BulkImporter, parse_entries
+    from main import configure_api_url
+    from telebot.asyncio_helper import session_manager
+
+    async def telebot_session_close():
+        if session_manager.session:
+            await session_manager.session.close()
+
+    api = FakeTelegramApi(latency=latency).start()
+    configure_api_url(api.url)
+    # یک توکن نامعتبر در هر 50 توکن و یک تکراری در انتها
+    lines = [
+        f"{2000000000 + i}:{'BAD' if i % 50 == 49 else 'AAH'}{i:032d} {500000000 + i % 7}"
+        for i in range(count)
+    ]
+    lines.append(lines[0])
+    entries, _ = parse_entries('\n'.join(lines))
+
+    async def run(parallel: int) -> dict:
+        batches = []
+
+        async def register(batch):
+            batches.append(len(batch))
+
+        report = await BulkImporter(concurrency=parallel).run(entries, set(), set(), register)
+        await telebot_session_close()
+        report.pop('results')
+        report['batches'] = len(batches)
+        return report
+
+    try:
+        results = {
+            'serial': asyncio.run(run(1)),
+            f'concurrency_{concurrency}': asyncio.run(run(concurrency)),
+        }
+    finally:
+        api.stop()
+    return {'count': count, 'latency_ms': latency * 1000, 'runs': results}
+
+
+# ========== بنچمارک پایداری حافظه (soak) ==========
+_SOAK_WORDS = ('salam', 'hello', 'chetori', 'khoobi', 'soal', 'dashtam', 'mishe', 'lotfan',
+               'javab', 'bede', 'merci', 'emrooz', 'farda', 'kar', 'dars', 'film', 'music', 'link')
+
+
+def _soak_text(rng, spam: str) -> str:
+    # ده درصد پیام‌ها کمپین تکراری هستند تا مسیر جمع کردن تکراری‌ها هم اجرا شود
+    if rng.random() < 0.1:
+        return spam
+    return ' '.join(rng.choice(_SOAK_WORDS) for _ in range(rng.randint(2, 20)))
+
+
+def _slope_per_hour(samples) -> float:
+    """شیب خط برازش (کمترین مربعات) مگابایت بر ساعت"""
+    if len(samples) < 2:
+        return 0.0
+    xs = [t for t, _ in samples]
+    ys = [v for _, v in samples]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mean_x) ** 2 for x in xs)
+    if not var:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var * 3600
+
+
+def bench_soak(duration: float, rate: float, bots: int, senders: int, interval: float,
+               warmup: float, max_growth_mb: float, hibernate_after: float, trace: bool) -> dict:
+    """
+    اجرای طولانی مسیر رله روی API جعلی و پایش رشد حافظه
+
+    ربات‌های فرزند با مسیر واقعی (thread و loop هر ربات، polling، کنترل
+    پذیرش و رله به مالک از طریق ربات مادر) اجرا می‌شوند و rate پیام در
+    ثانیه از senders فرستنده چرخشی دریافت می‌کنند. RSS هر interval ثانیه
+    نمونه‌برداری می‌شود؛ اگر پس از warmup میانه ده درصد آخر نمونه‌ها بیش
+    از max_growth_mb مگابایت بالاتر از ده درصد اول باشد، passed=False است.
+    """
+    import random
+    from diagnostics import MemoryTracker, process_memory
+
+    data_dir = tempfile.mkdtemp(prefix='soak_bench_')
+    os.environ.update(DATA_DIR=data_dir, HIBERNATE_AFTER=str(hibernate_after), SHUTDOWN_TIMEOUT='10')
+    for name in ('STATE_STORE_URL', 'REPLY_INDEX_PATH', 'INBOX_PATH', 'LEADER_ELECTION', 'WEBHOOK_URL'):
+        os.environ.pop(name, None)
+    from main import AnonymousChatBot, BotRecord, configure_api_url
+
+    api = FakeTelegramApi(max_calls=1000).start()
+    configure_api_url(api.url)
+    app = AnonymousChatBot('123456:' + 'A' * 35)
+    app.start_master_loop()
+    bot_ids = [3000000000 + i for i in range(bots)]
+    for i, bot_id in enumerate(bot_ids):
+        app.child_manager.add_bot(BotRecord(
+            f"bench{bot_id}_bot", 900000000 + i, f"{bot_id}:AAH{i:032d}", bot_id=bot_id
+        ), fresh=False)
+
+    rng = random.Random(1)
+    spam = 'join our channel now for free crypto signals ' * 2
+    tracker = MemoryTracker()
+    samples = []
+    sent = skipped = 0
+    baseline = None
+    started = time.monotonic()
+    next_sample = started + interval
+    try:
+        while True:
+            now = time.monotonic()
+            elapsed = now - started
+            if elapsed >= duration:
+                break
+            # صف API جعلی محدود می‌ماند تا عقب افتادن رله حافظه بنچمارک را بالا نبرد
+            due = int(elapsed * rate) - sent - skipped
+            backlog = api.pending_updates()
+            for _ in range(max(0, due)):
+                if backlog > rate * 10:
+                    skipped += 1
+                    continue
+                api.queue_message(700000000 + rng.randrange(senders), _soak_text(rng, spam),
+                                  bot_id=bot_ids[rng.randrange(bots)])
+                sent += 1
+                backlog += 1
+            if now >= next_sample:
+                next_sample += interval
+                gc.collect()
+                rss = process_memory()['rss_bytes'] or 0
+                samples.append((round(elapsed, 1), round(rss / 2 ** 20, 2)))
+                if baseline is None and elapsed >= warmup:
+                    baseline = {'at_s': round(elapsed, 1), 'structures': app.memory_report()['structures']}
+                    if trace:
+                        baseline['snapshot'] = tracker.snapshot(limit=0)['id']
+            time.sleep(0.01)
+
+        final = app.memory_report()
+        leaks = tracker.diff(baseline['snapshot'], group='line', limit=15) if trace and baseline else None
+    finally:
+        app.shutdown()
+        tracker.stop()
+        api.stop()
+
+    steady = [(t, mb) for t, mb in samples if baseline and t >= baseline['at_s']]
+    window = max(1, len(steady) // 10)
+    first = sorted(mb for _, mb in steady[:window])
+    last = sorted(mb for _, mb in steady[-window:])
+    growth = (last[len(last) // 2] - first[len(first) // 2]) if steady else None
+
+    growth_by_structure = {}
+    if baseline:
+        for name, after in final['structures'].items():
+            before = baseline['structures'].get(name, {'entries': 0, 'approx_bytes': 0})
+            growth_by_structure[name] = {
+                'entries': after['entries'],
+                'entries_diff': (after['entries'] - before['entries']) if after['entries'] is not None else None,
+                'approx_bytes_diff': after['approx_bytes'] - before['approx_bytes'],
+            }
+
+    return {
+        'duration_s': duration,
+        'messages': sent,
+        'skipped_backlog': skipped,
+        'api_calls': api.call_count,
+        'bots': bots,
+        'senders': senders,
+        'rss_mb_start': samples[0][1] if samples else None,
+        'rss_mb_end': samples[-1][1] if samples else None,
+        'steady_growth_mb': round(growth, 2) if growth is not None else None,
+        'slope_mb_per_hour': round(_slope_per_hour(steady), 2),
+        'max_growth_mb': max_growth_mb,
+        'passed': growth is not None and growth <= max_growth_mb,
+        'structures': growth_by_structure,
+        'clients': final['clients'],
+        'threads': final['threads']['by_name'],
+        'tracemalloc_growth': leaks,
+        'samples': samples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="بنچمارک‌های ربات چت ناشناس")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    records = sub.add_parser('bot-records', help="حافظه هر ربات ثبت‌شده")
+    records.add_argument('--count', type=int, default=10000)
+    records.add_argument('--no-clients', action='store_true',
+                         help="بدون کلاینت AsyncTeleBot در رکورد قدیمی")
+
+    store = sub.add_parser('state-store', help="تاخیر و توان عملیاتی backendهای ذخیره‌سازی")
+    store.add_argument('--iterations', type=int, default=5000)
+
+    startup = sub.add_parser('startup', help="زمان import و راه‌اندازی سرد تا اولین آپدیت")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--timeout', type=float, default=30.0)
+
+    bulk = sub.add_parser('bulk-import', help="توان عملیاتی ورود دسته‌ای توکن‌ها")
+    bulk.add_argument('--count', type=int, default=200)
+    bulk.add_argument('--latency-ms', type=float, default=50.0,
+                      help="تاخیر شبیه‌سازی شده هر درخواست API")
+    bulk.add_argument('--concurrency', type=int, default=16)
+
+    blocks = sub.add_parser('blocklist', help="حافظه و تاخیر فهرست مسدودی سراسری")
+    blocks.add_argument('--count', type=int, default=1000000)
+    blocks.add_argument('--lookups', type=int, default=100000)
+
+    inbox = sub.add_parser('inbox', help="نوشتن، صفحه‌بندی و جستجوی صندوق پیام")
+    inbox.add_argument('--count', type=int, default=1000000)
+    inbox.add_argument('--queries', type=int, default=50)
+
+    ingress = sub.add_parser('ingress', help="همزمانی پردازش در هجوم آپدیت‌ها با کنترل پذیرش")
+    ingress.add_argument('--count', type=int, default=2000)
+    ingress.add_argument('--work-ms', type=float, default=50.0, help="زمان پردازش هر آپدیت")
+    ingress.add_argument('--max-per-bot', type=int, default=50)
+
+    dedup = sub.add_parser('dedup', help="تاخیر و حافظه تشخیص پیام‌های تکراری")
+    dedup.add_argument('--count', type=int, default=100000)
+    dedup.add_argument('--campaigns', type=int, default=20)
+    dedup.add_argument('--max-entries', type=int, default=20000)
+
+    soak = sub.add_parser('soak', help="اجرای طولانی مسیر رله و شکست در صورت رشد پیوسته حافظه")
+    soak.add_argument('--duration', type=float, default=600.0, help="ثانیه (برای چند ساعت: 3600 × ساعت)")
+    soak.add_argument('--rate', type=float, default=5.0, help="پیام در ثانیه (هر مالک حداکثر یک اعلان در ثانیه می‌گیرد)")
+    soak.add_argument('--bots', type=int, default=10)
+    soak.add_argument('--senders', type=int, default=5000, help="اندازه جمعیت چرخشی فرستندگان")
+    soak.add_argument('--interval', type=float, default=5.0, help="فاصله نمونه‌برداری RSS")
+    soak.add_argument('--warmup', type=float, default=60.0)
+    soak.add_argument('--max-growth-mb', type=float, default=20.0)
+    soak.add_argument('--hibernate-after', type=float, default=0.0,
+                      help="خواب ربات‌های بی‌فعالیت (0 غیرفعال)")
+    soak.add_argument('--tracemalloc', action='store_true',
+                      help="مقایسه snapshot پس از warmup با پایان به تفکیک خط")
+
+    args = parser.parse_args()
+    started = time.perf_counter()
+
+    if args.command == 'bot-records':
+        result = bench_bot_records(args.count, with_clients=not args.no_clients)
+    elif args.command == 'state-store':
+        result = bench_state_store(args.iterations)
+    elif args.command == 'startup':
+        result = bench_startup(args.runs, args.timeout)
+    elif args.command == 'inbox':
+        result = bench_inbox(args.count, args.queries)
+    elif args.command == 'ingress':
+        result = bench_ingress(args.count, args.work_ms, args.max_per_bot)
+    elif args.command == 'dedup':
+        result = bench_dedup(args.count, args.campaigns, args.max_entries)
+    elif args.command == 'soak':
+        result = bench_soak(args.duration, args.rate, args.bots, args.senders, args.interval,
+                            args.warmup, args.max_growth_mb, args.hibernate_after, args.tracemalloc)
+    elif args.command == 'blocklist':
+        result = bench_blocklist(args.count, args.lookups)
+    elif args.command == 'bulk-import':
+        result = bench_bulk_import(args.count, args.latency_ms / 1000, args.concurrency)
+
+    result['elapsed_s'] = round(time.perf_counter() - started, 2)
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    if result.get('passed') is False:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
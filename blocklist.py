@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+فهرست مسدودی سراسری (اپراتور) و مسدودی مالک در همه ربات‌هایش
+
+هر دامنه (0 برای فهرست سراسری، شناسه مالک برای مسدودی‌های همان مالک)
+یک آرایه مرتب از شناسه‌های کاربر (array('q'، هشت بایت برای هر مورد) دارد.
+جلوی آرایه‌ها یک Bloom filter قرار دارد: برای اکثر پیام‌ها (فرستنده
+مسدود نیست) پاسخ با k بررسی بیت و بدون جستجو مشخص می‌شود و فقط مثبت‌ها
+با جستجوی دودویی در آرایه دقیق تایید می‌شوند. با یک میلیون مورد حافظه
+حدود 8MB برای آرایه‌ها و 1.2MB برای Bloom filter (خطای 1%) است.
+"""
+
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+GLOBAL_SCOPE = 0
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(value: int) -> int:
+    """splitmix64"""
+    z = (value + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+# ========== Bloom filter ==========
+class BloomFilter:
+    """Bloom filter با double hashing روی یک هش 64 بیتی"""
+
+    __slots__ = ('capacity', 'size', 'hashes', 'bits')
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key: int):
+        h = _hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: int) -> bool:
+        h = _hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+# ========== مجموعه مرتب اعداد ==========
+class SortedIntSet:
+    """مجموعه دقیق شناسه‌ها در آرایه مرتب (جستجوی دودویی)"""
+
+    __slots__ = ('values',)
+
+    def __init__(self, values: Iterable[int] = ()):
+        self.values = array('q', sorted(set(values)))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, value: int) -> bool:
+        i = bisect_left(self.values, value)
+        return i < len(self.values) and self.values[i] == value
+
+    def add(self, value: int) -> bool:
+        i = bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            return False
+        self.values.insert(i, value)
+        return True
+
+    def update(self, values: Iterable[int]) -> List[int]:
+        """افزودن دسته‌ای؛ برای دسته‌های بزرگ آرایه یک بار مرتب می‌شود"""
+        new = list(set(values))
+        if self.values:
+            new = [value for value in new if value not in self]
+        if len(new) > 64:
+            merged = array('q', self.values)
+            merged.extend(new)
+            self.values = array('q', sorted(merged))
+        else:
+            for value in new:
+                self.add(value)
+        return new
+
+    def discard(self, value: int) -> bool:
+        i = bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            del self.values[i]
+            return True
+        return False
+
+
+# ========== فهرست مسدودی ==========
+class Blocklist:
+    """
+    فهرست مسدودی سراسری و مسدودی‌های سطح مالک
+
+    کلید Bloom filter ترکیب دامنه و شناسه کاربر است. حذف از Bloom filter
+    ممکن نیست؛ بیت‌های حذف‌شده‌ها فقط نرخ مثبت کاذب را بالا می‌برند و
+    وقتی تعداد حذف‌ها یا موارد از ظرفیت بگذرد، فیلتر دوباره ساخته می‌شود.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.01):
+        self.error_rate = error_rate
+        self._scopes: Dict[int, SortedIntSet] = {}
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._count = 0
+        self._removed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(scope: int, user_id: int) -> int:
+        return _hash64(scope) ^ (user_id & _MASK64)
+
+    def add(self, user_id: int, scope: int = GLOBAL_SCOPE) -> bool:
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None:
+                entries = self._scopes[scope] = SortedIntSet()
+            if not entries.add(user_id):
+                return False
+            self._count += 1
+            if self._count > self._bloom.capacity:
+                self._rebuild(self._count * 2)
+            else:
+                self._bloom.add(self._key(scope, user_id))
+            return True
+
+    def update(self, entries: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """افزودن دسته‌ای (scope, user_id)؛ فقط مواردی که تازه اضافه شدند برگردانده می‌شوند"""
+        with self._lock:
+            grouped: Dict[int, List[int]] = {}
+            for scope, user_id in entries:
+                grouped.setdefault(scope, []).append(user_id)
+            added = []
+            for scope, user_ids in grouped.items():
+                entries = self._scopes.get(scope)
+                if entries is None:
+                    entries = self._scopes[scope] = SortedIntSet()
+                added.extend((scope, user_id) for user_id in entries.update(user_ids))
+            self._count += len(added)
+            if self._count > self._bloom.capacity:
+                self._rebuild(self._count * 2)
+            else:
+                for scope, user_id in added:
+                    self._bloom.add(self._key(scope, user_id))
+            return added
+
+    def discard(self, user_id: int, scope: int = GLOBAL_SCOPE) -> bool:
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None or not entries.discard(user_id):
+                return False
+            if not entries:
+                del self._scopes[scope]
+            self._count -= 1
+            self._removed += 1
+            if self._removed > self._bloom.capacity // 4:
+                self._rebuild(self._bloom.capacity)
+            return True
+
+    def _rebuild(self, capacity: int):
+        bloom = BloomFilter(capacity, self.error_rate)
+        for scope, entries in self._scopes.items():
+            for user_id in entries.values:
+                bloom.add(self._key(scope, user_id))
+        self._bloom = bloom
+        self._removed = 0
+
+    def contains(self, user_id: int, scope: int = GLOBAL_SCOPE) -> bool:
+        entries = self._scopes.get(scope)
+        if entries is None or self._key(scope, user_id) not in self._bloom:
+            return False
+        return user_id in entries
+
+    def match(self, user_id: int, owner_id: int, check_global: bool = True) -> Optional[str]:
+        """'global'، 'owner' یا None برای فرستنده یک ربات از این مالک"""
+        if check_global and self.contains(user_id, GLOBAL_SCOPE):
+            return 'global'
+        if owner_id != GLOBAL_SCOPE and self.contains(user_id, owner_id):
+            return 'owner'
+        return None
+
+    def scope_size(self, scope: int) -> int:
+        entries = self._scopes.get(scope)
+        return len(entries) if entries else 0
+
+    def stats(self) -> Dict:
+        return {
+            'entries': self._count,
+            'global': self.scope_size(GLOBAL_SCOPE),
+            'owners': len(self._scopes) - (GLOBAL_SCOPE in self._scopes),
+            'bloom_bytes': len(self._bloom.bits),
+            'bloom_hashes': self._bloom.hashes,
+            'array_bytes': sum(len(e.values) * e.values.itemsize for e in self._scopes.values()),
+        }
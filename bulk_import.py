@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ورود دسته‌ای توکن ربات‌ها (مهاجرت و فروشندگان)
+
+توکن‌ها با موازی‌سازی محدود اعتبارسنجی می‌شوند (getMe و حذف webhook برای
+هر توکن)، با فهرست ربات‌های ثبت‌شده مقایسه و تکراری‌ها کنار گذاشته
+می‌شوند و ربات‌های معتبر در دسته‌های batch_size تایی ثبت می‌شوند. پاسخ
+429 تلگرام با انتظار به اندازه retry_after دوباره امتحان می‌شود، پس
+توان عملیاتی فقط به محدودیت‌های API تلگرام بستگی دارد.
+
+اجرا:
+    python bulk_import.py tokens.txt --owner 123456789
+    python bulk_import.py tokens.txt --owner 123456789 --server https://your-app.onrender.com
+
+هر خط فایل یک توکن و (اختیاری) شناسه مالک آن است: «TOKEN [OWNER_ID]».
+بدون --server رکوردها مستقیم در STATE_STORE_URL نوشته می‌شوند و سرویس
+در راه‌اندازی بعدی (یا همگام‌سازی انتخاب رهبر) آن‌ها را بارگذاری می‌کند؛
+این حالت فقط با ذخیره‌سازی پایدار (sqlite یا redis) اجرا می‌شود.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'^\s*(\d{5,16}:[A-Za-z0-9_-]{30,})(?:[\s,;]+(\d+))?\s*$')
+
+# وضعیت‌های گزارش هر توکن
+IMPORTED = 'imported'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+REJECTED = 'rejected'
+FAILED = 'error'
+
+
+def mask_token(token: str) -> str:
+    """نمایش امن توکن در گزارش"""
+    return token[:10] + '...'
+
+
+def parse_entries(text: str, default_owner: Optional[int] = None) -> Tuple[List[Tuple[int, str, Optional[int]]], List[Dict[str, Any]]]:
+    """
+    تجزیه خطوط ورودی به (شماره خط، توکن، مالک)
+
+    Returns:
+        فهرست ورودی‌های معتبر و گزارش خطوط نامعتبر
+    """
+    entries = []
+    rejected = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        match = TOKEN_PATTERN.match(line)
+        if not match:
+            rejected.append({'line': line_no, 'token': mask_token(line.strip()),
+                             'status': INVALID, 'error': 'malformed token'})
+            continue
+        owner = int(match.group(2)) if match.group(2) else default_owner
+        entries.append((line_no, match.group(1), owner))
+    return entries, rejected
+
+
+async def validate_token(token: str) -> Dict[str, Any]:
+    """getMe و حذف webhook (تا polling یا getUpdates با خطای 409 مواجه نشود)"""
+    from telebot import asyncio_helper
+
+    me = await asyncio_helper.get_me(token)
+    await asyncio_helper.delete_webhook(token, drop_pending_updates=True)
+    return me
+
+
+# ========== کلاس ورود دسته‌ای ==========
+class BulkImporter:
+    """
+    اعتبارسنجی موازی و ثبت دسته‌ای توکن‌ها
+
+    register با هر دسته از ربات‌های معتبر (dictهای token/owner_id/username/
+    bot_id) صدا زده می‌شود و admit (اختیاری) پیش از پذیرش هر ربات سهمیه
+    مالک را بررسی می‌کند.
+    """
+
+    def __init__(self, concurrency: int = 16, batch_size: int = 100, max_retries: int = 3,
+                 validate: Callable[[str], Awaitable[Dict[str, Any]]] = validate_token):
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.validate = validate
+
+    async def _validate(self, token: str) -> Tuple[Optional[Dict[str, Any]], str, Optional[str]]:
+        """(اطلاعات ربات، وضعیت، خطا) با تکرار برای 429 و خطاهای شبکه"""
+        from telebot.asyncio_helper import ApiTelegramException
+
+        attempt = 0
+        while True:
+            try:
+                return await self.validate(token), IMPORTED, None
+            except ApiTelegramException as e:
+                if e.error_code in (401, 404):
+                    return None, INVALID, e.description
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                if e.error_code != 429 or attempt >= self.max_retries:
+                    return None, FAILED, e.description
+                await asyncio.sleep(retry_after or 1)
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    return None, FAILED, str(e)[:200]
+                await asyncio.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+
+    async def run(self, entries: List[Tuple[int, str, Optional[int]]],
+                  known_tokens: Set[str], known_usernames: Set[str],
+                  register: Callable[[List[Dict[str, Any]]], Awaitable[None]],
+                  admit: Optional[Callable[[int], bool]] = None) -> Dict[str, Any]:
+        """اجرای ورود و برگرداندن گزارش هر توکن"""
+        started = time.perf_counter()
+        results: List[Dict[str, Any]] = []
+        pending: List[Tuple[int, str, int]] = []
+        seen: Set[str] = set()
+
+        for line_no, token, owner in entries:
+            report = {'line': line_no, 'token': mask_token(token)}
+            if owner is None:
+                report.update(status=REJECTED, error='owner not specified')
+            elif token in known_tokens or token in seen:
+                report.update(status=DUPLICATE, error='token already registered')
+            else:
+                seen.add(token)
+                pending.append((line_no, token, owner))
+                continue
+            results.append(report)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(token: str):
+            async with semaphore:
+                return await self._validate(token)
+
+        batch: List[Dict[str, Any]] = []
+        usernames = set(known_usernames)
+        checks = [asyncio.ensure_future(check(token)) for _, token, _ in pending]
+        try:
+            # ترتیب گزارش و پذیرش سهمیه مطابق ترتیب ورودی است
+            for (line_no, token, owner), task in zip(pending, checks):
+                info, status, error = await task
+                report = {'line': line_no, 'token': mask_token(token), 'owner_id': owner}
+                if info is not None:
+                    report.update(username=info['username'], bot_id=info['id'])
+                    if info['username'] in usernames:
+                        status, error = DUPLICATE, 'bot already registered'
+                    elif admit and not admit(owner):
+                        status, error = REJECTED, 'owner bot quota exceeded'
+                    else:
+                        usernames.add(info['username'])
+                        batch.append({'token': token, 'owner_id': owner,
+                                      'username': info['username'], 'bot_id': info['id']})
+                report['status'] = status
+                if error:
+                    report['error'] = error
+                results.append(report)
+
+                if len(batch) >= self.batch_size:
+                    await register(batch)
+                    batch = []
+            if batch:
+                await register(batch)
+        finally:
+            for task in checks:
+                task.cancel()
+
+        results.sort(key=lambda r: r['line'])
+        elapsed = time.perf_counter() - started
+        counts = {status: 0 for status in (IMPORTED, DUPLICATE, INVALID, REJECTED, FAILED)}
+        for report in results:
+            counts[report['status']] += 1
+        return {
+            'total': len(results),
+            **counts,
+            'elapsed_s': round(elapsed, 2),
+            'tokens_per_s': round(len(pending) / elapsed, 1) if elapsed > 0 else None,
+            'results': results,
+        }
+
+
+# ========== خط فرمان ==========
+def _post_to_server(server: str, text: str, owner: Optional[int], ignore_quota: bool) -> Dict[str, Any]:
+    """ارسال فایل به API ادمین سرویس در حال اجرا"""
+    import json
+    import os
+    import urllib.request
+
+    body = json.dumps({'tokens': text, 'owner_id': owner, 'ignore_quota': ignore_quota}).encode()
+    request = urllib.request.Request(
+        server.rstrip('/') + '/api/admin/import-bots',
+        data=body,
+        headers={'Content-Type': 'application/json', 'X-Admin-Token': os.environ.get('ADMIN_TOKEN', '')},
+    )
+    with urllib.request.urlopen(request, timeout=3600) as response:
+        return json.loads(response.read())
+
+
+async def _import_offline(text: str, owner: Optional[int], concurrency: int, batch_size: int) -> Dict[str, Any]:
+    """ثبت مستقیم در ذخیره‌سازی بدون بررسی سهمیه (سرویس در راه‌اندازی بعدی بارگذاری می‌کند)"""
+    import json
+    import os
+
+    from main import BotRecord, configure_api_url
+    from state_store import NS_BOTS, create_state_store
+
+    configure_api_url(os.environ.get('TELEGRAM_API_URL'))
+    store = create_state_store(os.environ.get('STATE_STORE_URL'))
+    try:
+        existing = await store.load_bots()
+
+        async def register(batch: List[Dict[str, Any]]):
+            await store.execute([
+                ('put', NS_BOTS, item['username'], json.dumps(BotRecord(**item).to_dict(), ensure_ascii=False))
+                for item in batch
+            ])
+
+        entries, malformed = parse_entries(text, owner)
+        report = await BulkImporter(concurrency, batch_size).run(
+            entries,
+            known_tokens={record['token'] for record in existing},
+            known_usernames={record['username'] for record in existing},
+            register=register,
+        )
+        report['results'] = sorted(malformed + report['results'], key=lambda r: r['line'])
+        report['invalid'] += len(malformed)
+        report['total'] += len(malformed)
+        return report
+    finally:
+        store.close()
+
+
+def main():
+    import argparse
+    import json
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(description="ورود دسته‌ای توکن ربات‌ها")
+    parser.add_argument('file', help="فایل توکن‌ها (هر خط: TOKEN [OWNER_ID])؛ - برای stdin")
+    parser.add_argument('--owner', type=int, help="مالک پیش‌فرض خطوط بدون شناسه مالک")
+    parser.add_argument('--server', help="آدرس سرویس در حال اجرا (با متغیر ADMIN_TOKEN)")
+    parser.add_argument('--ignore-quota', action='store_true', help="نادیده گرفتن سهمیه ربات مالک (فقط با --server)")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.file == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+    store_url = os.environ.get('STATE_STORE_URL')
+    if not args.server and (not store_url or store_url.startswith('memory:')):
+        # ذخیره‌سازی حافظه‌ای با پایان همین فرآیند از بین می‌رود
+        parser.error("ورود بدون --server به STATE_STORE_URL پایدار (sqlite یا redis) نیاز دارد")
+
+    if args.server:
+        report = _post_to_server(args.server, text, args.owner, args.ignore_quota)
+    else:
+        report = asyncio.run(_import_offline(text, args.owner, args.concurrency, args.batch_size))
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+تشخیص پیام‌های تکراری (کمپین‌های اسپم) با پنجره زمانی لغزان
+
+برای هر پیام یک اثر انگشت ساخته می‌شود:
+
+    رسانه     file_unique_id فایل به همراه هش کپشن
+    متن       هش دقیق متن نرمال‌شده (حروف کوچک، فاصله‌های یکسان، بدون
+              کاراکترهای نامرئی) و در صورت فعال بودن SimHash 64 بیتی روی
+              4-gramهای کاراکتری برای متن‌های تقریباً یکسان
+
+متن‌های کوتاه‌تر از short_text فقط برای همان فرستنده تکراری حساب می‌شوند
+تا سلام‌های معمولی فرستندگان مختلف یکی نشوند. شباهت SimHash هم فقط برای
+همان فرستنده کافی است؛ پیام فرستندگان مختلف فقط با هش دقیق برابر یکی
+می‌شوند تا متن‌های قالبی ولی متفاوت آن‌ها از دید مالک پنهان نشود.
+
+جستجوی SimHash با تقسیم 64 بیت به 8 باند 8 بیتی O(1) است: دو هش با
+فاصله همینگ حداکثر 7 حتماً در یکی از باندها برابرند، پس فقط اعضای
+همان سطل‌ها (حداکثر 16 مورد در هر سطل) مقایسه می‌شوند. تعداد مدخل‌ها
+محدود است (LRU، حدود 800 بایت برای هر مدخل با SimHash) و مدخل‌های
+قدیمی‌تر از window ثانیه نادیده گرفته می‌شوند.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+_INVISIBLE = re.compile('[\u200b-\u200f\u202a-\u202e\u2060-\u2064\ufeff]')
+_SPACES = re.compile(r'\s+')
+
+MEDIA_FIELDS = ('video', 'document', 'voice', 'audio', 'sticker', 'animation', 'video_note')
+
+BANDS = 8
+BAND_BITS = 64 // BANDS
+BUCKET_SIZE = 16
+
+
+def normalize_text(text: str) -> str:
+    return _SPACES.sub(' ', _INVISIBLE.sub('', text)).strip().casefold()
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(data: str) -> int:
+    # هش داخلی پایتون: ایندکس فقط در حافظه همین فرآیند است
+    return hash(data) & _MASK64
+
+
+def simhash(text: str, ngram: int = 4, limit: int = 256) -> int:
+    """
+    SimHash 64 بیتی روی n-gramهای کاراکتری (حداکثر limit کاراکتر اول)
+
+    بیت‌های همه هش‌ها پشت سر هم در یک رشته قرار می‌گیرند و شمارش هر ستون
+    بیت با یک برش گام‌دار انجام می‌شود (64 عملیات به جای 64 × n).
+    """
+    text = text[:limit]
+    grams = [text[i:i + ngram] for i in range(max(1, len(text) - ngram + 1))]
+    columns = ''.join([format(_hash64(gram), '064b') for gram in grams])
+    half = len(grams) / 2
+    result = 0
+    for bit in range(64):
+        if columns[bit::64].count('1') > half:
+            result |= 1 << (63 - bit)
+    return result
+
+
+class Fingerprint:
+    """اثر انگشت محتوای یک پیام"""
+
+    __slots__ = ('exact', 'simhash', 'sender_scoped')
+
+    def __init__(self, exact: int, simhash_value: Optional[int] = None, sender_scoped: bool = False):
+        self.exact = exact
+        self.simhash = simhash_value
+        self.sender_scoped = sender_scoped
+
+
+class DuplicateEntry:
+    """اعلان ارسال شده برای یک محتوا و تعداد تکرارهای آن"""
+
+    __slots__ = ('key', 'simhash', 'owner_id', 'bot_username', 'sender_id', 'message_id',
+                 'via_child', 'count', 'senders', 'last_seen', 'edit_scheduled', 'held')
+
+    MAX_SENDERS = 100
+    MAX_HELD = 20
+
+    def __init__(self, key: Tuple, simhash_value: Optional[int], owner_id: int,
+                 bot_username: str, sender_id: int):
+        self.key = key
+        self.simhash = simhash_value
+        self.owner_id = owner_id
+        self.bot_username = bot_username
+        self.sender_id = sender_id
+        self.message_id: Optional[int] = None  # تا ارسال اعلان اول None است
+        self.via_child = False
+        self.count = 1
+        self.senders: Optional[Set[int]] = None  # فرستندگان تکرارها (فقط با بیش از یک فرستنده)
+        self.last_seen = time.monotonic()
+        self.edit_scheduled = False
+        self.held: Optional[List[Any]] = None  # تکرارهای رسیده پیش از ارسال اعلان اول
+
+    @property
+    def sender_count(self) -> int:
+        return len(self.senders) if self.senders else 1
+
+
+# ========== ایندکس تکراری‌ها ==========
+class DuplicateIndex:
+    """
+    ایندکس اثر انگشت پیام‌ها به اعلان ارسال شده برای مالک
+
+    claim در thread هر ربات فرزند صدا زده می‌شود و زیر یک قفل یا مدخل
+    موجود را (با افزایش شمارنده) برمی‌گرداند یا مدخل تازه‌ای رزرو می‌کند؛
+    تکرارهایی که پیش از ارسال اعلان اول برسند هم شمرده می‌شوند.
+    """
+
+    def __init__(self, window: float = 600, max_entries: int = 20000, use_simhash: bool = True,
+                 simhash_distance: int = 6, short_text: int = 20, simhash_min_length: int = 40):
+        self.window = window
+        self.max_entries = max_entries
+        self.use_simhash = use_simhash
+        self.simhash_distance = min(simhash_distance, BANDS - 1)
+        self.short_text = short_text
+        self.simhash_min_length = simhash_min_length
+        self._entries: 'OrderedDict[Tuple, DuplicateEntry]' = OrderedDict()
+        self._bands: Dict[int, Tuple[DuplicateEntry, ...]] = {}  # tuple کم‌حجم‌تر از list است
+        self._lock = threading.Lock()
+        self.collapsed = 0
+
+    def fingerprint(self, message) -> Optional[Fingerprint]:
+        """اثر انگشت پیام یا None برای انواعی که بررسی نمی‌شوند"""
+        caption = normalize_text(getattr(message, 'caption', None) or '')
+        if getattr(message, 'photo', None):
+            return Fingerprint(_hash64(f"photo:{message.photo[-1].file_unique_id}:{caption}"))
+        for field in MEDIA_FIELDS:
+            media = getattr(message, field, None)
+            if media is not None:
+                return Fingerprint(_hash64(f"{field}:{media.file_unique_id}:{caption}"))
+
+        text = normalize_text(getattr(message, 'text', None) or '')
+        if not text:
+            return None
+        if len(text) < self.short_text:
+            return Fingerprint(_hash64(f"text:{text}"), sender_scoped=True)
+        near = simhash(text) if self.use_simhash and len(text) >= self.simhash_min_length else None
+        return Fingerprint(_hash64(f"text:{text}"), near)
+
+    @staticmethod
+    def _key(owner_id: int, fingerprint: Fingerprint, sender_id: int) -> Tuple:
+        if fingerprint.sender_scoped:
+            return (owner_id, fingerprint.exact, sender_id)
+        return (owner_id, fingerprint.exact)
+
+    @staticmethod
+    def _band_keys(owner_id: int, value: int) -> List[int]:
+        """کلید عددی سطل هر باند: (مالک، شماره باند، مقدار باند)"""
+        mask = (1 << BAND_BITS) - 1
+        base = owner_id << 16
+        return [base | band << BAND_BITS | (value >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+    def _alive(self, entry: DuplicateEntry, now: float) -> bool:
+        return now - entry.last_seen <= self.window
+
+    def _find_near(self, owner_id: int, value: int, sender_id: int, now: float) -> Optional[DuplicateEntry]:
+        for band_key in self._band_keys(owner_id, value):
+            for entry in self._bands.get(band_key, ()):
+                if entry.sender_id != sender_id:
+                    continue
+                if bin(entry.simhash ^ value).count('1') <= self.simhash_distance and self._alive(entry, now):
+                    return entry
+        return None
+
+    def _evict(self, entry: DuplicateEntry):
+        self._entries.pop(entry.key, None)
+        if entry.simhash is not None:
+            for band_key in self._band_keys(entry.owner_id, entry.simhash):
+                bucket = self._bands.get(band_key)
+                if bucket and entry in bucket:
+                    bucket = tuple(other for other in bucket if other is not entry)
+                    if bucket:
+                        self._bands[band_key] = bucket
+                    else:
+                        del self._bands[band_key]
+
+    def claim(self, owner_id: int, fingerprint: Fingerprint, sender_id: int,
+              bot_username: str) -> Optional[DuplicateEntry]:
+        """
+        ثبت پیام در ایندکس
+
+        Returns:
+            مدخل موجود (پیام تکراری است و شمارنده آن افزایش یافته) یا None
+            (پیام تازه است و باید عادی رله شود و سپس bind شود)
+        """
+        now = time.monotonic()
+        key = self._key(owner_id, fingerprint, sender_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._alive(entry, now):
+                self._evict(entry)
+                entry = None
+            if entry is None and fingerprint.simhash is not None:
+                entry = self._find_near(owner_id, fingerprint.simhash, sender_id, now)
+
+            if entry is not None:
+                entry.count += 1
+                if sender_id != entry.sender_id:
+                    if entry.senders is None:
+                        entry.senders = {entry.sender_id}
+                    if len(entry.senders) < entry.MAX_SENDERS:
+                        entry.senders.add(sender_id)
+                entry.last_seen = now
+                self._entries.move_to_end(entry.key)
+                self.collapsed += 1
+                return entry
+
+            entry = DuplicateEntry(key, fingerprint.simhash, owner_id, bot_username, sender_id)
+            self._entries[key] = entry
+            if fingerprint.simhash is not None:
+                for band_key in self._band_keys(owner_id, fingerprint.simhash):
+                    bucket = self._bands.get(band_key, ())
+                    self._bands[band_key] = bucket[-(BUCKET_SIZE - 1):] + (entry,)
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries.values())))
+            return None
+
+    def bind(self, owner_id: int, fingerprint: Fingerprint, sender_id: int,
+             message_id: int, via_child: bool) -> Optional[DuplicateEntry]:
+        """ثبت شناسه اعلان ارسال شده برای مدخل رزرو شده"""
+        with self._lock:
+            entry = self._entries.get(self._key(owner_id, fingerprint, sender_id))
+            if entry is None:
+                return None
+            entry.message_id = message_id
+            entry.via_child = via_child
+            return entry
+
+    def hold(self, entry: DuplicateEntry, item: Any) -> bool:
+        """
+        نگه داشتن تکراری که پیش از ارسال اعلان اول رسیده
+
+        Returns:
+            True اگر مدخل هنوز اعلانی ندارد و item نگه داشته شد؛ سرنوشت آن
+            با bind (take_held) یا release معلوم می‌شود
+        """
+        with self._lock:
+            if entry.message_id is not None or self._entries.get(entry.key) is not entry:
+                return False
+            if entry.held is None:
+                entry.held = []
+            if len(entry.held) >= entry.MAX_HELD:
+                return False
+            entry.held.append(item)
+            return True
+
+    def take_held(self, entry: DuplicateEntry) -> List[Any]:
+        """برداشتن تکرارهای نگه‌داشته شده (پس از ارسال اعلان اول)"""
+        with self._lock:
+            held, entry.held = entry.held or [], None
+            return held
+
+    def release(self, owner_id: int, fingerprint: Fingerprint, sender_id: int) -> List[Any]:
+        """
+        حذف مدخل رزرو شده (اعلان ارسال نشد)
+
+        Returns:
+            تکرارهای نگه‌داشته شده که باید دوباره رله شوند
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(owner_id, fingerprint, sender_id))
+            if entry is None or entry.message_id is not None:
+                return []
+            self._evict(entry)
+            held, entry.held = entry.held or [], None
+            return held
+
+    def begin_edit(self, entry: DuplicateEntry) -> bool:
+        """آیا باید به‌روزرسانی شمارنده اعلان زمان‌بندی شود؟ (یکی در هر لحظه)"""
+        with self._lock:
+            if entry.edit_scheduled or entry.message_id is None:
+                return False
+            entry.edit_scheduled = True
+            return True
+
+    def end_edit(self, entry: DuplicateEntry):
+        with self._lock:
+            entry.edit_scheduled = False
+
+    def forget_bot(self, bot_username: str):
+        with self._lock:
+            for entry in [e for e in self._entries.values() if e.bot_username == bot_username]:
+                self._evict(entry)
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._entries),
+            'simhash_buckets': len(self._bands),
+            'collapsed': self.collapsed,
+        }
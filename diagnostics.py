@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ابزارهای عیب‌یابی کارایی در حال اجرا
+
+    LoopMonitor      اندازه‌گیری تاخیر (lag) هر event loop و تشخیص
+                     هندلرهایی که loop را مسدود کرده‌اند
+    sample_profile   پروفایلر نمونه‌برداری از همه threadها با خروجی
+                     collapsed stacks (مناسب flamegraph.pl و speedscope)
+    approx_size      اندازه تقریبی یک ساختار داده (پیمایش بازگشتی محدود)
+    MemoryTracker    snapshotهای tracemalloc بر حسب درخواست و مقایسه آن‌ها
+                     به تفکیک ماژول یا خط
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WATCHDOG_THREAD = 'loop_watchdog'
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename.rsplit('/', 1)[-1]
+    return f"{code.co_name} ({filename}:{frame.f_lineno})"
+
+
+def _stack(frame, limit: int = 64) -> List[str]:
+    """فهرست فریم‌ها از ریشه تا فریم فعلی"""
+    frames = []
+    while frame is not None and len(frames) < limit:
+        frames.append(_format_frame(frame))
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+# ========== پایش تاخیر event loop ==========
+class _LoopState:
+    __slots__ = ('name', 'loop', 'thread_id', 'heartbeat', 'lags', 'max_lag', 'stall')
+
+    def __init__(self, name: str, loop: asyncio.AbstractEventLoop, thread_id: int):
+        self.name = name
+        self.loop = loop
+        self.thread_id = thread_id
+        self.heartbeat = time.monotonic()
+        self.lags: deque = deque(maxlen=600)
+        self.max_lag = 0.0
+        self.stall: Optional[Dict] = None
+
+
+class LoopMonitor:
+    """
+    پایش تاخیر event loopها و تشخیص هندلرهای کند
+
+    در هر loop ثبت‌شده یک task سبک هر interval ثانیه بیدار می‌شود و
+    اختلاف زمان واقعی بیدار شدن با زمان مورد انتظار را به عنوان lag ثبت
+    می‌کند. یک thread ناظر (watchdog) ضربان این taskها را بررسی می‌کند؛
+    اگر loopی بیش از slow_threshold ثانیه ضربان نداشته باشد، یعنی یک
+    callback آن را مسدود کرده است و پشته thread آن loop ثبت می‌شود تا
+    مشخص شود کدام هندلر و چه مدت loop را نگه داشته است.
+    """
+
+    def __init__(self, interval: float = 0.25, slow_threshold: float = 0.1, max_events: int = 200):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self._loops: Dict[int, _LoopState] = {}
+        self._lock = threading.Lock()
+        self.slow_events: deque = deque(maxlen=max_events)
+        self._watchdog: Optional[threading.Thread] = None
+
+    def register(self, loop: asyncio.AbstractEventLoop, name: str):
+        """ثبت loop برای پایش (از هر thread قابل فراخوانی است)"""
+        def start():
+            state = _LoopState(name, loop, threading.get_ident())
+            with self._lock:
+                self._loops[id(loop)] = state
+            loop.create_task(self._sampler(state))
+
+        if loop.is_running() and _running_loop() is not loop:
+            loop.call_soon_threadsafe(start)
+        else:
+            loop.call_soon(start)
+        self._ensure_watchdog()
+
+    def unregister(self, loop: asyncio.AbstractEventLoop):
+        with self._lock:
+            self._loops.pop(id(loop), None)
+
+    async def _sampler(self, state: _LoopState):
+        try:
+            while id(state.loop) in self._loops:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - expected)
+                state.lags.append(lag)
+                state.max_lag = max(state.max_lag, lag)
+                state.heartbeat = now
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.unregister(state.loop)
+
+    def _ensure_watchdog(self):
+        with self._lock:
+            if self._watchdog is None or not self._watchdog.is_alive():
+                self._watchdog = threading.Thread(target=self._watch, daemon=True, name=WATCHDOG_THREAD)
+                self._watchdog.start()
+
+    def _watch(self):
+        check_every = min(self.slow_threshold / 2, 0.05)
+        while True:
+            time.sleep(check_every)
+            now = time.monotonic()
+            frames = None
+            with self._lock:
+                states = list(self._loops.values())
+
+            for state in states:
+                blocked_for = now - state.heartbeat - self.interval
+                if blocked_for > self.slow_threshold:
+                    if state.stall is None:
+                        if frames is None:
+                            frames = sys._current_frames()
+                        frame = frames.get(state.thread_id)
+                        state.stall = {
+                            'loop': state.name,
+                            'started_at': time.time() - blocked_for,
+                            'stack': _stack(frame)[-12:] if frame else [],
+                        }
+                    state.stall['blocked_ms'] = round(blocked_for * 1000, 1)
+                elif state.stall is not None:
+                    event, state.stall = state.stall, None
+                    self.slow_events.append(event)
+                    logger.warning(
+                        "event loop %s به مدت %sms مسدود بود: %s",
+                        event['loop'], event['blocked_ms'], event['stack'][-1] if event['stack'] else '?'
+                    )
+
+    def snapshot(self) -> Dict:
+        """وضعیت lag هر loop و آخرین رویدادهای مسدود شدن"""
+        loops = {}
+        with self._lock:
+            states = list(self._loops.values())
+        for state in states:
+            lags = sorted(state.lags)
+            loops[state.name] = {
+                'samples': len(lags),
+                'p50_lag_ms': round(lags[len(lags) // 2] * 1000, 2) if lags else 0.0,
+                'p99_lag_ms': round(lags[int(len(lags) * 0.99)] * 1000, 2) if lags else 0.0,
+                'max_lag_ms': round(state.max_lag * 1000, 2),
+                'blocked_now': state.stall,
+            }
+        return {
+            'interval_ms': self.interval * 1000,
+            'slow_threshold_ms': self.slow_threshold * 1000,
+            'loops': loops,
+            'slow_events': list(self.slow_events),
+        }
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+# ========== پروفایلر نمونه‌برداری ==========
+def sample_profile(seconds: float = 5.0, interval: float = 0.005,
+                   include_idle: bool = False) -> str:
+    """
+    نمونه‌برداری از پشته همه threadها به مدت seconds ثانیه
+
+    خروجی به فرمت collapsed stacks است: هر خط «thread;frame;...;frame count».
+    threadهایی که در انتظار I/O یا قفل هستند (فریم بالایی select/wait/sleep)
+    به طور پیش‌فرض حذف می‌شوند تا فقط کار واقعی CPU دیده شود.
+    """
+    idle_functions = {'select', 'poll', 'epoll', 'wait', 'sleep', '_recv_into', 'accept', 'readinto'}
+    me = threading.get_ident()
+    names = {}
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me or names.get(thread_id) == WATCHDOG_THREAD:
+                continue
+            if not include_idle and frame.f_code.co_name in idle_functions:
+                continue
+            stack = _stack(frame)
+            counts[';'.join([names.get(thread_id, str(thread_id))] + stack)] += 1
+        time.sleep(interval)
+
+    return '\n'.join(f"{stack} {count}" for stack, count in counts.most_common())
+
+
+# ========== حسابداری حافظه ==========
+# اشیاء مشترک بین همه (شمرده نمی‌شوند) و اشیاء بدون فرزند
+_SHARED = (type, types.ModuleType, types.CodeType, types.FrameType, types.BuiltinFunctionType,
+           asyncio.AbstractEventLoop, threading.Thread)
+_LEAVES = (str, bytes, int, float, bool, type(None))
+
+
+def approx_size(obj, exclude: Iterable = (), max_objects: int = 200000, sample: int = 1000) -> int:
+    """
+    اندازه تقریبی obj و هر چه فقط از طریق آن قابل دسترسی است (بایت)
+
+    پیمایش از dict/list/tuple/set، __dict__ و __slots__ اشیاء و سلول‌های
+    closure توابع عبور می‌کند؛ ماژول‌ها، کلاس‌ها، loopها، threadها و
+    اشیاء exclude (مثلاً خود سرویس که همه هندلرها به آن ارجاع دارند)
+    شمرده نمی‌شوند. از مجموعه‌های بزرگ‌تر از sample فقط sample عضو اول
+    پیمایش و نتیجه به کل مجموعه تعمیم داده می‌شود تا هزینه endpoint
+    محدود بماند.
+    """
+    seen = {id(item) for item in exclude}
+    total = 0
+    stack = [(obj, 1.0)]
+    visited = 0
+    while stack and visited < max_objects:
+        item, weight = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, _SHARED):
+            continue
+        visited += 1
+        total += sys.getsizeof(item, 0) * weight
+        if isinstance(item, _LEAVES):
+            continue
+
+        if isinstance(item, dict):
+            size = len(item)
+            # کپی در C و بدون رها کردن GIL؛ ساختارها در threadهای دیگر تغییر می‌کنند
+            children = [part for pair in islice(item.items(), sample) for part in pair]
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            size = len(item)
+            children = list(islice(item, sample))
+        elif isinstance(item, types.FunctionType):
+            children = [cell.cell_contents for cell in item.__closure__ or () if _cell_filled(cell)]
+            size = len(children)
+        elif isinstance(item, types.MethodType):
+            children, size = [item.__func__], 1
+        else:
+            children = []
+            if hasattr(item, '__dict__'):
+                children.append(item.__dict__)
+            slots = getattr(type(item), '__slots__', ())
+            for slot in (slots,) if isinstance(slots, str) else slots:
+                if hasattr(item, slot):
+                    children.append(getattr(item, slot))
+            size = len(children)
+
+        child_weight = weight * (size / sample if size > sample else 1.0)
+        stack.extend((child, child_weight) for child in children)
+    return int(total)
+
+
+def _cell_filled(cell) -> bool:
+    try:
+        cell.cell_contents
+        return True
+    except ValueError:
+        return False
+
+
+def process_memory() -> Dict:
+    """RSS فعلی و بیشینه فرآیند (بایت)"""
+    result = {'rss_bytes': None, 'peak_rss_bytes': None}
+    try:
+        with open('/proc/self/statm') as statm:
+            result['rss_bytes'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # لینوکس کیلوبایت و macOS بایت برمی‌گرداند
+        result['peak_rss_bytes'] = peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, OSError):
+        pass
+    return result
+
+
+class MemoryTracker:
+    """
+    snapshotهای tracemalloc بر حسب درخواست
+
+    tracemalloc سربار قابل توجهی دارد، پس فقط با اولین snapshot (یا
+    start) روشن می‌شود و تا stop روشن می‌ماند. چند snapshot آخر با شناسه
+    نگه داشته می‌شوند تا تخصیص‌های بین دو لحظه به تفکیک ماژول یا خط
+    مقایسه شوند؛ رشد پیوسته یک خط بین snapshotها نشانه نشت است.
+    """
+
+    GROUPS = {'module': 'filename', 'line': 'lineno'}
+
+    def __init__(self, frames: int = 1, keep: int = 4):
+        self.frames = frames
+        self.keep = keep
+        self._snapshots: 'OrderedDict[int, tuple]' = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            logger.info("tracemalloc روشن شد (%s فریم)", self.frames)
+
+    def stop(self):
+        with self._lock:
+            self._snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("tracemalloc خاموش شد")
+
+    def _filtered(self, snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),  # خود ابزار اندازه‌گیری
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    @staticmethod
+    def _label(stat, group: str) -> str:
+        frame = stat.traceback[0]
+        filename = frame.filename
+        for path in sorted(sys.path, key=len, reverse=True):
+            if path and filename.startswith(path + os.sep):
+                filename = filename[len(path) + 1:]
+                break
+        return filename if group == 'module' else f"{filename}:{frame.lineno}"
+
+    def snapshot(self, group: str = 'module', limit: int = 20) -> Dict:
+        """snapshot تازه و پرحجم‌ترین گروه‌های آن (tracemalloc را در صورت نیاز روشن می‌کند)"""
+        group = group if group in self.GROUPS else 'module'
+        started = not tracemalloc.is_tracing()
+        self.start()
+        snapshot = self._filtered(tracemalloc.take_snapshot())
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self._snapshots) > self.keep:
+                self._snapshots.popitem(last=False)
+        stats = snapshot.statistics(self.GROUPS[group])
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'id': snapshot_id,
+            'tracing_started_now': started,
+            'traced_bytes': current,
+            'traced_peak_bytes': peak,
+            'top': [
+                {'where': self._label(stat, group), 'size_bytes': stat.size, 'count': stat.count}
+                for stat in stats[:limit]
+            ],
+        }
+
+    def diff(self, base_id: int, target_id: Optional[int] = None,
+             group: str = 'module', limit: int = 20) -> Optional[Dict]:
+        """
+        تفاوت دو snapshot (بدون target_id با یک snapshot تازه)
+
+        Returns:
+            گروه‌ها به ترتیب بیشترین رشد، یا None اگر snapshot پایه موجود نباشد
+        """
+        group = group if group in self.GROUPS else 'module'
+        with self._lock:
+            base = self._snapshots.get(base_id)
+            target = self._snapshots.get(target_id) if target_id is not None else None
+        if base is None or (target_id is not None and target is None):
+            return None
+        if target is None:
+            target_id = self.snapshot(group, limit=0)['id']
+            with self._lock:
+                target = self._snapshots[target_id]
+        stats = target[1].compare_to(base[1], self.GROUPS[group])
+        return {
+            'base': base_id,
+            'target': target_id,
+            'seconds': round(target[0] - base[0], 1),
+            'total_diff_bytes': sum(stat.size_diff for stat in stats),
+            'top': [
+                {
+                    'where': self._label(stat, group),
+                    'size_bytes': stat.size,
+                    'size_diff_bytes': stat.size_diff,
+                    'count_diff': stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    def status(self) -> Dict:
+        with self._lock:
+            snapshots = [{'id': sid, 'taken_at': taken} for sid, (taken, _) in self._snapshots.items()]
+        result = {'tracing': tracemalloc.is_tracing(), 'snapshots': snapshots}
+        if result['tracing']:
+            result['traced_bytes'], result['traced_peak_bytes'] = tracemalloc.get_traced_memory()
+        return result
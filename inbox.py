@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+صندوق پیام قابل جستجو برای مالکان ربات‌ها
+
+هر پیام رله‌شده (متن یا کپشن) در SQLite ذخیره می‌شود تا مالک بتواند
+پیام‌ها و فرستندگان قدیمی را با /inbox مرور و با /search جستجو کند.
+
+    جدول‌ها بر اساس زمان بخش‌بندی می‌شوند (inbox_<شماره بازه>، هر بازه
+    partition_days روز) و هر بخش یک جدول FTS5 با محتوای خارجی روی متن
+    پیام و شناسه مالک دارد؛ جستجو با «owner_id : <مالک> AND body : (...)»
+    فقط فهرست پیام‌های همان مالک را قطع می‌دهد، نه نتایج همه مالکان. نگهداری با حذف کامل بخش‌های قدیمی‌تر از retention انجام
+    می‌شود (DROP TABLE، بدون حذف سطر به سطر و بدون رشد فایل).
+
+    شناسه هر پیام (زمان به میلی‌ثانیه << 10) | شمارنده است، پس ترتیب شناسه
+    همان ترتیب زمانی است و صفحه‌بندی keyset با «id < cursor» در هر بخش از
+    ایندکس (owner_id, id) استفاده می‌کند؛ هزینه هر صفحه به تعداد کل
+    پیام‌ها بستگی ندارد.
+
+    نوشتن از مسیر رله فقط یک put_nowait در صف محدود است؛ یک thread
+    اختصاصی پیام‌ها را دسته‌ای در یک تراکنش می‌نویسد. خواندن‌ها روی اتصال
+    و thread جداگانه (WAL) اجرا می‌شوند تا با نوشتن‌ها تداخل نداشته باشند.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match_query(text: str) -> Optional[str]:
+    """تبدیل متن جستجوی کاربر به عبارت امن FTS5 (همه کلمات، با تطبیق پیشوندی)"""
+    tokens = _TOKEN.findall(text)[:8]
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+# ========== کلاس صندوق پیام ==========
+class InboxStore:
+    """
+    ذخیره و بازیابی پیام‌های رله‌شده با بخش‌بندی زمانی و ایندکس FTS5
+
+    Args:
+        retention_days: پیام‌های قدیمی‌تر (در قالب بخش کامل) حذف می‌شوند
+        partition_days: طول بازه زمانی هر بخش
+    """
+
+    def __init__(self, path: str, retention_days: float = 30, partition_days: float = 7,
+                 queue_size: int = 10000, batch_size: int = 500, prune_interval: float = 3600):
+        self.path = path
+        self.retention = retention_days * 86400
+        self.partition_ms = int(partition_days * 86400 * 1000)
+        self.batch_size = batch_size
+        self.prune_interval = prune_interval
+        self.dropped = 0
+        self.written = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._partitions: List[int] = []
+        self._partitions_lock = threading.Lock()
+        self._last_id = 0
+        self._closed = threading.Event()
+
+        self._writer = self._connect()
+        self._partitions = sorted(
+            int(name[len('inbox_'):])
+            for (name,) in self._writer.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'inbox_[0-9]*' "
+                "AND name NOT LIKE '%fts%'"
+            )
+        )
+        for partition in self._partitions:
+            self._migrate_fts(partition)
+        if self._partitions:
+            row = self._writer.execute(f"SELECT MAX(id) FROM inbox_{self._partitions[-1]}").fetchone()
+            self._last_id = row[0] or 0
+        self._reader_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='inbox_reader')
+        self._reader: Optional[sqlite3.Connection] = None
+        self._writer_thread = threading.Thread(target=self._write_loop, daemon=True, name='inbox_writer')
+        self._writer_thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # فقط روی فایل تازه اثر دارد؛ فضای بخش‌های حذف‌شده به سیستم‌عامل برمی‌گردد
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ---------- نوشتن ----------
+    def append(self, owner_id: int, bot_username: str, sender_id: int,
+               content_type: str, body: str, ts: Optional[float] = None) -> bool:
+        """افزودن پیام بدون انتظار (در صورت پر بودن صف دور ریخته و شمارش می‌شود)"""
+        try:
+            self._queue.put_nowait(('add', (ts or time.time(), owner_id, bot_username, sender_id, content_type, body or '')))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def forget_bot(self, bot_username: str):
+        """حذف پیام‌های یک ربات (پس از حذف ربات)"""
+        self._queue.put(('forget', bot_username))
+
+    def _next_id(self, ts: float) -> int:
+        candidate = int(ts * 1000) << 10
+        self._last_id = max(candidate, self._last_id + 1)
+        return self._last_id
+
+    def _partition_of(self, message_id: int) -> int:
+        return (message_id >> 10) // self.partition_ms
+
+    def _ensure_partition(self, partition: int):
+        if partition in self._partitions:
+            return
+        table = f"inbox_{partition}"
+        conn = self._writer
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, bot TEXT NOT NULL, "
+            "sender_id INTEGER NOT NULL, content_type TEXT NOT NULL, body TEXT NOT NULL)"
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_owner ON {table} (owner_id, id)")
+        self._create_fts(table)
+        with self._partitions_lock:
+            self._partitions = sorted(set(self._partitions) | {partition})
+
+    def _create_fts(self, table: str):
+        self._writer.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5("
+            f"body, owner_id, content='{table}', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def _migrate_fts(self, partition: int):
+        """بازسازی ایندکس FTS بخش‌های قدیمی که ستون مالک ندارند"""
+        table = f"inbox_{partition}"
+        columns = [row[1] for row in self._writer.execute(f"PRAGMA table_info({table}_fts)")]
+        if 'owner_id' in columns:
+            return
+        with self._writer as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {table}_fts")
+            self._create_fts(table)
+            conn.execute(
+                f"INSERT INTO {table}_fts (rowid, body, owner_id) "
+                f"SELECT id, body, owner_id FROM {table} WHERE body != ''"
+            )
+        logger.info("ایندکس جستجوی بخش %s صندوق پیام بازسازی شد", partition)
+
+    def _write_batch(self, items: List[Tuple[str, Any]]):
+        conn = self._writer
+        with conn:
+            for op, payload in items:
+                if op == 'add':
+                    ts, owner_id, bot, sender_id, content_type, body = payload
+                    message_id = self._next_id(ts)
+                    partition = self._partition_of(message_id)
+                    self._ensure_partition(partition)
+                    conn.execute(
+                        f"INSERT INTO inbox_{partition} (id, owner_id, bot, sender_id, content_type, body) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (message_id, owner_id, bot, sender_id, content_type, body)
+                    )
+                    if body:
+                        conn.execute(
+                            f"INSERT INTO inbox_{partition}_fts (rowid, body, owner_id) VALUES (?, ?, ?)",
+                            (message_id, body, owner_id)
+                        )
+                    self.written += 1
+                elif op == 'forget':
+                    for partition in list(self._partitions):
+                        table = f"inbox_{partition}"
+                        conn.execute(
+                            f"INSERT INTO {table}_fts ({table}_fts, rowid, body, owner_id) "
+                            f"SELECT 'delete', id, body, owner_id FROM {table} WHERE bot = ? AND body != ''",
+                            (payload,)
+                        )
+                        conn.execute(f"DELETE FROM {table} WHERE bot = ?", (payload,))
+
+    def _write_loop(self):
+        next_prune = 0.0
+        while not self._closed.is_set() or not self._queue.empty():
+            try:
+                items = [self._queue.get(timeout=1.0)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if items:
+                try:
+                    self._write_batch(items)
+                except Exception as e:
+                    logger.error("خطا در نوشتن صندوق پیام: %s", e)
+                finally:
+                    for _ in items:
+                        self._queue.task_done()
+
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + self.prune_interval
+                try:
+                    self.prune()
+                except Exception as e:
+                    logger.error("خطا در حذف بخش‌های قدیمی صندوق پیام: %s", e)
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """حذف بخش‌هایی که کاملاً قدیمی‌تر از retention هستند (در thread نویسنده)"""
+        cutoff_ms = int(((now or time.time()) - self.retention) * 1000)
+        expired = [p for p in self._partitions if (p + 1) * self.partition_ms <= cutoff_ms]
+        if not expired:
+            return 0
+        conn = self._writer
+        with conn:
+            for partition in expired:
+                conn.execute(f"DROP TABLE IF EXISTS inbox_{partition}_fts")
+                conn.execute(f"DROP TABLE IF EXISTS inbox_{partition}")
+        with self._partitions_lock:
+            self._partitions = [p for p in self._partitions if p not in expired]
+        conn.execute("PRAGMA incremental_vacuum")
+        logger.info("صندوق پیام: %s بخش قدیمی حذف شد", len(expired))
+        return len(expired)
+
+    def flush(self, timeout: float = 10.0):
+        """انتظار تا نوشته شدن همه پیام‌های صف"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.flush()
+        self._closed.set()
+        self._writer_thread.join(5)
+        self._reader_executor.shutdown(wait=True)
+
+    # ---------- خواندن ----------
+    def _read(self, func, *args) -> 'asyncio.Future':
+        return asyncio.wrap_future(self._reader_executor.submit(func, *args))
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        if self._reader is None:
+            self._reader = self._connect()
+            self._reader.row_factory = sqlite3.Row
+        return self._reader
+
+    def _scan(self, owner_id: int, before: Optional[int], limit: int, bot: Optional[str],
+              match: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """پیمایش بخش‌ها از جدید به قدیم تا پر شدن صفحه (یک سطر اضافه برای تشخیص صفحه بعد)"""
+        conn = self._reader_conn()
+        with self._partitions_lock:
+            partitions = list(reversed(self._partitions))
+        if before is not None:
+            last = self._partition_of(before)
+            partitions = [p for p in partitions if p <= last]
+
+        rows: List[Dict[str, Any]] = []
+        for partition in partitions:
+            table = f"inbox_{partition}"
+            params: List[Any] = []
+            if match:
+                # پیمایش FTS به ترتیب rowid نزولی تا پر شدن صفحه؛ شرط مالک داخل
+                # خود عبارت MATCH است تا نتایج مالکان دیگر اصلاً خوانده نشوند
+                key = 'f.rowid'
+                sql = (f"SELECT m.id, m.bot, m.sender_id, m.content_type, "
+                       f"snippet({table}_fts, 0, '«', '»', '…', 16) AS body "
+                       f"FROM {table}_fts f JOIN {table} m ON m.id = f.rowid "
+                       f"WHERE {table}_fts MATCH ? AND m.owner_id = ?")
+                params += [f'owner_id : "{int(owner_id)}" AND body : ({match})', owner_id]
+            else:
+                key = 'm.id'
+                sql = f"SELECT id, bot, sender_id, content_type, body FROM {table} m WHERE owner_id = ?"
+                params.append(owner_id)
+            if before is not None:
+                sql += f" AND {key} < ?"
+                params.append(before)
+            if bot:
+                sql += " AND m.bot = ?"
+                params.append(bot)
+            sql += f" ORDER BY {key} DESC LIMIT ?"
+            params.append(limit + 1 - len(rows))
+            try:
+                rows.extend(dict(row) for row in conn.execute(sql, params))
+            except sqlite3.OperationalError as e:
+                # بخش بین فهرست‌گیری و خواندن حذف شده است
+                logger.debug("خواندن بخش %s صندوق پیام ناموفق بود: %s", partition, e)
+            if len(rows) > limit:
+                break
+
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        rows = rows[:limit]
+        for row in rows:
+            row['ts'] = (row['id'] >> 10) / 1000
+        return rows, next_cursor
+
+    def page(self, owner_id: int, before: Optional[int] = None, limit: int = 10,
+             bot: Optional[str] = None) -> 'asyncio.Future':
+        """صفحه‌ای از پیام‌ها از جدید به قدیم: (سطرها، cursor صفحه بعد یا None)"""
+        return self._read(self._scan, owner_id, before, limit, bot, None)
+
+    def search(self, owner_id: int, text: str, before: Optional[int] = None, limit: int = 10,
+               bot: Optional[str] = None) -> 'asyncio.Future':
+        """جستجوی متن و کپشن پیام‌ها با صفحه‌بندی keyset"""
+        match = build_match_query(text)
+        if match is None:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(([], None))
+            return future
+        return self._read(self._scan, owner_id, before, limit, bot, match)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'partitions': len(self._partitions),
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'file_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
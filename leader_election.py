@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+انتخاب رهبر مبتنی بر lease بین چند نمونه اجرا
+
+فقط نمونه‌ای که lease یک شارد را در اختیار دارد، ربات‌های آن شارد را
+poll می‌کند تا تلگرام با خطای 409 Conflict پاسخ ندهد. هر lease یک زمان
+انقضا دارد و دارنده آن را به صورت دوره‌ای تمدید می‌کند؛ اگر نمونه از کار
+بیفتد، lease منقضی شده و نمونه آماده به کار (hot-standby) آن را می‌گیرد.
+در خاموش شدن عادی lease بلافاصله آزاد می‌شود تا جابه‌جایی سریع باشد.
+
+دو backend وجود دارد:
+    FileLeaseBackend   فایل در یک پوشه مشترک با قفل fcntl
+    StoreLeaseBackend  هر StateStore (حافظه، SQLite، Redis) با compare-and-set
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # ویندوز
+    fcntl = None
+
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+NS_LEASES = 'leases'
+
+
+def default_instance_id() -> str:
+    """شناسه پیش‌فرض نمونه: نام میزبان و شماره پروسه"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# ========== backendهای lease ==========
+class LeaseBackend:
+    """رابط نگهداری leaseها"""
+
+    def try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        """گرفتن یا تمدید lease؛ True اگر اکنون در اختیار holder باشد"""
+        raise NotImplementedError
+
+    def release(self, name: str, holder: str):
+        """آزاد کردن lease (فقط اگر در اختیار holder باشد)"""
+        raise NotImplementedError
+
+    def holder(self, name: str) -> Optional[str]:
+        """دارنده فعلی lease (اگر منقضی نشده باشد)"""
+        raise NotImplementedError
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    lease روی فایل در یک پوشه مشترک
+
+    هر lease یک فایل JSON با دارنده و زمان انقضا است و خواندن/نوشتن آن
+    زیر قفل انحصاری fcntl روی یک فایل قفل جداگانه انجام می‌شود.
+    """
+
+    def __init__(self, directory: str):
+        if fcntl is None:
+            raise RuntimeError("FileLeaseBackend به fcntl نیاز دارد")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, name: str):
+        base = os.path.join(self.directory, name)
+        return f"{base}.lease", f"{base}.lock"
+
+    def _locked(self, name: str, update: Callable[[Optional[Dict]], Optional[Dict]]):
+        lease_path, lock_path = self._paths(name)
+        with open(lock_path, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(lease_path, 'r', encoding='utf-8') as f:
+                        current = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    current = None
+
+                new = update(current)
+                if new is not current:
+                    if new is None:
+                        try:
+                            os.remove(lease_path)
+                        except FileNotFoundError:
+                            pass
+                    else:
+                        tmp_path = f"{lease_path}.tmp"
+                        with open(tmp_path, 'w', encoding='utf-8') as f:
+                            json.dump(new, f)
+                        os.replace(tmp_path, lease_path)
+                return new
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+
+        def update(current):
+            if current and current['holder'] != holder and current['expires'] > now:
+                return current
+            return {'holder': holder, 'expires': now + ttl}
+
+        return self._locked(name, update)['holder'] == holder
+
+    def release(self, name: str, holder: str):
+        self._locked(name, lambda current: None if current and current['holder'] == holder else current)
+
+    def holder(self, name: str) -> Optional[str]:
+        current = self._locked(name, lambda current: current)
+        if current and current['expires'] > time.time():
+            return current['holder']
+        return None
+
+
+class StoreLeaseBackend(LeaseBackend):
+    """lease روی یک StateStore با compare-and-set"""
+
+    def __init__(self, store: StateStore):
+        self.store = store
+
+    def try_acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        current_raw = self.store.get_sync(NS_LEASES, name)
+        if current_raw is not None:
+            current = json.loads(current_raw)
+            if current['holder'] != holder and current['expires'] > now:
+                return False
+        new_raw = json.dumps({'holder': holder, 'expires': now + ttl})
+        return self.store.compare_and_set_sync(NS_LEASES, name, current_raw, new_raw)
+
+    def release(self, name: str, holder: str):
+        current_raw = self.store.get_sync(NS_LEASES, name)
+        if current_raw is not None and json.loads(current_raw)['holder'] == holder:
+            self.store.compare_and_set_sync(NS_LEASES, name, current_raw, None)
+
+    def holder(self, name: str) -> Optional[str]:
+        current_raw = self.store.get_sync(NS_LEASES, name)
+        if current_raw is None:
+            return None
+        current = json.loads(current_raw)
+        return current['holder'] if current['expires'] > time.time() else None
+
+
+# ========== مدیر leaseها ==========
+class LeaseManager:
+    """
+    گرفتن و تمدید leaseهای شاردها و lease ربات مادر
+
+    ربات‌ها با crc32(username) % shards به شاردها تقسیم می‌شوند. هر
+    renew_interval ثانیه همه leaseها تلاش برای گرفتن/تمدید می‌شوند و با
+    گرفتن یا از دست دادن هر lease، هوک on_acquire/on_release فراخوانی
+    می‌شود.
+    """
+
+    MASTER = 'master'
+
+    def __init__(self, backend: LeaseBackend, instance_id: Optional[str] = None,
+                 ttl: float = 15.0, renew_interval: Optional[float] = None, shards: int = 1):
+        self.backend = backend
+        self.instance_id = instance_id or default_instance_id()
+        self.ttl = ttl
+        self.renew_interval = renew_interval or ttl / 3
+        self.shards = max(1, shards)
+        self.owned: Set[str] = set()
+        self.on_acquire: Optional[Callable[[str], None]] = None
+        self.on_release: Optional[Callable[[str], None]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def lease_names(self):
+        return [self.MASTER] + [f"shard-{i}" for i in range(self.shards)]
+
+    def shard_of(self, bot_username: str) -> str:
+        """نام lease شارد یک ربات"""
+        return f"shard-{zlib.crc32(bot_username.encode('utf-8')) % self.shards}"
+
+    def owns_bot(self, bot_username: str) -> bool:
+        """آیا این نمونه مسئول polling این ربات است؟"""
+        return self.shard_of(bot_username) in self.owned
+
+    def owns_master(self) -> bool:
+        return self.MASTER in self.owned
+
+    def tick(self):
+        """یک دور گرفتن/تمدید leaseها"""
+        for name in self.lease_names:
+            try:
+                held = self.backend.try_acquire(name, self.instance_id, self.ttl)
+            except Exception as e:
+                logger.warning("خطا در تمدید lease %s: %s", name, e)
+                # اگر تا انقضا نتوانیم تمدید کنیم، باید polling را متوقف کنیم
+                held = False
+
+            if held and name not in self.owned:
+                self.owned.add(name)
+                logger.info("lease %s در اختیار این نمونه (%s) قرار گرفت", name, self.instance_id)
+                if self.on_acquire:
+                    self.on_acquire(name)
+            elif not held and name in self.owned:
+                self.owned.discard(name)
+                logger.warning("lease %s از دست رفت", name)
+                if self.on_release:
+                    self.on_release(name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.renew_interval)
+
+    def start(self):
+        """شروع thread تمدید leaseها (اولین دور همگام اجرا می‌شود)"""
+        self.tick()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="lease_manager")
+        self._thread.start()
+
+    def release_all(self):
+        """آزاد کردن همه leaseها برای جابه‌جایی سریع هنگام خاموش شدن"""
+        self._stop.set()
+        for name in list(self.owned):
+            if self.on_release:
+                self.on_release(name)
+            try:
+                self.backend.release(name, self.instance_id)
+            except Exception as e:
+                logger.warning("خطا در آزاد کردن lease %s: %s", name, e)
+            self.owned.discard(name)
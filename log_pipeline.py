@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+لاگ غیرمسدودکننده و ساخت‌یافته
+
+فراخوانی logger در event loop فقط رکورد را در یک صف محدود قرار می‌دهد؛
+قالب‌بندی پیام و نوشتن روی خروجی در یک thread پس‌زمینه (QueueListener)
+انجام می‌شود. اگر خروجی گیر کند و صف پر شود، رکوردهای جدید دور ریخته و
+شمارش می‌شوند تا حافظه بی‌حد رشد نکند.
+
+شناسه‌های ربات، مالک، فرستنده، آپدیت و پیام با bind_log_context در contextvar نگه داشته
+می‌شوند و به هر رکورد در همان task اضافه می‌شوند. رویدادهای پرحجم info
+با extra={'sample': '<نام رویداد>'} فقط با نرخ LOG_SAMPLE_RATE ثبت می‌شوند.
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Dict, Optional
+
+# شناسه‌های زمینه (bot/owner/update) برای task فعلی
+_log_context: contextvars.ContextVar = contextvars.ContextVar('log_context', default=None)
+
+CONTEXT_FIELDS = ('bot', 'owner', 'user', 'update', 'message')
+
+# کتابخانه‌هایی که هنگام import روی logger خودشان handler مستقیم stderr می‌گذارند
+LIBRARY_LOGGERS = ('TeleBot',)
+
+
+def bind_log_context(**fields) -> contextvars.Token:
+    """افزودن شناسه‌ها به زمینه لاگ task فعلی (برگشت با reset_log_context)"""
+    current = _log_context.get()
+    merged = dict(current) if current else {}
+    merged.update((k, v) for k, v in fields.items() if v is not None)
+    return _log_context.set(merged)
+
+
+def reset_log_context(token: contextvars.Token):
+    _log_context.reset(token)
+
+
+# ========== فیلترها ==========
+class ContextFilter(logging.Filter):
+    """کپی شناسه‌های زمینه روی رکورد (در thread فراخوان اجرا می‌شود)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _log_context.get()
+        if context:
+            for key, value in context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    نمونه‌برداری رویدادهای پرحجم
+
+    رکوردهای سطح INFO و پایین‌تر که ویژگی sample دارند، برای هر کلید فقط
+    یک مورد از هر round(1 / rate) ثبت می‌شوند. هشدارها و خطاها همیشه ثبت
+    می‌شوند.
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._counters: Dict[str, int] = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample', None)
+        if key is None or record.levelno > logging.INFO:
+            return True
+        if not self.every:
+            self.sampled_out += 1
+            return False
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        if count % self.every:
+            self.sampled_out += 1
+            return False
+        record.sample_rate = 1 / self.every
+        return True
+
+
+# ========== صف محدود ==========
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler با صف محدود و بدون قالب‌بندی در thread فراخوان
+
+    QueueHandler استاندارد پیام را پیش از قرار دادن در صف قالب‌بندی می‌کند؛
+    اینجا رکورد همان‌طور که هست در صف قرار می‌گیرد و قالب‌بندی در thread
+    پس‌زمینه انجام می‌شود.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# ========== قالب JSON ==========
+class JsonFormatter(logging.Formatter):
+    """یک شیء JSON در هر خط با شناسه‌های زمینه"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        sample = getattr(record, 'sample', None)
+        if sample is not None:
+            entry['event'] = sample
+            entry['sample_rate'] = getattr(record, 'sample_rate', 1.0)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _Pipeline:
+    def __init__(self, handler: BoundedQueueHandler, sampler: SamplingFilter,
+                 listener: logging.handlers.QueueListener):
+        self.handler = handler
+        self.sampler = sampler
+        self.listener = listener
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.handler.queue.qsize(),
+            'capacity': self.handler.queue.maxsize,
+            'dropped': self.handler.dropped,
+            'sampled_out': self.sampler.sampled_out,
+        }
+
+
+_pipeline: Optional[_Pipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def setup_logging(level: str = 'INFO', fmt: str = 'json', queue_size: int = 10000,
+                  sample_rate: float = 1.0, stream=None) -> _Pipeline:
+    """
+    جایگزینی handlerهای ریشه با صف محدود و شروع thread نوشتن
+
+    Args:
+        fmt: 'json' برای خروجی ساخت‌یافته یا 'text' برای قالب قبلی
+        sample_rate: نرخ نگهداری رویدادهای info دارای ویژگی sample
+    """
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline:
+            return _pipeline
+
+        sink = logging.StreamHandler(stream or sys.stderr)
+        if fmt == 'json':
+            sink.setFormatter(JsonFormatter())
+        else:
+            sink.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+        handler = BoundedQueueHandler(queue_size)
+        sampler = SamplingFilter(sample_rate)
+        handler.addFilter(sampler)
+        handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level.upper())
+        # رکوردهای این کتابخانه‌ها فقط از مسیر ریشه (صف) عبور کنند، نه دوبار و مسدودکننده
+        for name in LIBRARY_LOGGERS:
+            library = logging.getLogger(name)
+            for existing in list(library.handlers):
+                library.removeHandler(existing)
+            library.propagate = True
+
+        listener = logging.handlers.QueueListener(handler.queue, sink, respect_handler_level=True)
+        listener.start()
+        _pipeline = _Pipeline(handler, sampler, listener)
+        return _pipeline
+
+
+def log_stats() -> Optional[Dict]:
+    """آمار صف لاگ (None اگر pipeline راه‌اندازی نشده باشد)"""
+    return _pipeline.stats() if _pipeline else None
+
+
+def shutdown_logging():
+    """تخلیه صف و توقف thread نوشتن"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline:
+            _pipeline.listener.stop()
+            _pipeline = None
@@ -5,34 +5,48 @@
 """
 
 import os
+import sys
+import signal
 import json
+import hmac
+import html
 import logging
 import asyncio
 import threading
+import concurrent.futures
 import time
+import zlib
+from collections import deque, OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Any, Set
+from typing import Dict, List, Optional, Tuple, Any, Set, Callable
 
-from flask import Flask, request, jsonify
+import aiohttp
 import telebot
 from telebot import types
 from telebot.async_telebot import AsyncTeleBot
-import aiohttp
 
-# تنظیمات لاگ
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from state_store import StateStore, create_state_store, NS_BOTS
+from leader_election import LeaseManager, FileLeaseBackend, StoreLeaseBackend
+from diagnostics import LoopMonitor, MemoryTracker, approx_size, process_memory, sample_profile
+from analytics import AnalyticsStore, sparkline
+from blocklist import Blocklist, GLOBAL_SCOPE
+from inbox import InboxStore
+from dedup import DuplicateIndex, DuplicateEntry, Fingerprint
+from admission import AdmissionController, MASTER_KEY
+from bulk_import import BulkImporter, parse_entries
+from log_pipeline import setup_logging, shutdown_logging, log_stats, bind_log_context, reset_log_context
+
+# تنظیمات لاگ (صف پس‌زمینه در main با setup_logging راه‌اندازی می‌شود)
 logger = logging.getLogger(__name__)
 
 # ========== کلاس مدیریت مرحله‌ها ==========
 class StepHandlerManager:
     """مدیریت مراحل ثبت‌نام و تعاملات چند مرحله‌ای"""
     
-    def __init__(self):
+    def __init__(self, store: Optional[StateStore] = None):
         self.user_steps: Dict[int, Dict] = {}
         self.user_data: Dict[int, Dict] = {}
+        self.store = store
     
     def set_step(self, user_id: int, step: str, data: Dict = None):
         """تنظیم مرحله کاربر"""
@@ -45,6 +59,9 @@ class StepHandlerManager:
             if user_id not in self.user_data:
                 self.user_data[user_id] = {}
             self.user_data[user_id].update(data)
+        
+        if self.store:
+            self.store.save_step(user_id, step, self.user_data.get(user_id))
     
     def get_step(self, user_id: int) -> Optional[str]:
         """دریافت مرحله فعلی کاربر"""
@@ -66,147 +83,1916 @@ class StepHandlerManager:
             del self.user_steps[user_id]
         if user_id in self.user_data:
             del self.user_data[user_id]
+        
+        if self.store:
+            self.store.save_step(user_id, None)
+    
+    def restore(self, steps: Dict[int, Dict[str, Any]]):
+        """بازگردانی مراحل ذخیره شده"""
+        for user_id, entry in steps.items():
+            self.user_steps[user_id] = {'current_step': entry['step']}
+            if entry.get('data'):
+                self.user_data[user_id] = dict(entry['data'])
+
+
+# ========== نشست HTTP هر event loop ==========
+class LoopSessionManager(telebot.asyncio_helper.SessionManager):
+    """
+    یک نشست aiohttp برای هر event loop
+    
+    SessionManager پیش‌فرض telebot یک نشست سراسری دارد که به loop سازنده
+    خود وابسته است، اما ربات مادر و هر ربات فرزند loop جداگانه‌ای در thread
+    خود دارند. close_session کلاینت‌ها (AdmittedTeleBot) فقط نشست loop
+    خودشان را می‌بندد. نشست هر loop هنگام پایان thread ربات بسته می‌شود و نشست
+    loopهای بسته شده در فراخوانی بعدی کنار گذاشته می‌شود تا با خواب و
+    بیدار شدن ربات‌ها انباشته نشود.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._sessions: Dict[asyncio.AbstractEventLoop, Any] = {}
+        self._lock = threading.Lock()
+    
+    async def create_session(self):
+        # برخلاف نسخه پایه self.session سراسری تنظیم نمی‌شود تا close_session
+        # پیش‌فرض telebot نشست loop دیگری را نبندد
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=telebot.asyncio_helper.REQUEST_LIMIT,
+            ssl_context=self.ssl_context
+        ))
+    
+    async def get_session(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for stale in [other for other in self._sessions if other.is_closed()]:
+                del self._sessions[stale]
+            session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = await self.create_session()
+            with self._lock:
+                self._sessions[loop] = session
+        return session
+    
+    async def close_loop_session(self):
+        """بستن نشست loop جاری (پیش از بسته شدن loop)"""
+        with self._lock:
+            session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+    
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+def close_loop_session(loop: asyncio.AbstractEventLoop):
+    """بستن نشست HTTP یک loop متوقف شده پیش از loop.close"""
+    manager = telebot.asyncio_helper.session_manager
+    if isinstance(manager, LoopSessionManager):
+        try:
+            loop.run_until_complete(manager.close_loop_session())
+        except Exception as e:
+            logger.debug("بستن نشست HTTP loop ناموفق بود: %s", e)
+
+
+def install_session_manager() -> LoopSessionManager:
+    """جایگزینی SessionManager سراسری telebot (یک بار برای فرآیند)"""
+    manager = telebot.asyncio_helper.session_manager
+    if not isinstance(manager, LoopSessionManager):
+        manager = telebot.asyncio_helper.session_manager = LoopSessionManager()
+    return manager
+
+
+# ========== کلاینت تلگرام با کنترل پذیرش ==========
+class AdmittedTeleBot(AsyncTeleBot):
+    """
+    AsyncTeleBot با کنترل پذیرش ورودی
+    
+    polling پیش از هر getUpdates منتظر ظرفیت آزاد ربات می‌ماند، اندازه
+    دسته را به همان ظرفیت محدود می‌کند و دسته دریافتی را بلافاصله در
+    جریان ثبت می‌کند (پیش از آنکه task پردازش آن اجرا شود). آپدیت‌های
+    webhook پیش از ارسال به loop در مسیر HTTP پذیرفته می‌شوند؛ پس
+    process_new_updates فقط ظرفیت را آزاد می‌کند.
+    
+    update_id هر آپدیت دریافتی تا پایان پردازش همان آپدیت نگه داشته می‌شود
+    (آپدیت‌های یک دسته جداگانه و همزمان پردازش می‌شوند) تا هنگام خاموشی
+    offset امن، یعنی اولین آپدیت پردازش‌نشده، معلوم باشد. تحویل «حداقل یک
+    بار» است: آپدیت‌هایی که پس از اولین آپدیت لغو شده تمام شده‌اند در
+    اجرای بعدی دوباره دریافت می‌شوند.
+    """
+    
+    def __init__(self, token: str, admission: Optional[AdmissionController] = None,
+                 ingress_key: str = MASTER_KEY, **kwargs):
+        super().__init__(token, **kwargs)
+        self.admission = admission
+        self.ingress_key = ingress_key
+        self._unfinished: Set[int] = set()
+    
+    async def get_updates(self, *args, **kwargs):
+        if self.admission is not None:
+            kwargs['limit'] = min(100, await self.admission.wait_to_fetch(self.ingress_key))
+        updates = await super().get_updates(*args, **kwargs)
+        if updates:
+            self._unfinished.update(update.update_id for update in updates)
+            if self.admission is not None:
+                self.admission.acquire(self.ingress_key, len(updates))
+        return updates
+    
+    async def process_new_updates(self, updates):
+        if len(updates) <= 1:
+            return await self._process_update(updates)
+        await asyncio.gather(*(self._process_update([update]) for update in updates))
+    
+    async def _process_update(self, updates):
+        cancelled = False
+        try:
+            await super().process_new_updates(updates)
+        except asyncio.CancelledError:
+            # پردازش ناتمام ماند: آپدیت در offset امن باقی می‌ماند
+            cancelled = True
+            raise
+        finally:
+            if updates:
+                if self.admission is not None:
+                    self.admission.release(self.ingress_key, len(updates))
+                if not cancelled:
+                    self._unfinished.discard(updates[0].update_id)
+    
+    async def close_session(self):
+        """بستن نشست HTTP همین loop (نه نشست سراسری telebot)"""
+        manager = telebot.asyncio_helper.session_manager
+        if isinstance(manager, LoopSessionManager):
+            await manager.close_loop_session()
+        else:
+            await super().close_session()
+    
+    def pending_offset(self) -> int:
+        """اولین update_id پردازش‌نشده (offset ادامه در نمونه بعدی)"""
+        return min(self._unfinished, default=self.offset)
+    
+    async def commit_offset(self) -> int:
+        """تایید آپدیت‌های پردازش‌شده نزد تلگرام (getUpdates بدون انتظار)"""
+        offset = self.pending_offset()
+        if offset:
+            await telebot.asyncio_helper.get_updates(self.token, offset, 1, 0)
+        return offset
+
+
+# ========== کلاس رکورد ربات ==========
+class BotRecord:
+    """
+    رکورد فشرده یک ربات فرزند
+    
+    به جای dict از __slots__ استفاده می‌شود تا حافظه هر ربات ثبت‌شده کم
+    بماند: زمان ایجاد به صورت عدد صحیح (epoch) نگه داشته می‌شود، username
+    intern می‌شود و کلاینت AsyncTeleBot فقط وقتی ربات فعال است متصل است
+    (برای ربات‌های خوابیده None است).
+    
+    owner_via_child مشخص می‌کند اعلان‌ها از طریق خود ربات فرزند به مالک
+    می‌رسند یا نه: None یعنی هنوز امتحان نشده، False یعنی مالک ربات را
+    start نکرده است.
+    """
+    
+    __slots__ = ('username', 'owner_id', 'token', 'bot_id', 'created_at',
+                 'active', 'digest_enabled', 'offset', 'owner_via_child', 'client')
+    
+    def __init__(self, username: str, owner_id: int, token: str, bot_id: int = 0,
+                 created_at: Optional[int] = None, active: bool = True,
+                 digest_enabled: bool = False, offset: int = 0,
+                 owner_via_child: Optional[bool] = None,
+                 client: Optional[AsyncTeleBot] = None):
+        self.username = sys.intern(username)
+        self.owner_id = owner_id
+        self.token = token
+        self.bot_id = bot_id
+        self.created_at = int(time.time()) if created_at is None else int(created_at)
+        self.active = active
+        self.digest_enabled = digest_enabled
+        self.offset = offset
+        self.owner_via_child = owner_via_child
+        self.client = client
+    
+    @property
+    def display_token(self) -> str:
+        """بخش قابل نمایش توکن"""
+        return self.token[:10] + '...'
+    
+    @property
+    def created_at_text(self) -> str:
+        """زمان ایجاد به صورت متن قابل نمایش"""
+        return datetime.fromtimestamp(self.created_at).strftime('%Y/%m/%d %H:%M')
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """تبدیل به dict قابل ذخیره (بدون کلاینت)"""
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != 'client'}
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'BotRecord':
+        """ساخت رکورد از dict ذخیره شده"""
+        return cls(**{k: v for k, v in data.items() if k in cls.__slots__ and k != 'client'})
+    
+    def __repr__(self):
+        return f"BotRecord(@{self.username}, owner={self.owner_id})"
 
 
 # ========== کلاس مدیریت ربات‌های فرزند ==========
 class ChildBotManager:
-    """مدیریت polling ربات‌های فرزند"""
+    """
+    مدیریت polling ربات‌های فرزند
     
-    def __init__(self):
-        self.child_bots: Dict[str, Dict] = {}  # username -> bot_data
+    ربات‌هایی که مدت idle_threshold ثانیه پیامی دریافت نکرده‌اند به خواب
+    می‌روند: polling آن‌ها متوقف، کلاینت AsyncTeleBot و هندلرهایشان آزاد و
+    offset آخرین آپدیت در bot_data ذخیره می‌شود. یک thread مشترک به صورت
+    دوره‌ای با یک getUpdates ارزان (بدون long-poll و بدون تایید آپدیت‌ها)
+    ربات‌های خوابیده را بررسی می‌کند؛ فاصله بررسی با هر بررسی خالی دو برابر
+    می‌شود (تا poll_max_interval). با رسیدن اولین آپدیت جدید، کلاینت دوباره
+    ساخته شده و polling از همان offset ادامه پیدا می‌کند.
+    """
+    
+    def __init__(self, idle_threshold: float = 1800, poll_min_interval: float = 30,
+                 poll_max_interval: float = 300, store: Optional[StateStore] = None,
+                 probe_concurrency: int = 20):
+        self.child_bots: Dict[str, BotRecord] = {}  # username -> bot_data
         self.polling_tasks: Dict[str, threading.Thread] = {}
         self.polling_active: Dict[str, bool] = {}
+        
+        # loop و task polling هر ربات برای توقف واقعی
+        self.polling_loops: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Task]] = {}
+        
+        # خواب ربات‌های بی‌فعالیت
+        self.idle_threshold = idle_threshold
+        self.poll_min_interval = poll_min_interval
+        self.poll_max_interval = poll_max_interval
+        self.probe_concurrency = max(1, probe_concurrency)
+        self.last_activity: Dict[str, float] = {}
+        self.hibernated: Dict[str, Dict[str, float]] = {}  # username -> {'interval', 'next_check'}
+        self.client_factory: Optional[Callable[[BotRecord], Any]] = None
+        self.store = store
+        
+        # آیا این نمونه مجاز به polling این ربات است؟ (انتخاب رهبر)
+        self.poll_gate: Optional[Callable[[str], bool]] = None
+        
+        # پایش تاخیر loop هر ربات
+        self.loop_monitor: Optional[LoopMonitor] = None
+        self._lock = threading.RLock()
+        self._hibernation_thread: Optional[threading.Thread] = None
+        self._saved_offsets: Dict[str, int] = {}  # آخرین offset ثبت شده هر ربات
+        
+        # خاموشی: کارهای در جریان هر loop تا drain_deadline (یا task_grace
+        # ثانیه برای خواب و توقف عادی) فرصت پایان دارند
+        self.draining = False
+        self.drain_deadline: Optional[float] = None
+        self.drain_hook: Optional[Callable[[BotRecord], Any]] = None
+        self.task_grace = 10.0
     
-    def add_bot(self, bot_data: Dict):
-        """افزودن ربات فرزند"""
-        username = bot_data['username']
-        self.child_bots[username] = bot_data
-        self.polling_active[username] = True
+    def add_bot(self, bot_data: BotRecord, fresh: bool = True):
+        """
+        افزودن ربات فرزند
         
-        # شروع polling در thread جداگانه
-        thread = threading.Thread(
-            target=self._start_bot_polling,
-            args=(bot_data,),
-            daemon=True,
-            name=f"bot_{username}"
-        )
-        self.polling_tasks[username] = thread
-        thread.start()
+        Args:
+            fresh: ربات تازه ثبت شده است (حذف webhook و رد کردن آپدیت‌های
+                قدیمی)؛ برای بیدار کردن ربات خوابیده False است.
+        """
+        username = bot_data.username
+        with self._lock:
+            self.child_bots[username] = bot_data
+            self.last_activity[username] = time.monotonic()
+            
+            if self.draining:
+                return
+            
+            if self.poll_gate and not self.poll_gate(username):
+                # lease شارد این ربات در اختیار نمونه دیگری است
+                logger.info("ربات فرزند @%s ثبت شد (polling توسط نمونه دیگر)", username)
+                return
+            
+            self.polling_active[username] = True
+            
+            # شروع polling در thread جداگانه
+            thread = threading.Thread(
+                target=self._start_bot_polling,
+                args=(bot_data, fresh),
+                daemon=True,
+                name=f"bot_{username}"
+            )
+            self.polling_tasks[username] = thread
+            thread.start()
+        
+        self._ensure_hibernation_thread()
+        logger.info("ربات فرزند @%s اضافه شد و polling شروع شد", username)
+    
+    def add_hibernated(self, bot_data: BotRecord):
+        """
+        ثبت ربات بدون thread polling (ورود دسته‌ای)
+        
+        ربات مانند ربات خوابیده ثبت می‌شود و با اولین آپدیت توسط thread
+        خواب بیدار می‌شود؛ اگر خواب غیرفعال باشد polling عادی شروع می‌شود.
+        """
+        if self.idle_threshold <= 0:
+            self.add_bot(bot_data, fresh=False)
+            return
         
-        logger.info(f"ربات فرزند @{username} اضافه شد و polling شروع شد")
+        username = bot_data.username
+        with self._lock:
+            self.child_bots[username] = bot_data
+            self.last_activity[username] = time.monotonic()
+            self.hibernated[username] = {
+                'interval': self.poll_min_interval,
+                'next_check': time.monotonic() + self.poll_min_interval
+            }
+        self._ensure_hibernation_thread()
     
-    def _start_bot_polling(self, bot_data: Dict):
+    def _start_bot_polling(self, bot_data: BotRecord, fresh: bool = True):
         """شروع polling برای یک ربات فرزند"""
-        bot = bot_data['bot_instance']
-        username = bot_data['username']
+        username = bot_data.username
         
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        if self.loop_monitor:
+            self.loop_monitor.register(loop, f"bot_{username}")
         
         try:
-            # حذف webhook قبلی (اگر وجود دارد)
-            loop.run_until_complete(bot.remove_webhook())
+            # ساخت مجدد کلاینت ربات خوابیده
+            if bot_data.client is None and self.client_factory:
+                loop.run_until_complete(self.client_factory(bot_data))
+            bot = bot_data.client
+            
+            if fresh:
+                # حذف webhook قبلی (اگر وجود دارد)
+                loop.run_until_complete(bot.remove_webhook())
             
-            logger.info(f"شروع polling برای ربات @{username}")
+            logger.info("شروع polling برای ربات @%s", username)
             
             # شروع polling
-            loop.run_until_complete(bot.polling(
+            task = loop.create_task(bot.polling(
                 non_stop=True,
                 timeout=60,
-                skip_pending=True
+                skip_pending=fresh
             ))
+            self.polling_loops[username] = (loop, task)
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error("خطا در polling ربات @%s: %s", username, e)
+        finally:
+            # نمونه‌بردار LoopMonitor پیش از انتظار برای کارهای باقی‌مانده متوقف می‌شود
+            if self.loop_monitor:
+                self.loop_monitor.unregister(loop)
+            self._finish_loop(loop, bot_data)
+            close_loop_session(loop)
+            current = self.polling_loops.get(username)
+            if current and current[0] is loop:
+                del self.polling_loops[username]
+            loop.close()
+    
+    def _finish_loop(self, loop: asyncio.AbstractEventLoop, bot_data: BotRecord):
+        """
+        پایان کارهای در جریان loop ربات پیش از بستن آن
+        
+        آپدیت‌های دریافت‌شده، آلبوم‌ها و ارسال‌های صف تا مهلت تمام می‌شوند و
+        بقیه لغو می‌شوند. هنگام خاموشی offset امن نزد تلگرام تایید می‌شود.
+        """
+        try:
+            if self.draining and self.drain_hook:
+                loop.run_until_complete(self.drain_hook(bot_data))
+            
+            pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+            if pending:
+                grace = (self.task_grace if self.drain_deadline is None
+                         else max(0.0, self.drain_deadline - time.monotonic()))
+                _, late = loop.run_until_complete(asyncio.wait(pending, timeout=grace))
+                if late:
+                    logger.warning("%s کار ربات @%s در مهلت تمام نشد و لغو شد", len(late), bot_data.username)
+                    for task in late:
+                        task.cancel()
+                    loop.run_until_complete(asyncio.gather(*late, return_exceptions=True))
+            
+            client = bot_data.client
+            if self.draining and client is not None:
+                bot_data.offset = client.pending_offset()
+                loop.run_until_complete(client.commit_offset())
+        except Exception as e:
+            logger.warning("خطا در پایان کارهای ربات @%s: %s", bot_data.username, e)
+    
+    def _stop_polling(self, username: str, wait: float = 0) -> Optional[threading.Thread]:
+        """لغو task polling یک ربات و (در صورت نیاز) انتظار برای پایان thread"""
+        entry = self.polling_loops.get(username)
+        if entry:
+            loop, task = entry
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass
+        
+        thread = self.polling_tasks.get(username)
+        if thread and wait:
+            thread.join(wait)
+        return thread
+    
+    def is_polling(self, username: str) -> bool:
+        """آیا thread polling این ربات در حال اجراست؟"""
+        thread = self.polling_tasks.get(username)
+        return bool(thread and thread.is_alive())
+    
+    def start_polling_where(self, predicate: Callable[[str], bool]):
+        """شروع polling ربات‌هایی که predicate برایشان True است (با گرفتن lease)"""
+        for username, bot_data in list(self.child_bots.items()):
+            if predicate(username) and not self.is_polling(username):
+                self.hibernated.pop(username, None)
+                self.add_bot(bot_data, fresh=False)
+    
+    def stop_polling_where(self, predicate: Callable[[str], bool]):
+        """توقف polling و ذخیره offset ربات‌هایی که predicate برایشان True است"""
+        stopped = []
+        for username in list(self.polling_tasks.keys()):
+            if predicate(username):
+                self.polling_active[username] = False
+                self._stop_polling(username)
+                stopped.append(username)
+        
+        for username in stopped:
+            thread = self.polling_tasks.pop(username, None)
+            if thread:
+                thread.join(10)
+            bot_data = self.child_bots.get(username)
+            if bot_data and bot_data.client is not None:
+                bot_data.offset = bot_data.client.pending_offset()
+                if self.store:
+                    self.store.save_offset(username, bot_data.offset)
+        
+        if stopped and self.store:
+            self.store.flush_pending()
+        return stopped
+    
+    def touch(self, username: str):
+        """ثبت فعالیت ربات (برای جلوگیری از خواب)"""
+        self.last_activity[username] = time.monotonic()
+    
+    def hibernate(self, username: str) -> bool:
+        """به خواب بردن ربات بی‌فعالیت و آزاد کردن کلاینت آن"""
+        with self._lock:
+            bot_data = self.child_bots.get(username)
+            if not bot_data or username in self.hibernated:
+                return False
+            self.polling_active[username] = False
+        
+        thread = self._stop_polling(username, wait=10)
+        if thread and thread.is_alive():
+            logger.warning("توقف polling ربات @%s برای خواب ممکن نشد", username)
+            self.polling_active[username] = True
+            return False
+        
+        with self._lock:
+            bot = bot_data.client
+            if bot is not None:
+                bot_data.offset = bot.pending_offset()
+                if self.store:
+                    self.store.save_offset(username, bot_data.offset)
+            bot_data.client = None
+            self.polling_tasks.pop(username, None)
+            self.hibernated[username] = {
+                'interval': self.poll_min_interval,
+                'next_check': time.monotonic() + self.poll_min_interval
+            }
+        
+        logger.info("ربات @%s به دلیل عدم فعالیت به خواب رفت", username)
+        return True
+    
+    def wake(self, username: str):
+        """بیدار کردن ربات خوابیده و ادامه polling از offset ذخیره شده"""
+        with self._lock:
+            if self.hibernated.pop(username, None) is None:
+                return
+            bot_data = self.child_bots.get(username)
+        
+        if bot_data:
+            logger.info("بیدار شدن ربات @%s", username)
+            self.add_bot(bot_data, fresh=False)
+    
+    async def _has_pending_updates(self, bot_data: BotRecord) -> bool:
+        """بررسی ارزان وجود آپدیت جدید بدون تایید آن"""
+        try:
+            # بدون پارامتر timeout تلگرام فوراً پاسخ می‌دهد (long polling نیست)؛
+            # apihelper همگام timeout=0 را نادیده می‌گیرد و 10 ثانیه منتظر می‌ماند
+            updates = await telebot.asyncio_helper.get_updates(
+                bot_data.token,
+                offset=bot_data.offset,
+                limit=1,
+                request_timeout=10
+            )
+            return bool(updates)
         except Exception as e:
-            logger.error(f"خطا در polling ربات @{username}: {e}")
+            logger.warning("خطا در بررسی آپدیت ربات خوابیده @%s: %s", bot_data.username, e)
+            return False
+    
+    async def _probe_hibernated(self, bots: List[BotRecord]) -> List[bool]:
+        """بررسی همزمان ربات‌های خوابیده با حداکثر probe_concurrency درخواست"""
+        semaphore = asyncio.Semaphore(self.probe_concurrency)
+        
+        async def probe(bot_data: BotRecord) -> bool:
+            async with semaphore:
+                return await self._has_pending_updates(bot_data)
+        
+        return await asyncio.gather(*(probe(bot_data) for bot_data in bots))
+    
+    def _ensure_hibernation_thread(self):
+        if self.idle_threshold <= 0:
+            return
+        with self._lock:
+            if self._hibernation_thread is None or not self._hibernation_thread.is_alive():
+                self._hibernation_thread = threading.Thread(
+                    target=self._hibernation_loop,
+                    daemon=True,
+                    name="child_hibernation"
+                )
+                self._hibernation_thread.start()
+    
+    def _hibernation_loop(self):
+        """به خواب بردن ربات‌های بی‌فعالیت و بررسی تطبیقی ربات‌های خوابیده"""
+        check_every = min(10.0, self.poll_min_interval)
+        # loop اختصاصی این thread برای بررسی همزمان ربات‌های خوابیده
+        loop = asyncio.new_event_loop()
+        try:
+            while not self.draining:
+                time.sleep(check_every)
+                self._hibernation_sweep(loop)
         finally:
+            close_loop_session(loop)
             loop.close()
     
+    def checkpoint_offsets(self):
+        """
+        ثبت دوره‌ای offset ربات‌های در حال polling (در صورت تغییر)
+        
+        فقط pending_offset ذخیره می‌شود، یعنی اولین آپدیت پردازش‌نشده؛ پس
+        از خرابی، آپدیت‌های در جریان دوباره دریافت می‌شوند (حداقل یک بار).
+        """
+        if not self.store:
+            return
+        for username, bot_data in list(self.child_bots.items()):
+            client = bot_data.client
+            if client is None or not isinstance(client, AdmittedTeleBot):
+                continue
+            try:
+                offset = client.pending_offset()
+            except RuntimeError:
+                # مجموعه آپدیت‌های در جریان همزمان در loop ربات تغییر کرد؛ دور بعد
+                continue
+            if offset and self._saved_offsets.get(username) != offset and username in self.child_bots:
+                self._saved_offsets[username] = offset
+                self.store.save_offset(username, offset)
+    
+    def _hibernation_sweep(self, loop: asyncio.AbstractEventLoop):
+        """یک دور: ثبت offsetها، خواباندن ربات‌های بی‌فعالیت و بررسی ربات‌های خوابیده سررسید"""
+        self.checkpoint_offsets()
+        now = time.monotonic()
+            
+        for username in list(self.child_bots.keys()):
+            if username in self.hibernated or not self.is_polling(username):
+                continue
+            if now - self.last_activity.get(username, now) > self.idle_threshold:
+                self.hibernate(username)
+        
+        due = []
+        for username, state in list(self.hibernated.items()):
+            if now < state['next_check']:
+                continue
+            bot_data = self.child_bots.get(username)
+            if bot_data is None:
+                self.hibernated.pop(username, None)
+                continue
+            if self.poll_gate and not self.poll_gate(username):
+                continue
+            due.append(bot_data)
+        if not due:
+            return
+        
+        pending = loop.run_until_complete(self._probe_hibernated(due))
+        for bot_data, has_updates in zip(due, pending):
+            state = self.hibernated.get(bot_data.username)
+            if state is None:
+                continue
+            if has_updates:
+                self.wake(bot_data.username)
+            else:
+                state['interval'] = min(self.poll_max_interval, state['interval'] * 2)
+                state['next_check'] = time.monotonic() + state['interval']
+    
     def remove_bot(self, username: str):
         """حذف ربات فرزند"""
         if username in self.polling_active:
             self.polling_active[username] = False
         
+        self._stop_polling(username)
+        self.hibernated.pop(username, None)
+        self.last_activity.pop(username, None)
+        self._saved_offsets.pop(username, None)
+        
         if username in self.child_bots:
             del self.child_bots[username]
         
-        if username in self.polling_tasks:
-            # صبر کردن برای پایان thread (اختیاری)
-            time.sleep(1)
-            # thread به صورت daemon است، پس خودش بسته می‌شود
+        # thread با لغو task polling خودش پایان می‌یابد؛ انتظار برای آن
+        # در این متد (که از داخل هندلرهای async صدا زده می‌شود) loop را مسدود می‌کند
+        self.polling_tasks.pop(username, None)
         
-        logger.info(f"ربات فرزند @{username} حذف شد")
+        logger.info("ربات فرزند @%s حذف شد", username)
     
-    def get_bot(self, username: str) -> Optional[Dict]:
+    def get_bot(self, username: str) -> Optional[BotRecord]:
         """دریافت اطلاعات ربات فرزند"""
         return self.child_bots.get(username)
     
-    def stop_all(self):
-        """توقف تمام ربات‌های فرزند"""
-        for username in list(self.polling_active.keys()):
+    def stop_all(self, deadline: float) -> int:
+        """
+        توقف دریافت آپدیت همه ربات‌های فرزند برای خاموشی
+        
+        polling همه ربات‌ها همزمان لغو می‌شود؛ هر thread کارهای در جریان
+        loop خود را تا deadline (زمان monotonic) تمام و offset امن را تایید
+        می‌کند و offsetها در ذخیره‌سازی نوشته می‌شوند.
+        
+        Returns:
+            تعداد ربات‌هایی که تا مهلت متوقف نشدند
+        """
+        with self._lock:
+            self.draining = True
+            self.drain_deadline = deadline
+            usernames = list(self.polling_tasks.keys())
+        
+        for username in usernames:
             self.polling_active[username] = False
+            self._stop_polling(username)
         
-        logger.info("تمام ربات‌های فرزند متوقف شدند")
+        stuck = 0
+        for username in usernames:
+            thread = self.polling_tasks.get(username)
+            if thread:
+                thread.join(max(0.0, deadline - time.monotonic()) + 1)
+                stuck += thread.is_alive()
+            bot_data = self.child_bots.get(username)
+            if bot_data and self.store:
+                self.store.save_offset(username, bot_data.offset)
+        
+        if self.store:
+            self.store.flush_pending()
+        logger.info("polling %s ربات فرزند متوقف شد", len(usernames) - stuck)
+        return stuck
 
 
-# ========== کلاس اصلی ربات مادر ==========
-class AnonymousChatBot:
-    def __init__(self, token: str, webhook_url: str = None, port: int = 10000):
+# ========== کلاس محدودکننده نرخ ارسال ==========
+class OutboundRateLimiter:
+    """
+    محدودکننده نرخ ارسال پیام‌ها (token bucket)
+    
+    برای هر توکن یک سطل سراسری (حدود ۳۰ پیام در ثانیه) و برای هر چت
+    یک سطل جداگانه (حدود ۱ پیام در ثانیه با امکان burst) نگه داشته می‌شود.
+    چون ربات‌های فرزند هر کدام event loop و thread خودشان را دارند،
+    محاسبه زمان انتظار زیر یک قفل threading انجام می‌شود و انتظار واقعی
+    با asyncio.sleep در loop فراخواننده است.
+    """
+    
+    def __init__(self, token_rate: float = 30.0, chat_rate: float = 1.0,
+                 chat_burst: int = 3, max_chat_buckets: int = 10000):
+        self.token_rate = token_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chat_buckets = max_chat_buckets
+        self._lock = threading.Lock()
+        # کلید -> (تعداد توکن‌های باقیمانده, زمان آخرین به‌روزرسانی)
+        self._token_buckets: Dict[str, List[float]] = {}
+        self._chat_buckets: Dict[Tuple[str, int], List[float]] = {}
+    
+    @staticmethod
+    def _reserve(bucket: List[float], rate: float, capacity: float, now: float) -> float:
+        """رزرو یک واحد از سطل و برگرداندن زمان انتظار لازم"""
+        tokens, last = bucket
+        tokens = min(capacity, tokens + (now - last) * rate)
+        tokens -= 1
+        bucket[0] = tokens
+        bucket[1] = now
+        return 0.0 if tokens >= 0 else -tokens / rate
+    
+    def reserve(self, token: str, chat_id: Optional[int] = None, per_token: bool = True) -> float:
         """
-        مقداردهی اولیه ربات مادر
+        رزرو ظرفیت ارسال و محاسبه زمان انتظار (بدون انتظار)
         
         Args:
-            token: توکن ربات مادر
-            webhook_url: آدرس وب هوک
-            port: پورت برای اجرای سرور
+            per_token: اعمال سطل سراسری توکن؛ برای ربات مادر که نرخ کلی
+                آن توسط FairScheduler کنترل می‌شود False است.
         """
-        self.master_token = token
-        self.bot = AsyncTeleBot(token)
-        self.webhook_url = webhook_url
-        self.port = port
+        now = time.monotonic()
+        key = token[:16]
+        with self._lock:
+            wait = 0.0
+            if per_token:
+                bucket = self._token_buckets.setdefault(key, [self.token_rate, now])
+                wait = self._reserve(bucket, self.token_rate, self.token_rate, now)
+            
+            if chat_id is not None:
+                chat_key = (key, chat_id)
+                chat_bucket = self._chat_buckets.get(chat_key)
+                if chat_bucket is None:
+                    if len(self._chat_buckets) >= self.max_chat_buckets:
+                        self._prune_chat_buckets(now)
+                    chat_bucket = [float(self.chat_burst), now]
+                    self._chat_buckets[chat_key] = chat_bucket
+                wait = max(wait, self._reserve(chat_bucket, self.chat_rate, self.chat_burst, now))
+        return wait
+    
+    def _prune_chat_buckets(self, now: float):
+        """حذف سطل‌های چتی که دوباره پر شده‌اند (برای محدود ماندن حافظه)"""
+        refill_time = self.chat_burst / self.chat_rate
+        stale = [k for k, (_, last) in self._chat_buckets.items() if now - last > refill_time]
+        for k in stale:
+            del self._chat_buckets[k]
+    
+    def try_reserve(self, token: str, headroom: float = 5.0) -> bool:
+        """
+        رزرو ظرفیت فقط در صورتی که بیش از headroom واحد در سطل توکن باقی
+        بماند؛ برای کارهای کم‌اولویت (مثل ارسال همگانی) تا ترافیک زنده
+        رله همیشه ظرفیت داشته باشد.
+        """
+        now = time.monotonic()
+        key = token[:16]
+        with self._lock:
+            bucket = self._token_buckets.setdefault(key, [self.token_rate, now])
+            tokens = min(self.token_rate, bucket[0] + (now - bucket[1]) * self.token_rate)
+            bucket[1] = now
+            if tokens - 1 < headroom:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+    
+    async def acquire(self, token: str, chat_id: Optional[int] = None, per_token: bool = True):
+        """انتظار تا زمانی که ارسال مجاز باشد"""
+        wait = self.reserve(token, chat_id, per_token)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# ========== کلاس ردیابی تاخیر رله ==========
+class RelayTrace:
+    """ثبت زمان مراحل یک رله پیام"""
+    
+    __slots__ = ('bot_username', 'started', 'spans')
+    
+    def __init__(self, bot_username: str):
+        self.bot_username = bot_username
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+    
+    def stage(self, name: str):
+        """context manager برای اندازه‌گیری یک مرحله"""
+        return _TraceStage(self, name)
+    
+    async def timed(self, name: str, coro):
+        """اجرای یک coroutine و ثبت مدت آن به عنوان یک مرحله"""
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.spans[name] = (time.perf_counter() - start) * 1000
+
+
+class _TraceStage:
+    __slots__ = ('trace', 'name', 'start')
+    
+    def __init__(self, trace: RelayTrace, name: str):
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.trace.spans[self.name] = (time.perf_counter() - self.start) * 1000
+        return False
+
+
+class RelayTracer:
+    """
+    جمع‌آوری spanهای مراحل رله و محاسبه صدک‌ها
+    
+    مراحل: receive, render, notify_owner, ack_sender و total.
+    هر trace پس از پایان به هوک‌های ثبت‌شده داده می‌شود (مثلاً برای
+    ارسال به سیستم tracing بیرونی) و در یک پنجره محدود برای محاسبه
+    p50/p90/p99 نگه داشته می‌شود.
+    """
+    
+    STAGES = ('receive', 'render', 'notify_owner', 'ack_sender', 'total')
+    
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {
+            stage: deque(maxlen=window) for stage in self.STAGES
+        }
+        self.hooks: List[Callable[[Dict[str, Any]], None]] = []
+    
+    def add_hook(self, hook: Callable[[Dict[str, Any]], None]):
+        """ثبت هوک دریافت spanها"""
+        self.hooks.append(hook)
+    
+    def start(self, bot_username: str) -> RelayTrace:
+        """شروع trace جدید"""
+        return RelayTrace(bot_username)
+    
+    def finish(self, trace: RelayTrace, **attrs):
+        """پایان trace، ثبت نمونه‌ها و فراخوانی هوک‌ها"""
+        trace.spans['total'] = (time.perf_counter() - trace.started) * 1000
         
-        # مدیر مراحل
-        self.step_manager = StepHandlerManager()
+        with self._lock:
+            for stage, duration in trace.spans.items():
+                samples = self._samples.get(stage)
+                if samples is not None:
+                    samples.append(duration)
         
-        # مدیر ربات‌های فرزند
-        self.child_manager = ChildBotManager()
+        if self.hooks:
+            record = {'bot': trace.bot_username, 'spans_ms': dict(trace.spans)}
+            record.update(attrs)
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception as e:
+                    logger.warning("خطا در هوک tracing: %s", e)
+    
+    @staticmethod
+    def _percentile(sorted_values: List[float], q: float) -> float:
+        index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+        return sorted_values[index]
+    
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """خلاصه تاخیر هر مرحله (میلی‌ثانیه)"""
+        with self._lock:
+            snapshot = {stage: sorted(values) for stage, values in self._samples.items()}
         
-        # دیکشنری برای ذخیره ربات‌های کاربران
-        self.user_bots: Dict[int, List[Dict]] = {}
+        result = {}
+        for stage, values in snapshot.items():
+            if not values:
+                result[stage] = {'count': 0}
+                continue
+            result[stage] = {
+                'count': len(values),
+                'p50': round(self._percentile(values, 0.50), 2),
+                'p90': round(self._percentile(values, 0.90), 2),
+                'p99': round(self._percentile(values, 0.99), 2),
+                'max': round(values[-1], 2),
+            }
+        return result
+
+
+# ========== کلاس حالت خلاصه (digest) ==========
+class DigestManager:
+    """
+    تجمیع پیام‌های ناشناس ربات‌های پرترافیک در یک پیام خلاصه
+    
+    برای ربات‌هایی که مالکشان حالت خلاصه را فعال کرده، نرخ پیام‌های
+    ورودی در یک دقیقه اخیر اندازه‌گیری می‌شود. وقتی نرخ از آستانه بگذرد،
+    پیام‌ها برای یک پنجره کوتاه بافر شده و با یک فراخوانی API به صورت
+    یک پیام واحد (با دکمه‌های فشرده پاسخ/مسدود برای هر مورد) به مالک
+    ارسال می‌شوند.
+    
+    هر ربات فرزند در event loop خودش اجرا می‌شود و بافر هر ربات فقط از
+    همان loop دستکاری می‌شود، پس نیازی به قفل نیست.
+    """
+    
+    # محدودیت تلگرام: ۴۰۹۶ کاراکتر متن و حداکثر ۱۰۰ دکمه
+    MAX_TEXT_LENGTH = 3800
+    
+    def __init__(self, threshold_per_minute: int = 20, window: float = 10.0, max_items: int = 15):
+        self.threshold = threshold_per_minute
+        self.window = window
+        self.max_items = max_items
+        self._arrivals: Dict[str, deque] = {}
+        self._buffers: Dict[str, List[Tuple[int, str]]] = {}
+        self._buffer_chars: Dict[str, int] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        self.delivered_items = 0
+        self.delivered_messages = 0
+    
+    def record_inbound(self, bot_username: str) -> int:
+        """ثبت پیام ورودی و برگرداندن تعداد پیام‌های یک دقیقه اخیر"""
+        now = time.monotonic()
+        arrivals = self._arrivals.get(bot_username)
+        if arrivals is None:
+            arrivals = self._arrivals[bot_username] = deque(maxlen=self.threshold * 4)
+        arrivals.append(now)
+        while arrivals and now - arrivals[0] > 60:
+            arrivals.popleft()
+        return len(arrivals)
+    
+    def should_buffer(self, bot_username: str) -> bool:
+        """آیا پیام بعدی این ربات باید بافر شود؟"""
+        if self._buffers.get(bot_username):
+            return True
+        return self.record_inbound(bot_username) >= self.threshold
+    
+    def add(self, bot_username: str, sender_id: int, line: str) -> bool:
+        """افزودن مورد به بافر؛ True یعنی بافر پر است و باید فوراً ارسال شود"""
+        buffer = self._buffers.setdefault(bot_username, [])
+        buffer.append((sender_id, line))
+        chars = self._buffer_chars.get(bot_username, 0) + len(line)
+        self._buffer_chars[bot_username] = chars
+        return len(buffer) >= self.max_items or chars >= self.MAX_TEXT_LENGTH
+    
+    def take(self, bot_username: str) -> List[Tuple[int, str]]:
+        """برداشتن همه موارد بافر شده"""
+        self._buffer_chars.pop(bot_username, None)
+        return self._buffers.pop(bot_username, [])
+    
+    def requeue(self, bot_username: str, items: List[Tuple[int, str]]) -> int:
+        """
+        بازگرداندن موارد یک ارسال ناموفق به ابتدای بافر
         
-        # دیکشنری برای نگاشت چت‌ها
-        self.chat_mapping: Dict[int, int] = {}
+        بافر حداکثر max_items مورد نگه می‌دارد تا خطای مداوم باعث رشد بی‌حد
+        آن نشود؛ قدیمی‌ترین موارد اضافه کنار گذاشته و تعدادشان برگردانده می‌شود.
+        """
+        buffer = items + self._buffers.get(bot_username, [])
+        dropped = max(0, len(buffer) - self.max_items)
+        buffer = buffer[dropped:]
+        self._buffers[bot_username] = buffer
+        self._buffer_chars[bot_username] = sum(len(line) for _, line in buffer)
+        return dropped
+    
+    def schedule_flush(self, bot_username: str, flush: Callable[[], Any]):
+        """زمان‌بندی ارسال خلاصه پس از پایان پنجره (اگر قبلاً زمان‌بندی نشده)"""
+        if bot_username in self._flush_tasks:
+            return
         
-        # کاربران مسدود شده
-        self.blocked_users: Set[Tuple[int, str]] = set()  # (user_id, bot_username)
+        async def delayed():
+            try:
+                await asyncio.sleep(self.window)
+            except asyncio.CancelledError:
+                return
+            self._flush_tasks.pop(bot_username, None)
+            await flush()
         
-        # تنظیم هندلرها
-        self.setup_handlers()
-        self.setup_callback_handlers()
+        self._flush_tasks[bot_username] = asyncio.create_task(delayed())
+    
+    def cancel_flush(self, bot_username: str):
+        """لغو ارسال زمان‌بندی شده (وقتی بافر زودتر ارسال می‌شود)"""
+        task = self._flush_tasks.pop(bot_username, None)
+        if task and not task.done():
+            task.cancel()
+    
+    def forget(self, bot_username: str):
+        """پاک کردن وضعیت یک ربات (هنگام حذف یا خاموش کردن حالت خلاصه)"""
+        self._arrivals.pop(bot_username, None)
+        self._buffers.pop(bot_username, None)
+        self._buffer_chars.pop(bot_username, None)
+        task = self._flush_tasks.pop(bot_username, None)
+        if task and not task.done():
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+
+# ========== کلاس تجمیع آلبوم‌ها (media group) ==========
+class MediaGroupBuffer:
+    """
+    جمع کردن پیام‌های یک آلبوم برای رله یکجا
+
+    تلگرام هر عضو آلبوم را به صورت یک آپدیت جدا با media_group_id مشترک
+    می‌فرستد. اعضا تا window ثانیه پس از آخرین عضو (و حداکثر max_wait ثانیه
+    از اولین عضو) جمع می‌شوند و سپس flush با فهرست مرتب پیام‌ها صدا زده
+    می‌شود. با رسیدن max_items عضو (سقف آلبوم تلگرام) آلبوم بلافاصله ارسال
+    می‌شود.
+
+    یک نمونه بین loop همه ربات‌های فرزند (و thread حذف ربات) مشترک است،
+    پس دسترسی به _groups زیر قفل انجام می‌شود.
+    """
+
+    def __init__(self, window: float = 1.0, max_wait: float = 5.0, max_items: int = 10):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._groups: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, bot_username: str, message, flush: Callable[[List[Any]], Any]):
+        """افزودن عضو آلبوم (باید داخل loop ربات صدا زده شود)"""
+        key = (bot_username, message.media_group_id)
+        now = time.monotonic()
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = {'messages': [], 'started': now, 'deadline': now + self.window}
+                self._groups[key] = group
+                group['task'] = asyncio.create_task(self._flush_later(key, flush))
+
+            group['messages'].append(message)
+            group['deadline'] = min(now + self.window, group['started'] + self.max_wait)
+
+            full = len(group['messages']) >= self.max_items
+            if full:
+                self._groups.pop(key, None)
+
+        if full:
+            group['task'].cancel()
+            asyncio.create_task(flush(self._ordered(group)))
+
+    @staticmethod
+    def _ordered(group: Dict[str, Any]) -> List[Any]:
+        return sorted(group['messages'], key=lambda m: m.message_id)
+
+    async def _flush_later(self, key: Tuple[str, str], flush: Callable[[List[Any]], Any]):
+        try:
+            while True:
+                with self._lock:
+                    group = self._groups.get(key)
+                    if group is None:
+                        return
+                    remaining = group['deadline'] - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+        except asyncio.CancelledError:
+            return
+
+        with self._lock:
+            group = self._groups.pop(key, None)
+        if group:
+            await flush(self._ordered(group))
+
+    def pending(self) -> int:
+        return len(self._groups)
+
+    def forget(self, bot_username: str):
+        """لغو آلبوم‌های در انتظار یک ربات (هنگام حذف)"""
+        with self._lock:
+            groups = [self._groups.pop(k) for k in [k for k in self._groups if k[0] == bot_username]]
+        for group in groups:
+            task = group['task']
+            if not task.done():
+                task.get_loop().call_soon_threadsafe(task.cancel)
+
+
+# ========== کلاس ایندکس پاسخ مستقیم ==========
+class ReplyIndex:
+    """
+    نگاشت پیام‌های رله‌شده به فرستنده اصلی برای پاسخ مستقیم (reply-to)
+    
+    کلید: (شناسه چت مالک, message_id پیام اعلان) به صورت یک عدد صحیح
+    فشرده. مقدار: (sender_id, bot_username). با پر شدن ظرفیت، قدیمی‌ترین
+    موارد (LRU) حذف می‌شوند. در صورت تعیین مسیر، ایندکس هنگام شروع
+    بارگذاری و توسط یک thread پس‌زمینه روی دیسک ذخیره می‌شود: با رسیدن
+    flush_every تغییر (یا هر flush_interval ثانیه) بیدار می‌شود و فایل
+    حداکثر یک بار در هر flush_interval ثانیه بازنویسی می‌شود.
+    """
+    
+    def __init__(self, capacity: int = 50000, path: Optional[str] = None, flush_every: int = 200,
+                 flush_interval: float = 5.0):
+        self.capacity = capacity
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._entries: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = 0
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
         
-        # تنظیمات رندر
-        self.setup_render_config()
+        if path:
+            self.load()
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="reply_index_flush")
+            self._flusher.start()
+    
+    @staticmethod
+    def _key(chat_id: int, message_id: int, via: int = 0) -> int:
+        # via: شناسه ربات فرزندی که اعلان را فرستاده (0 برای ربات مادر)؛
+        # شماره پیام‌ها در هر گفتگوی مالک با هر ربات مستقل است
+        return (via << 96) | (chat_id << 32) | (message_id & 0xFFFFFFFF)
+    
+    def put(self, chat_id: int, message_id: int, sender_id: int, bot_username: str, via: int = 0):
+        """ثبت پیام اعلان ارسال شده به مالک"""
+        key = self._key(chat_id, message_id, via)
+        with self._lock:
+            self._entries[key] = (sender_id, sys.intern(bot_username))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._dirty += 1
+            should_flush = self.path and self._dirty >= self.flush_every
         
-        # Flask app برای وب هوک
-        self.app = Flask(__name__)
-        self.setup_flask_routes()
+        if should_flush:
+            # نوشتن روی دیسک در thread پس‌زمینه (put از داخل loop صدا زده می‌شود)
+            self._wake.set()
     
-    def setup_render_config(self):
-        """تنظیمات رندر"""
-        self.render_config = {
-            'welcome_message': "🎭 به ربات چت ناشناس خوش آمدید!\n\n"
-                              "با این ربات می‌توانید ربات ناشناس خود را ایجاد کنید.\n\n"
-                              "دستورات:\n"
-                              "/start - شروع کار\n"
-                              "/addbot - ساخت ربات جدید\n"
-                              "/mybots - ربات‌های من\n"
-                              "/help - راهنمایی",
-            
-            'add_bot_instructions': "🤖 **مراحل ساخت ربات ناشناس:**\n\n"
-                                   "1. به @BotFather در تلگرام بروید\n"
-                                   "2. دستور `/newbot` را ارسال کنید\n"
-                                   "3. برای ربات خود نام انتخاب کنید\n"
-                                   "4. یک username منحصر به فرد انتخاب کنید\n"
-                                   "5. توکن دریافتی را برای من ارسال کنید\n\n"
-                                   "⚠️ **توجه:**\n"
+    def get(self, chat_id: int, message_id: int, via: int = 0) -> Optional[Tuple[int, str]]:
+        """یافتن فرستنده اصلی یک پیام اعلان"""
+        key = self._key(chat_id, message_id, via)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+    
+    def discard_bot(self, bot_username: str):
+        """حذف همه موارد مربوط به یک ربات"""
+        with self._lock:
+            stale = [k for k, (_, uname) in self._entries.items() if uname == bot_username]
+            for k in stale:
+                del self._entries[k]
+            self._dirty += len(stale)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def load(self):
+        """بارگذاری ایندکس از دیسک"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("بارگذاری ایندکس پاسخ ناموفق بود: %s", e)
+            return
+        
+        with self._lock:
+            for key, sender_id, bot_username in rows[-self.capacity:]:
+                self._entries[key] = (sender_id, sys.intern(bot_username))
+    
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            # فاصله حداقل بین دو بازنویسی کامل فایل
+            self._closed.wait(self.flush_interval)
+    
+    def close(self):
+        """توقف thread ذخیره و ذخیره نهایی"""
+        self._closed.set()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join(5)
+        self.flush()
+    
+    def flush(self):
+        """ذخیره اتمیک ایندکس روی دیسک"""
+        if not self.path:
+            return
+        # قفل نوشتن پیرامون گرفتن snapshot تا نسخه قدیمی‌تر روی نسخه جدیدتر ننشیند
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                rows = [[key, sender_id, uname] for key, (sender_id, uname) in self._entries.items()]
+                self._dirty = 0
+            
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(rows, f, separators=(',', ':'))
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning("ذخیره ایندکس پاسخ ناموفق بود: %s", e)
+
+
+# ========== کلاس ایندکس فرستندگان ==========
+class SenderIndex:
+    """
+    فهرست فرستندگان هر ربات (برای ارسال همگانی)
+    
+    برای هر ربات یک dict مرتب (به عنوان مجموعه مرتب بر اساس زمان اولین
+    پیام) نگه داشته می‌شود تا ترتیب ارسال همگانی پایدار باشد. فرستندگان
+    تازه و حذف‌شده با write_behind در ذخیره‌سازی (یک فضای نام برای هر ربات)
+    ثبت و در restore_state بارگذاری می‌شوند.
+    """
+    
+    def __init__(self, store: Optional[StateStore] = None):
+        self._senders: Dict[str, Dict[int, None]] = {}
+        self._lock = threading.Lock()
+        self.store = store
+    
+    def add(self, bot_username: str, sender_id: int):
+        """ثبت فرستنده"""
+        senders = self._senders.get(bot_username)
+        if senders is None:
+            with self._lock:
+                senders = self._senders.setdefault(bot_username, {})
+        if sender_id in senders:
+            return
+        senders[sender_id] = None
+        if self.store:
+            self.store.add_sender(bot_username, sender_id, time.time_ns())
+    
+    def remove(self, bot_username: str, sender_id: int):
+        """حذف فرستنده (مثلاً وقتی ربات را مسدود کرده)"""
+        senders = self._senders.get(bot_username)
+        if senders is not None and senders.pop(sender_id, False) is None and self.store:
+            self.store.remove_sender(bot_username, sender_id)
+    
+    def restore(self, senders: Dict[str, List[int]]):
+        """بارگذاری فهرست‌های ذخیره شده (بدون نوشتن دوباره)"""
+        with self._lock:
+            for bot_username, sender_ids in senders.items():
+                current = self._senders.setdefault(bot_username, {})
+                restored = dict.fromkeys(sender_ids)
+                restored.update(current)
+                self._senders[bot_username] = restored
+    
+    def snapshot(self, bot_username: str) -> List[int]:
+        """فهرست فعلی فرستندگان یک ربات"""
+        with self._lock:
+            return list(self._senders.get(bot_username, ()))
+    
+    def count(self, bot_username: str) -> int:
+        """تعداد فرستندگان یک ربات"""
+        return len(self._senders.get(bot_username, ()))
+    
+    def drop_bot(self, bot_username: str):
+        """حذف فهرست یک ربات"""
+        with self._lock:
+            senders = self._senders.pop(bot_username, None)
+        if senders and self.store:
+            for sender_id in senders:
+                self.store.remove_sender(bot_username, sender_id)
+
+
+# ========== کلاس کار ارسال همگانی ==========
+class BroadcastJob:
+    """
+    کار ارسال همگانی قابل ادامه
+    
+    فهرست گیرندگان هنگام ساخت کار یک بار و پیشرفت (position) به صورت
+    دوره‌ای در ذخیره‌سازی وضعیت ثبت می‌شود تا پس از راه‌اندازی مجدد (یا روی
+    نمونه دیگری با همان ذخیره‌سازی)، ارسال از همان نقطه ادامه پیدا کند.
+    """
+    
+    CHECKPOINT_EVERY = 50
+    
+    def __init__(self, bot_username: str, owner_id: int, text: str, recipients: List[int],
+                 store: StateStore, position: int = 0, sent: int = 0, failed: int = 0, pruned: int = 0,
+                 progress_message_id: Optional[int] = None):
+        self.bot_username = bot_username
+        self.owner_id = owner_id
+        self.text = text
+        self.recipients = recipients
+        self.store = store
+        self.position = position
+        self.sent = sent
+        self.failed = failed
+        self.pruned = pruned
+        self.progress_message_id = progress_message_id
+        self.cancelled = False
+    
+    @property
+    def total(self) -> int:
+        return len(self.recipients)
+    
+    @property
+    def done(self) -> bool:
+        return self.position >= len(self.recipients)
+    
+    def to_dict(self) -> Dict:
+        """وضعیت کار بدون فهرست گیرندگان (که جدا و یک بار ذخیره می‌شود)"""
+        return {
+            'bot_username': self.bot_username,
+            'owner_id': self.owner_id,
+            'text': self.text,
+            'position': self.position,
+            'sent': self.sent,
+            'failed': self.failed,
+            'pruned': self.pruned,
+            'progress_message_id': self.progress_message_id
+        }
+    
+    @classmethod
+    async def load(cls, store: StateStore, bot_username: str) -> Optional['BroadcastJob']:
+        """بارگذاری کار نیمه‌تمام یک ربات از ذخیره‌سازی (None اگر وجود ندارد)"""
+        saved = await store.load_broadcast(bot_username)
+        if saved is None:
+            return None
+        state, recipients = saved
+        return cls(store=store, recipients=recipients, **state)
+    
+    def save(self):
+        """ثبت کار تازه به همراه فهرست گیرندگان"""
+        self.store.save_broadcast(self.bot_username, self.to_dict(), self.recipients)
+    
+    def checkpoint(self):
+        """ذخیره پیشرفت کار"""
+        self.store.checkpoint_broadcast(self.bot_username, self.to_dict())
+    
+    def discard(self):
+        """حذف کار پس از پایان آن"""
+        self.store.delete_broadcast(self.bot_username)
+
+
+# ========== کلاس زمان‌بندی عادلانه بین مستاجرها ==========
+class TenantQuotas:
+    """
+    سهمیه‌های هر مستاجر (مالک)
+    
+    مقادیر پیش‌فرض برای همه مالکان اعمال می‌شود و می‌توان برای مالکان
+    خاص مقادیر جداگانه تعیین کرد، مثلاً از طریق متغیر محیطی TENANT_QUOTAS:
+    {"123456": {"max_bots": 50, "relays_per_minute": 1200, "weight": 2}}
+    
+    سهمیه رله در دقیقه برای هر مالک شمرده می‌شود (مشترک بین همه
+    ربات‌هایش)، نه برای هر ربات؛ وگرنه مالک N ربات N برابر سهمیه داشت.
+    """
+    
+    def __init__(self, max_bots: int = 20, relays_per_minute: int = 600,
+                 weight: float = 1.0, overrides: Optional[Dict[str, Dict]] = None):
+        self.defaults = {
+            'max_bots': max_bots,
+            'relays_per_minute': relays_per_minute,
+            'weight': weight
+        }
+        self.overrides: Dict[int, Dict] = {
+            int(owner_id): values for owner_id, values in (overrides or {}).items()
+        }
+        # مالک -> [شروع پنجره یک دقیقه‌ای، تعداد رله در پنجره]
+        self._windows: Dict[int, List[float]] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, owner_id: int, key: str):
+        """مقدار یک سهمیه برای مالک"""
+        override = self.overrides.get(owner_id)
+        if override and key in override:
+            return override[key]
+        return self.defaults[key]
+    
+    def allow_relay(self, owner_id: int) -> bool:
+        """بررسی سهمیه رله مالک در پنجره یک دقیقه‌ای فعلی (از هر thread)"""
+        limit = self.get(owner_id, 'relays_per_minute')
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(owner_id)
+            if window is None or now - window[0] >= 60:
+                window = self._windows[owner_id] = [now, 0]
+            if window[1] >= limit:
+                return False
+            window[1] += 1
+            return True
+    
+    def relays_this_minute(self, owner_id: int) -> int:
+        window = self._windows.get(owner_id)
+        return int(window[1]) if window and time.monotonic() - window[0] < 60 else 0
+
+
+class FairScheduler:
+    """
+    زمان‌بندی عادلانه ارسال‌های ربات مادر بین ربات‌های فرزند (Deficit Round Robin)
+    
+    همه ربات‌های فرزند برای رساندن پیام به مالک از توکن مشترک ربات مادر
+    استفاده می‌کنند. این کلاس مجوز ارسال را با نرخ کلی توکن صادر می‌کند و
+    وقتی صف تشکیل شود، مجوزها را به صورت نوبتی و وزن‌دار بین ربات‌ها
+    تقسیم می‌کند تا یک ربات پرترافیک نتواند بقیه را گرسنه نگه دارد.
+    
+    فراخواننده‌ها در event loopهای مختلف (thread ربات‌های فرزند) هستند؛
+    صف‌ها زیر قفل threading نگه داشته می‌شوند و یک thread توزیع‌کننده
+    futureها را با call_soon_threadsafe در loop خودشان آزاد می‌کند.
+    
+    DRR فقط ترتیب ارسال‌های ربات مادر را تعیین می‌کند. اجرای هندلرها
+    نوبت‌دهی DRR ندارد: هر ربات فرزند thread و event loop خودش را دارد و
+    سهم هر ربات از پردازش با سقف آپدیت‌های در جریان همان ربات
+    (INGRESS_MAX_PER_BOT در AdmissionController) محدود می‌شود.
+    """
+    
+    def __init__(self, rate: float = 30.0, burst: float = 30.0, quantum: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.quantum = quantum
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._queues: Dict[str, deque] = {}
+        self._active: deque = deque()
+        self._deficit: Dict[str, float] = {}
+        self._weights: Dict[str, float] = {}
+        self._dispatcher: Optional[threading.Thread] = None
+    
+    def set_weight(self, tenant: str, weight: float):
+        """تعیین وزن یک مستاجر"""
+        self._weights[tenant] = max(weight, 0.1)
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+    
+    def queued(self) -> int:
+        """تعداد درخواست‌های در صف"""
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+    
+    async def acquire(self, tenant: str):
+        """انتظار برای نوبت ارسال این مستاجر"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._refill(time.monotonic())
+            # مسیر سریع: صفی وجود ندارد و ظرفیت هست
+            if not self._active and self._tokens >= 1:
+                self._tokens -= 1
+                return
+            
+            future = loop.create_future()
+            queue = self._queues.get(tenant)
+            if queue is None:
+                queue = self._queues[tenant] = deque()
+            if not queue:
+                self._active.append(tenant)
+                self._deficit.setdefault(tenant, 0.0)
+            queue.append((loop, future))
+            
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch_loop, daemon=True, name="fair_scheduler"
+                )
+                self._dispatcher.start()
+        
+        self._wakeup.set()
+        await future
+    
+    def _next_grant(self):
+        """انتخاب درخواست بعدی طبق DRR (زیر قفل فراخوانی می‌شود)"""
+        while self._active:
+            tenant = self._active[0]
+            queue = self._queues[tenant]
+            
+            # حذف درخواست‌های لغو شده
+            while queue and queue[0][1].done():
+                queue.popleft()
+            if not queue:
+                self._active.popleft()
+                self._deficit[tenant] = 0.0
+                del self._queues[tenant]
+                continue
+            
+            if self._deficit[tenant] < 1:
+                self._deficit[tenant] += self.quantum * self._weights.get(tenant, 1.0)
+                if self._deficit[tenant] < 1:
+                    self._active.rotate(-1)
+                    continue
+            
+            self._deficit[tenant] -= 1
+            grant = queue.popleft()
+            if not queue:
+                self._active.popleft()
+                self._deficit[tenant] = 0.0
+                del self._queues[tenant]
+            elif self._deficit[tenant] < 1:
+                self._active.rotate(-1)
+            return grant
+        return None
+    
+    def _dispatch_loop(self):
+        """thread توزیع مجوزها"""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                grants = []
+                while self._tokens >= 1:
+                    grant = self._next_grant()
+                    if grant is None:
+                        break
+                    self._tokens -= 1
+                    grants.append(grant)
+                idle = not self._active
+                wait = 0.0 if idle else max(0.001, (1 - self._tokens) / self.rate)
+            
+            for loop, future in grants:
+                try:
+                    loop.call_soon_threadsafe(_resolve_future, future)
+                except RuntimeError:
+                    # loop بسته شده است
+                    pass
+            
+            if idle:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            else:
+                time.sleep(wait)
+
+
+def _resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# حداکثر طول متن یک پیام و کپشن تلگرام
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+
+def _truncate(text: str, limit: int) -> str:
+    """کوتاه کردن متن خام تا limit کاراکتر (پیش از escape)"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _escape_limited(text: str, limit: int) -> str:
+    """escape متن برای HTML با سقف طول پس از escape (بدون شکستن entityها)"""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    parts = []
+    size = 0
+    for char in text:
+        piece = html.escape(char)
+        if size + len(piece) > limit - 1:
+            break
+        parts.append(piece)
+        size += len(piece)
+    return ''.join(parts) + "…"
+
+
+def _recipient_gone(error: telebot.asyncio_helper.ApiTelegramException) -> bool:
+    """آیا خطا یعنی گیرنده در دسترس نیست (ربات مسدود شده یا چت وجود ندارد)؟"""
+    if error.error_code == 403:
+        return True
+    return error.error_code == 400 and 'chat not found' in (error.description or '').lower()
+
+
+def _token_matches(expected: Optional[str], supplied: Optional[str]) -> bool:
+    """مقایسه توکن اپراتور در زمان ثابت (توکن تنظیم نشده یعنی مسیر بسته است)"""
+    if not expected or supplied is None:
+        return False
+    return hmac.compare_digest(expected.encode('utf-8'), supplied.encode('utf-8'))
+
+
+def _log_future_error(future: concurrent.futures.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("خطا در اجرای کار روی loop ربات مادر: %s", future.exception())
+
+
+class TenantUsage:
+    """شمارنده‌های مصرف یک ربات فرزند"""
+    
+    __slots__ = ('owner_id', 'relays', 'master_sends', 'throttled', 'queue_wait_ms')
+    
+    def __init__(self, owner_id: int):
+        self.owner_id = owner_id
+        self.relays = 0
+        self.master_sends = 0
+        self.throttled = 0
+        self.queue_wait_ms = 0.0
+    
+    def record_relay(self, allowed: bool) -> bool:
+        """ثبت نتیجه بررسی سهمیه مالک برای این ربات"""
+        if allowed:
+            self.relays += 1
+        else:
+            self.throttled += 1
+        return allowed
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'relays': self.relays,
+            'master_sends': self.master_sends,
+            'throttled': self.throttled,
+            'avg_queue_wait_ms': round(self.queue_wait_ms / self.master_sends, 2) if self.master_sends else 0.0
+        }
+
+
+# ========== کلاس آمار افزایشی ==========
+class StatsRegistry:
+    """
+    آمار سرویس که همزمان با تغییرات به‌روز می‌شود
+
+    شمارنده‌ها با incr در محل تغییر (افزودن ربات، مسدود کردن، رله پیام)
+    به‌روز می‌شوند و gaugeها تابع‌های O(1) مانند len(dict) هستند. snapshot
+    فقط وقتی شمارنده‌ای تغییر کرده یا refresh ثانیه گذشته باشد دوباره
+    ساخته می‌شود و ETag آن از محتوا به دست می‌آید. خروجی‌های رندر شده
+    (صفحه وضعیت، JSON) تا تغییر ETag در حافظه می‌مانند.
+    """
+
+    def __init__(self, refresh: float = 1.0):
+        self.refresh = refresh
+        self._counters: Dict[str, int] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+        self._info: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._built_version = -1
+        self._built_at = 0.0
+        self._snapshot: Dict[str, Any] = {}
+        self._etag = ''
+        self._rendered: Dict[str, Tuple[str, Any]] = {}
+
+    def incr(self, name: str, delta: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + delta
+            self._version += 1
+
+    def gauge(self, name: str, func: Callable[[], Any]):
+        """ثبت مقدار لحظه‌ای (تابع باید O(1) باشد)"""
+        self._gauges[name] = func
+
+    def set_info(self, name: str, value: Any):
+        with self._lock:
+            self._info[name] = value
+            self._version += 1
+
+    def snapshot(self) -> Tuple[Dict[str, Any], str]:
+        """آخرین snapshot و ETag آن"""
+        now = time.monotonic()
+        with self._lock:
+            if self._built_version == self._version and now - self._built_at < self.refresh:
+                return self._snapshot, self._etag
+            data = dict(self._info)
+            data.update(self._counters)
+            version = self._version
+
+        for name, func in self._gauges.items():
+            try:
+                data[name] = func()
+            except Exception:
+                data[name] = None
+        etag = '"%08x"' % zlib.crc32(json.dumps(data, sort_keys=True, default=str).encode('utf-8'))
+
+        with self._lock:
+            self._snapshot, self._etag = data, etag
+            self._built_version, self._built_at = version, now
+        return data, etag
+
+    def rendered(self, key: str, render: Callable[[Dict[str, Any]], Any]) -> Tuple[Any, str]:
+        """خروجی render(snapshot) که تا تغییر ETag دوباره ساخته نمی‌شود"""
+        data, etag = self.snapshot()
+        cached = self._rendered.get(key)
+        if cached and cached[0] == etag:
+            return cached[1], etag
+        body = render(data)
+        self._rendered[key] = (etag, body)
+        return body, etag
+
+
+# ========== کلاس کش صفحات فهرست ربات‌ها ==========
+class BotListPageCache:
+    """
+    کش صفحات رندر شده /mybots برای هر مالک
+
+    هر صفحه (متن و کیبورد) تا زمان تغییر فهرست ربات‌های مالک (افزودن، حذف
+    یا تغییر وضعیت) دوباره ساخته نمی‌شود. تعداد مالکان نگهداری شده محدود
+    است و مالک‌هایی که اخیراً استفاده نشده‌اند حذف می‌شوند.
+    """
+
+    def __init__(self, page_size: int = 8, max_owners: int = 1000):
+        self.page_size = max(1, page_size)
+        self.max_owners = max_owners
+        self._pages: "OrderedDict[int, Dict[int, Tuple[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page_count(self, total: int) -> int:
+        return max(1, -(-total // self.page_size))
+
+    def page_of(self, index: int) -> int:
+        """شماره صفحه‌ای که ربات با اندیس index در آن است"""
+        return index // self.page_size
+
+    def get(self, owner_id: int, page: int) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            pages = self._pages.get(owner_id)
+            if pages is None:
+                return None
+            self._pages.move_to_end(owner_id)
+            return pages.get(page)
+
+    def put(self, owner_id: int, page: int, rendered: Tuple[str, Any]):
+        with self._lock:
+            self._pages.setdefault(owner_id, {})[page] = rendered
+            self._pages.move_to_end(owner_id)
+            while len(self._pages) > self.max_owners:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, owner_id: int):
+        with self._lock:
+            self._pages.pop(owner_id, None)
+
+
+# ========== کلاس اصلی ربات مادر ==========
+class AnonymousChatBot:
+    def __init__(self, token: str, webhook_url: str = None, port: int = 10000):
+        """
+        مقداردهی اولیه ربات مادر
+        
+        Args:
+            token: توکن ربات مادر
+            webhook_url: آدرس وب هوک
+            port: پورت برای اجرای سرور
+        """
+        self.master_token = token
+        # نشست HTTP جداگانه برای loop ربات مادر و loop هر ربات فرزند
+        self.sessions = install_session_manager()
+        
+        # کنترل پذیرش ورودی: ظرفیت آپدیت‌های در جریان برای هر ربات و کل سرویس
+        self.admission = AdmissionController(
+            max_inflight=int(os.environ.get('INGRESS_MAX_INFLIGHT', 1000)),
+            max_per_bot=int(os.environ.get('INGRESS_MAX_PER_BOT', 50)),
+            shed_ratio=float(os.environ.get('INGRESS_SHED_RATIO', 0.8))
+        )
+        self.bot = AdmittedTeleBot(token, admission=self.admission)
+        self.webhook_url = webhook_url
+        self.port = port
+        
+        # ذخیره‌سازی وضعیت (حافظه، SQLite یا Redis)
+        self.store = create_state_store(os.environ.get('STATE_STORE_URL'))
+        
+        # مدیر مراحل
+        self.step_manager = StepHandlerManager(store=self.store)
+        
+        # مدیر ربات‌های فرزند (با خواب ربات‌های بی‌فعالیت)
+        self.child_manager = ChildBotManager(
+            idle_threshold=float(os.environ.get('HIBERNATE_AFTER', 1800)),
+            poll_min_interval=float(os.environ.get('HIBERNATE_POLL_MIN', 30)),
+            poll_max_interval=float(os.environ.get('HIBERNATE_POLL_MAX', 300)),
+            probe_concurrency=int(os.environ.get('HIBERNATE_PROBE_CONCURRENCY', 20)),
+            store=self.store
+        )
+        self.child_manager.client_factory = self.attach_child_client
+        
+        # دیکشنری برای ذخیره ربات‌های کاربران
+        self.user_bots: Dict[int, List[BotRecord]] = {}
+        
+        # کاربران مسدود شده
+        self.blocked_users: Set[Tuple[int, str]] = set()  # (user_id, bot_username)
+        
+        # فهرست مسدودی سراسری اپراتور (اختیاری) و مسدودی مالک در همه ربات‌هایش
+        self.blocklist = Blocklist(capacity=int(os.environ.get('BLOCKLIST_CAPACITY', 100000)))
+        self.global_blocklist = os.environ.get('GLOBAL_BLOCKLIST', 'off') == 'on'
+        
+        # مالکانی که ربات مادر را مسدود کرده‌اند (ربات‌هایشان متوقف می‌مانند)
+        self.unreachable_owners: Set[int] = set()
+        
+        # محدودکننده نرخ ارسال و ردیابی تاخیر رله
+        self.outbound = OutboundRateLimiter()
+        self.tracer = RelayTracer()
+        # رله‌های کندتر از RELAY_SLOW_MS میلی‌ثانیه با spanهایشان لاگ می‌شوند (0 غیرفعال)
+        self.relay_slow_ms = float(os.environ.get('RELAY_SLOW_MS', 0))
+        if self.relay_slow_ms > 0:
+            self.tracer.add_hook(self._log_slow_relay)
+        
+        # زمان‌بندی عادلانه و سهمیه‌های مستاجرها
+        self.quotas = TenantQuotas(
+            max_bots=int(os.environ.get('TENANT_MAX_BOTS', 20)),
+            relays_per_minute=int(os.environ.get('TENANT_MAX_RELAYS_PER_MINUTE', 600)),
+            overrides=json.loads(os.environ.get('TENANT_QUOTAS', '{}'))
+        )
+        self.scheduler = FairScheduler(rate=float(os.environ.get('MASTER_SEND_RATE', 30)))
+        self.tenant_usage: Dict[str, TenantUsage] = {}
+        
+        # ایندکس پاسخ مستقیم (reply-to روی پیام رله‌شده)
+        self.reply_index = ReplyIndex(
+            capacity=int(os.environ.get('REPLY_INDEX_SIZE', 50000)),
+            path=os.environ.get('REPLY_INDEX_PATH'),
+            flush_interval=float(os.environ.get('REPLY_INDEX_FLUSH_INTERVAL', 5))
+        )
+        
+        # فهرست فرستندگان و کارهای ارسال همگانی
+        self.data_dir = os.environ.get('DATA_DIR', 'data')
+        self.sender_index = SenderIndex(store=self.store)
+        self.broadcast_jobs: Dict[str, BroadcastJob] = {}
+        
+        # صندوق پیام قابل جستجو (INBOX_RETENTION_DAYS=0 غیرفعال می‌کند)
+        inbox_retention = float(os.environ.get('INBOX_RETENTION_DAYS', 30))
+        self.inbox: Optional[InboxStore] = None
+        if inbox_retention > 0:
+            self.inbox = InboxStore(
+                os.environ.get('INBOX_PATH', os.path.join(self.data_dir, 'inbox.db')),
+                retention_days=inbox_retention,
+                partition_days=float(os.environ.get('INBOX_PARTITION_DAYS', 7))
+            )
+        self.inbox_page_size = int(os.environ.get('INBOX_PAGE_SIZE', 10))
+        self.inbox_queries: Dict[int, Tuple[Optional[str], Optional[str]]] = {}  # owner -> (query, bot)
+        # ربات‌هایی که ثبت یا حذف آن‌ها روی همین نمونه در جریان است (همگام‌سازی رد می‌کند)
+        self._pending_bots: Set[str] = set()
+        
+        # انتخاب رهبر بین چند نمونه (LEADER_ELECTION=file|store)
+        self.leases: Optional[LeaseManager] = None
+        self.lease_hooks: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.master_polling: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Task]] = None
+        self.use_webhook = False
+        election = os.environ.get('LEADER_ELECTION', 'off')
+        if election in ('file', 'store'):
+            backend = (
+                FileLeaseBackend(os.environ.get('LEASE_DIR', os.path.join(self.data_dir, 'leases')))
+                if election == 'file' else StoreLeaseBackend(self.store)
+            )
+            self.leases = LeaseManager(
+                backend,
+                instance_id=os.environ.get('INSTANCE_ID'),
+                ttl=float(os.environ.get('LEASE_TTL', 15)),
+                shards=int(os.environ.get('LEASE_SHARDS', 1))
+            )
+            self.child_manager.poll_gate = self.leases.owns_bot
+            # هوک‌های lease (شروع/توقف polling با join threadها) به ترتیب در یک
+            # worker جدا اجرا می‌شوند تا thread تمدید lease مسدود نشود
+            self.lease_hooks = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='lease_hooks'
+            )
+        # ربات‌های ساخته شده روی نمونه‌های دیگر هر BOT_SYNC_INTERVAL ثانیه
+        # از ذخیره‌سازی مشترک خوانده می‌شوند (دارنده شارد آن‌ها را poll می‌کند)
+        self.bot_sync_interval = float(os.environ.get('BOT_SYNC_INTERVAL', 30))
+        
+        # جمع کردن پیام‌های تکراری (کمپین‌های اسپم) در شمارنده اعلان قبلی
+        # (DEDUP_WINDOW=0 غیرفعال می‌کند)
+        self.duplicates: Optional[DuplicateIndex] = None
+        dedup_window = float(os.environ.get('DEDUP_WINDOW', 600))
+        if dedup_window > 0:
+            self.duplicates = DuplicateIndex(
+                window=dedup_window,
+                max_entries=int(os.environ.get('DEDUP_MAX_ENTRIES', 20000)),
+                use_simhash=os.environ.get('DEDUP_SIMHASH', 'on') == 'on',
+                simhash_distance=int(os.environ.get('DEDUP_SIMHASH_DISTANCE', 6))
+            )
+        self.dedup_edit_interval = float(os.environ.get('DEDUP_EDIT_INTERVAL', 3))
+        
+        # حالت خلاصه برای ربات‌های پرترافیک
+        self.digest = DigestManager(
+            threshold_per_minute=int(os.environ.get('DIGEST_THRESHOLD', 20)),
+            window=float(os.environ.get('DIGEST_WINDOW', 10))
+        )
+        
+        # تحویل اعلان‌ها به مالک: master (ربات مادر) یا child (خود ربات فرزند)
+        self.owner_delivery = os.environ.get('OWNER_DELIVERY', 'master')
+        
+        # تجمیع اعضای آلبوم برای یک اعلان و یک تایید
+        self.media_groups = MediaGroupBuffer(window=float(os.environ.get('MEDIA_GROUP_WINDOW', 1.0)))
+        
+        # پایش تاخیر event loopها و مسیرهای /debug (فقط با DEBUG_TOKEN فعال می‌شوند)
+        self.loop_monitor = LoopMonitor(
+            interval=float(os.environ.get('LOOP_LAG_INTERVAL', 0.25)),
+            slow_threshold=float(os.environ.get('SLOW_CALLBACK_MS', 100)) / 1000
+        )
+        self.child_manager.loop_monitor = self.loop_monitor
+        # snapshotهای tracemalloc در /debug/memory (با اولین snapshot روشن می‌شود)
+        self.memory_tracker = MemoryTracker(frames=int(os.environ.get('TRACEMALLOC_FRAMES', 1)))
+        self.debug_token = os.environ.get('DEBUG_TOKEN')
+        self.admin_token = os.environ.get('ADMIN_TOKEN')
+        self.import_concurrency = int(os.environ.get('IMPORT_CONCURRENCY', 16))
+        
+        # آمار افزایشی برای صفحه وضعیت، /api/stats و /stats
+        self.stats = StatsRegistry()
+        self.stats_max_age = int(os.environ.get('STATS_CACHE_SECONDS', 5))
+        self.stats.set_info('master_username', None)
+        self.stats.gauge('total_users', lambda: len(self.user_bots))
+        self.stats.gauge('total_child_bots', lambda: len(self.child_manager.child_bots))
+        self.stats.gauge('blocked_users', lambda: len(self.blocked_users))
+        self.stats.gauge('blocklist', self.blocklist.stats)
+        self.stats.gauge('unreachable_owners', lambda: len(self.unreachable_owners))
+        if self.inbox:
+            self.stats.gauge('inbox', self.inbox.stats)
+        if self.duplicates:
+            self.stats.gauge('duplicates', self.duplicates.stats)
+        self.stats.gauge('admission', self.admission.stats)
+        self.stats.gauge('active_polling_bots', lambda: len(self.child_manager.polling_loops))
+        self.stats.gauge('hibernated_bots', lambda: len(self.child_manager.hibernated))
+        self.stats.gauge('threads', threading.active_count)
+        self.stats.gauge('logging', log_stats)
+        
+        # آمار ترافیک هر ربات (سری‌های حلقوی و HyperLogLog)
+        self.analytics = AnalyticsStore()
+        
+        # صفحه‌بندی و کش /mybots
+        self.bot_pages = BotListPageCache(page_size=int(os.environ.get('BOTS_PAGE_SIZE', 8)))
+        
+        # تنظیم هندلرها
+        self.setup_handlers()
+        self.setup_callback_handlers()
+        
+        # تنظیمات رندر
+        self.setup_render_config()
+        
+        # وضعیت آمادگی و loop ربات مادر (در run ساخته می‌شوند)
+        self.master_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.http_server = None
+        self.webhook_active = False
+        self.state_restored = False
+        self.startup_timings: Dict[str, float] = {}
+        self._started_at = time.perf_counter()
+        self._stop_event = threading.Event()
+        
+        # خاموشی هماهنگ با SIGTERM (مهلت کل تخلیه؛ Render سی ثانیه صبر می‌کند)
+        self.draining = False
+        self.shutdown_timeout = float(os.environ.get('SHUTDOWN_TIMEOUT', 25))
+        self.child_manager.drain_hook = self.drain_child_bot
+        
+        # Flask app برای وب هوک
+        self.setup_flask_routes()
+    
+    def setup_render_config(self):
+        """تنظیمات رندر"""
+        self.render_config = {
+            'welcome_message': "🎭 به ربات چت ناشناس خوش آمدید!\n\n"
+                              "با این ربات می‌توانید ربات ناشناس خود را ایجاد کنید.\n\n"
+                              "دستورات:\n"
+                              "/start - شروع کار\n"
+                              "/addbot - ساخت ربات جدید\n"
+                              "/mybots - ربات‌های من\n"
+                              "/broadcast - ارسال همگانی\n"
+                              "/inbox - صندوق پیام‌ها\n"
+                              "/help - راهنمایی",
+            
+            'add_bot_instructions': "🤖 **مراحل ساخت ربات ناشناس:**\n\n"
+                                   "1. به @BotFather در تلگرام بروید\n"
+                                   "2. دستور `/newbot` را ارسال کنید\n"
+                                   "3. برای ربات خود نام انتخاب کنید\n"
+                                   "4. یک username منحصر به فرد انتخاب کنید\n"
+                                   "5. توکن دریافتی را برای من ارسال کنید\n\n"
+                                   "⚠️ **توجه:**\n"
                                    "• مالک ربات شما خواهید بود\n"
                                    "• فقط شما پیام‌ها را می‌بینید\n"
                                    "• کاربران از طریق username ربات شما پیام می‌فرستند",
@@ -219,12 +2005,16 @@ class AnonymousChatBot:
                             "از دستور /addbot استفاده کنید.",
             
             'bot_list': "📋 **ربات‌های شما:**\n\n",
+            'bot_list_page': "صفحه {} از {} ({} ربات)",
+            'prev_page_btn': "◀️ قبلی",
+            'next_page_btn': "بعدی ▶️",
             
             'message_received': "📩 **پیام ناشناس جدید**\n\n",
             
             'view_profile_btn': "👤 مشاهده پروفایل",
             'reply_btn': "↪️ پاسخ",
             'block_btn': "🚫 مسدود",
+            'block_all_btn': "🚫 در همه ربات‌هایم",
             'unblock_btn': "✅ آزاد کردن",
             'delete_bot_btn': "🗑 حذف ربات",
             'back_btn': "🔙 بازگشت",
@@ -235,11 +2025,15 @@ class AnonymousChatBot:
                            "• مشاهده پیام‌ها فقط توسط مالک\n"
                            "• پاسخ به پیام‌های دریافتی\n"
                            "• مسدود کردن کاربران مزاحم\n"
-                           "• مشاهده پروفایل فرستنده\n\n"
+                           "• مشاهده پروفایل فرستنده\n"
+                           "• پاسخ مستقیم با Reply روی پیام دریافتی\n\n"
                            "**دستورات:**\n"
                            "/start - شروع\n"
                            "/addbot - ساخت ربات جدید\n"
                            "/mybots - لیست ربات‌ها\n"
+                           "/broadcast - ارسال پیام به همه فرستندگان\n"
+                           "/inbox - پیام‌های دریافتی قبلی (/inbox @bot برای یک ربات)\n"
+                           "/search - جستجو در پیام‌های دریافتی\n"
                            "/help - این راهنما",
             
             'enter_token': "🔑 لطفاً توکن ربات خود را ارسال کنید:",
@@ -247,68 +2041,133 @@ class AnonymousChatBot:
             'processing_token': "⏳ در حال ساخت ربات...",
             'enter_reply': "✍️ لطفاً پاسخ خود را ارسال کنید:",
             'reply_sent': "✅ پاسخ شما ارسال شد.",
+            'owner_reply_header': "📬 <b>پاسخ از مالک:</b>",
+            'reply_text_only': "⚠️ از اینجا فقط پاسخ متنی ارسال می‌شود؛ برای ارسال عکس، فایل یا استیکر در خود ربات @{} پاسخ دهید.",
             'user_blocked': "✅ کاربر مسدود شد.",
             'user_unblocked': "✅ کاربر آزاد شد.",
+            'sender_blocked': "⛔ شما توسط مالک ربات مسدود شده‌اید.",
+            'owner_unreachable': "⏸ مالک این ربات در حال حاضر پیام‌ها را دریافت نمی‌کند. لطفاً بعداً تلاش کنید.",
+            'owner_unreachable_saved': "⏸ مالک این ربات در حال حاضر در دسترس نیست. پیام شما ذخیره شد و پس از بازگشت او قابل مشاهده است.",
+            'owner_resumed': "▶️ خوش برگشتید! ربات‌های شما دوباره پیام‌ها را برایتان ارسال می‌کنند.\n"
+                             "پیام‌های دریافتی در مدت توقف در /inbox قابل مشاهده است.",
+            'duplicate_counter': "🔁 تکرار: {count} بار از {senders} فرستنده",
+            'overloaded': "⏳ سرویس در حال حاضر شلوغ است. لطفاً چند لحظه بعد تلاش کنید.",
             'bot_deleted': "🗑 ربات حذف شد.",
             'error_occurred': "❌ خطایی رخ داد.",
             'no_permission': "⛔ شما دسترسی ندارید.",
             'user_not_found': "❌ کاربر یافت نشد.",
             'bot_not_found': "❌ ربات یافت نشد.",
             'already_blocked': "⚠️ کاربر قبلاً مسدود شده.",
-            'not_blocked': "⚠️ کاربر مسدود نیست."
+            'not_blocked': "⚠️ کاربر مسدود نیست.",
+            
+            'broadcast_choose_bot': "📣 ربات مورد نظر برای ارسال همگانی را انتخاب کنید:",
+            'broadcast_enter_text': "📣 متن پیام همگانی برای {} فرستنده @{} را ارسال کنید:",
+            'broadcast_no_senders': "⚠️ هنوز کسی به این ربات پیام نداده است.",
+            'broadcast_running': "⚠️ یک ارسال همگانی برای این ربات در حال اجراست.",
+            'broadcast_invalid_text': "⚠️ متن پیام همگانی باید بین 1 و {} کاراکتر باشد.",
+            'broadcast_progress': "📣 ارسال همگانی @{}\n\n"
+                                  "پیشرفت: {}/{}\n"
+                                  "✅ ارسال شده: {}\n"
+                                  "🚫 حذف شده (ربات مسدود شده): {}\n"
+                                  "❌ ناموفق: {}",
+            'broadcast_done': "✅ ارسال همگانی به پایان رسید.",
+            'broadcast_cancelled': "🛑 ارسال همگانی لغو شد.",
+            'broadcast_cancel_btn': "🛑 لغو ارسال",
+            
+            'inbox_title': "📥 <b>صندوق پیام</b>",
+            'inbox_search_title': "🔎 <b>نتایج جستجو:</b> {}",
+            'inbox_empty': "📭 پیامی یافت نشد.",
+            'inbox_disabled': "⚠️ صندوق پیام در این سرویس غیرفعال است.",
+            'inbox_older_btn': "قدیمی‌تر ▶️",
+            'inbox_newest_btn': "🔝 جدیدترین",
+            'search_usage': "🔎 نحوه استفاده: /search متن مورد نظر",
+            
+            'max_bots_reached': "⚠️ به حداکثر تعداد ربات مجاز ({}) رسیده‌اید.",
+            'relay_throttled': "⏳ این ربات در حال حاضر پیام‌های زیادی دریافت می‌کند. لطفاً کمی بعد دوباره تلاش کنید.",
+            
+            'digest_header': "📦 <b>خلاصه پیام‌های ناشناس</b> (@{})\n\n",
+            'digest_on_btn': "📦 حالت خلاصه: روشن",
+            'digest_off_btn': "📦 حالت خلاصه: خاموش",
+            'digest_enabled': "✅ حالت خلاصه فعال شد.",
+            'digest_disabled': "✅ حالت خلاصه غیرفعال شد.",
+            
+            'child_owner_start': "✅ اعلان پیام‌های ناشناس این ربات از این پس همین‌جا برای شما ارسال می‌شود.\n"
+                                 "برای پاسخ، روی پیام reply کنید یا دکمه پاسخ را بزنید.",
+            'child_owner_hint': "ℹ️ برای پاسخ به یک پیام ناشناس، روی همان پیام reply کنید.",
+            
+            'analytics_btn': "📈 آمار ترافیک",
+            'analytics_title': "📈 **آمار ترافیک @{}**\n\n",
+            'analytics_body': (
+                "• پیام‌های ساعت اخیر: {inbound_hour}\n"
+                "• پیام‌های ۲۴ ساعت اخیر: {inbound_day}\n"
+                "• پیام‌های ۷ روز اخیر: {inbound_week}\n"
+                "• فرستندگان یکتای امروز: ~{uniques_day}\n"
+                "• فرستندگان یکتای هفته: ~{uniques_week}\n"
+                "• پاسخ‌های ۲۴ ساعت اخیر: {replies_day}\n"
+                "• مسدودسازی‌های ۲۴ ساعت اخیر: {blocks_day}\n\n"
+                "ترافیک ساعتی (۲۴ ساعت):\n`{sparkline}`"
+            )
         }
     
     def setup_flask_routes(self):
         """تنظیم مسیرهای Flask"""
+        # Flask فقط هنگام ساخت سرویس بارگذاری می‌شود (نه با import main)
+        from flask import Flask, request, jsonify
+        self.app = Flask(__name__)
+        
+        def cached_response(key: str, render: Callable[[Dict[str, Any]], str], mimetype: str):
+            """پاسخ از snapshot آمار با ETag و Cache-Control"""
+            body, etag = self.stats.rendered(key, render)
+            headers = {
+                'ETag': etag,
+                'Cache-Control': f"public, max-age={self.stats_max_age}"
+            }
+            if etag in request.headers.get('If-None-Match', ''):
+                return '', 304, headers
+            headers['Content-Type'] = mimetype
+            return body, 200, headers
         
         @self.app.route('/')
         def index():
-            return """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>ربات چت ناشناس</title>
-                <meta charset="utf-8">
-                <style>
-                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
-                    .container { max-width: 800px; margin: 0 auto; }
-                    h1 { color: #333; }
-                    .status { background: #4CAF50; color: white; padding: 10px; border-radius: 5px; }
-                    .info { background: #f8f9fa; padding: 20px; border-radius: 10px; margin: 20px 0; }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1>🤖 ربات چت ناشناس</h1>
-                    <div class="status">✅ در حال اجرا</div>
-                    <div class="info">
-                        <p>این سرویس برای ربات تلگرام چت ناشناس ایجاد شده است.</p>
-                        <p>ربات اصلی: @{} (با دستور /start شروع کنید)</p>
-                        <p>تعداد ربات‌های فرزند فعال: {}</p>
-                    </div>
-                    <p><a href="https://t.me/{}" target="_blank">شروع گفتگو با ربات</a></p>
-                </div>
-            </body>
-            </html>
-            """.format(
-                (self.bot.get_me() if hasattr(self.bot, 'get_me') else 'ربات'),
-                len(self.child_manager.child_bots),
-                (self.bot.get_me().username if hasattr(self.bot, 'get_me') else '')
-            )
+            return cached_response('status_page', self.render_status_page, 'text/html; charset=utf-8')
         
         @self.app.route('/webhook/master', methods=['POST'])
         def master_webhook():
             """وب هوک ربات مادر"""
             if request.headers.get('content-type') == 'application/json':
-                json_string = request.get_data().decode('utf-8')
-                update = types.Update.de_json(json_string)
+                # پردازش آپدیت روی loop دائمی ربات مادر
+                if self.master_loop is None:
+                    # هنوز آماده نیستیم؛ تلگرام آپدیت را دوباره ارسال می‌کند
+                    return jsonify({"error": "starting"}), 503
+                if self.draining:
+                    # در حال خاموشی؛ آپدیت به نمونه بعدی می‌رسد
+                    return jsonify({"error": "shutting down"}), 503, {'Retry-After': '1'}
+                if not self.admission.try_acquire(MASTER_KEY):
+                    # ظرفیت پر است: پاسخ فوری قابل تکرار بدون خواندن بدنه
+                    return jsonify({"error": "overloaded"}), 503, {'Retry-After': '1'}
                 
-                # پردازش آپدیت
-                asyncio.run(self.process_update(update))
+                json_string = request.get_data().decode('utf-8')
+                try:
+                    update = types.Update.de_json(json_string)
+                except Exception:
+                    self.admission.release(MASTER_KEY)
+                    raise
+                self.submit(self.process_update(update))
                 
                 return jsonify({"status": "ok"}), 200
             return jsonify({"error": "Invalid content type"}), 403
         
+        @self.app.route('/ready', methods=['GET'])
+        def readiness_check():
+            """آمادگی واقعی برای دریافت آپدیت (503 تا پایان راه‌اندازی)"""
+            checks = self.readiness()
+            ready = all(checks.values())
+            return jsonify({
+                "ready": ready,
+                "checks": checks,
+                "startup_ms": self.startup_timings
+            }), 200 if ready else 503
+        
         @self.app.route('/health', methods=['GET'])
         def health_check():
             """بررسی سلامت"""
@@ -322,26 +2181,213 @@ class AnonymousChatBot:
         
         @self.app.route('/api/stats', methods=['GET'])
         def get_stats():
-            """آمار سرویس"""
+            """آمار سرویس (snapshot پیش‌محاسبه شده)"""
+            return cached_response(
+                'stats_json',
+                lambda data: json.dumps(data, ensure_ascii=False, default=str),
+                'application/json'
+            )
+        
+        # توکن فقط از header خوانده می‌شود (نه query string که در لاگ‌ها می‌ماند)
+        def debug_allowed() -> bool:
+            return _token_matches(self.debug_token, request.headers.get('X-Debug-Token'))
+        
+        def admin_allowed() -> bool:
+            return _token_matches(self.admin_token, request.headers.get('X-Admin-Token'))
+        
+        @self.app.route('/api/tenants', methods=['GET'])
+        def get_tenants():
+            """مصرف هر مستاجر (مالک) به تفکیک ربات (ADMIN_TOKEN یا DEBUG_TOKEN)"""
+            if not (admin_allowed() or debug_allowed()):
+                return jsonify({"error": "not found"}), 404
+            tenants: Dict[int, Dict] = {}
+            for bot_username, usage in list(self.tenant_usage.items()):
+                tenant = tenants.setdefault(usage.owner_id, {
+                    'bots': {},
+                    'max_bots': self.quotas.get(usage.owner_id, 'max_bots'),
+                    'relays_per_minute': self.quotas.get(usage.owner_id, 'relays_per_minute'),
+                    'relays_this_minute': self.quotas.relays_this_minute(usage.owner_id)
+                })
+                tenant['bots'][bot_username] = usage.to_dict()
             return jsonify({
-                "total_users": len(self.user_bots),
-                "total_child_bots": len(self.child_manager.child_bots),
-                "blocked_users": len(self.blocked_users),
-                "active_polling_threads": len([t for t in threading.enumerate() if 'bot_' in t.name])
+                'scheduler_queued': self.scheduler.queued(),
+                'tenants': {str(owner_id): data for owner_id, data in tenants.items()}
             }), 200
-    
-    async def process_update(self, update):
-        """پردازش آپدیت دریافتی"""
-        await self.bot.process_new_updates([update])
-    
-    def setup_handlers(self):
-        """تنظیم هندلرهای ربات مادر"""
         
-        @self.bot.message_handler(commands=['start'])
-        async def start_handler(message):
-            """هندلر دستور /start"""
-            user_id = message.from_user.id
-            first_name = message.from_user.first_name or "کاربر"
+        @self.app.route('/api/analytics/<bot_username>', methods=['GET'])
+        def bot_analytics(bot_username):
+            """سری‌های زمانی و تخمین فرستندگان یکتای یک ربات (ADMIN_TOKEN یا DEBUG_TOKEN)"""
+            if not (admin_allowed() or debug_allowed()):
+                return jsonify({"error": "not found"}), 404
+            if bot_username not in self.child_manager.child_bots:
+                return jsonify({"error": "bot not found"}), 404
+            return jsonify({
+                'bot': bot_username,
+                'summary': self.analytics.summary(bot_username),
+                'detail': self.analytics.to_dict(bot_username)
+            }), 200
+        
+        @self.app.route('/api/relay-latency', methods=['GET'])
+        def relay_latency():
+            """تاخیر رله به تفکیک مرحله (میلی‌ثانیه؛ ADMIN_TOKEN یا DEBUG_TOKEN)"""
+            if not (admin_allowed() or debug_allowed()):
+                return jsonify({"error": "not found"}), 404
+            return jsonify(self.tracer.summary()), 200
+        
+        @self.app.route('/api/admin/import-bots', methods=['POST'])
+        def import_bots_api():
+            """ورود دسته‌ای توکن‌ها با گزارش هر توکن"""
+            if not admin_allowed():
+                return jsonify({"error": "not found"}), 404
+            if self.master_loop is None:
+                return jsonify({"error": "starting"}), 503
+            payload = request.get_json(silent=True) or {}
+            tokens = payload.get('tokens')
+            if isinstance(tokens, list):
+                tokens = '\n'.join(map(str, tokens))
+            if not tokens:
+                return jsonify({"error": "tokens required"}), 400
+            owner_id = payload.get('owner_id')
+            report = self.submit(self.import_bots(
+                tokens,
+                owner_id=int(owner_id) if owner_id is not None else None,
+                ignore_quota=bool(payload.get('ignore_quota'))
+            )).result()
+            return jsonify(report), 200
+        
+        @self.app.route('/api/admin/blocklist', methods=['GET', 'POST'])
+        def global_blocklist_api():
+            """فهرست مسدودی سراسری: آمار (GET) یا افزودن/حذف شناسه‌ها (POST)"""
+            if not admin_allowed():
+                return jsonify({"error": "not found"}), 404
+            if request.method == 'POST':
+                if self.master_loop is None:
+                    return jsonify({"error": "starting"}), 503
+                payload = request.get_json(silent=True) or {}
+                try:
+                    add = [int(user_id) for user_id in payload.get('add', [])]
+                    remove = [int(user_id) for user_id in payload.get('remove', [])]
+                except (TypeError, ValueError):
+                    return jsonify({"error": "user ids must be integers"}), 400
+                self.submit(self.update_global_blocklist(add, remove)).result()
+            return jsonify({'enabled': self.global_blocklist, **self.blocklist.stats()}), 200
+        
+        @self.app.route('/debug/loops', methods=['GET'])
+        def debug_loops():
+            """تاخیر هر event loop و هندلرهایی که loop را مسدود کرده‌اند"""
+            if not debug_allowed():
+                return jsonify({"error": "not found"}), 404
+            return jsonify(self.loop_monitor.snapshot()), 200
+        
+        @self.app.route('/debug/profile', methods=['GET'])
+        def debug_profile():
+            """پروفایل نمونه‌برداری N ثانیه‌ای (collapsed stacks برای flamegraph)"""
+            if not debug_allowed():
+                return jsonify({"error": "not found"}), 404
+            seconds = min(max(request.args.get('seconds', 5, type=float), 0.1), 60)
+            interval = max(request.args.get('interval_ms', 5, type=float), 1) / 1000
+            include_idle = request.args.get('idle') == '1'
+            stacks = sample_profile(seconds, interval, include_idle=include_idle)
+            return stacks, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        
+        @self.app.route('/debug/memory', methods=['GET'])
+        def debug_memory():
+            """اندازه تقریبی ساختارهای وضعیت، کلاینت‌ها و threadها"""
+            if not debug_allowed():
+                return jsonify({"error": "not found"}), 404
+            sample = min(max(request.args.get('clients', 20, type=int), 0), 500)
+            return jsonify(self.memory_report(client_sample=sample)), 200
+        
+        @self.app.route('/debug/memory/snapshot', methods=['POST', 'DELETE'])
+        def debug_memory_snapshot():
+            """snapshot تازه tracemalloc (POST) یا خاموش کردن tracemalloc (DELETE)"""
+            if not debug_allowed():
+                return jsonify({"error": "not found"}), 404
+            if request.method == 'DELETE':
+                self.memory_tracker.stop()
+                return jsonify(self.memory_tracker.status()), 200
+            group = request.args.get('group', 'module')
+            limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+            return jsonify(self.memory_tracker.snapshot(group, limit)), 200
+        
+        @self.app.route('/debug/memory/diff', methods=['GET'])
+        def debug_memory_diff():
+            """رشد تخصیص‌ها از snapshot پایه تا snapshot مقصد (یا همین لحظه)"""
+            if not debug_allowed():
+                return jsonify({"error": "not found"}), 404
+            base = request.args.get('base', type=int)
+            if base is None:
+                return jsonify({"error": "base snapshot id required"}), 400
+            diff = self.memory_tracker.diff(
+                base,
+                target_id=request.args.get('target', type=int),
+                group=request.args.get('group', 'module'),
+                limit=min(max(request.args.get('limit', 20, type=int), 1), 200)
+            )
+            if diff is None:
+                return jsonify({"error": "unknown snapshot", **self.memory_tracker.status()}), 404
+            return jsonify(diff), 200
+    
+    def render_status_page(self, data: Dict[str, Any]) -> str:
+        """صفحه وضعیت HTML از snapshot آمار"""
+        username = html.escape(data.get('master_username') or '')
+        return """
+            <!DOCTYPE html>
+            <html>
+            <head>
+                <title>ربات چت ناشناس</title>
+                <meta charset="utf-8">
+                <style>
+                    body {{ font-family: Arial, sans-serif; text-align: center; padding: 50px; }}
+                    .container {{ max-width: 800px; margin: 0 auto; }}
+                    h1 {{ color: #333; }}
+                    .status {{ background: #4CAF50; color: white; padding: 10px; border-radius: 5px; }}
+                    .info {{ background: #f8f9fa; padding: 20px; border-radius: 10px; margin: 20px 0; }}
+                </style>
+            </head>
+            <body>
+                <div class="container">
+                    <h1>🤖 ربات چت ناشناس</h1>
+                    <div class="status">✅ در حال اجرا</div>
+                    <div class="info">
+                        <p>این سرویس برای ربات تلگرام چت ناشناس ایجاد شده است.</p>
+                        <p>ربات اصلی: @{} (با دستور /start شروع کنید)</p>
+                        <p>تعداد ربات‌های فرزند فعال: {}</p>
+                    </div>
+                    <p><a href="https://t.me/{}" target="_blank">شروع گفتگو با ربات</a></p>
+                </div>
+            </body>
+            </html>
+            """.format(username or 'ربات', data.get('total_child_bots', 0), username)
+    
+    def render_stats_text(self, data: Dict[str, Any]) -> str:
+        """متن دستور /stats از snapshot آمار"""
+        stats_text = "📊 **آمار سیستم:**\n\n"
+        stats_text += f"تعداد کاربران: {data.get('total_users', 0)}\n"
+        stats_text += f"تعداد ربات‌های فرزند: {data.get('total_child_bots', 0)}\n"
+        stats_text += f"ربات‌های در حال polling: {data.get('active_polling_bots', 0)}\n"
+        stats_text += f"کاربران مسدود شده: {data.get('blocked_users', 0)}\n"
+        stats_text += f"پیام‌های دریافتی: {data.get('messages_received', 0)}\n"
+        stats_text += f"پاسخ‌های ارسال شده: {data.get('replies_sent', 0)}\n"
+        stats_text += f"Thread های فعال: {data.get('threads', 0)}\n"
+        return stats_text
+    
+    async def process_update(self, update):
+        """پردازش آپدیت دریافتی (ظرفیت آن در مسیر webhook رزرو شده است)"""
+        context = bind_log_context(update=update.update_id)
+        try:
+            await self.bot.process_new_updates([update])
+        finally:
+            reset_log_context(context)
+    
+    def setup_handlers(self):
+        """تنظیم هندلرهای ربات مادر"""
+        
+        @self.bot.message_handler(commands=['start'])
+        async def start_handler(message):
+            """هندلر دستور /start"""
+            user_id = message.from_user.id
+            first_name = message.from_user.first_name or "کاربر"
             
             welcome_msg = f"سلام {first_name}!\n\n"
             welcome_msg += self.render_config['welcome_message']
@@ -360,9 +2406,24 @@ class AnonymousChatBot:
                 parse_mode='Markdown'
             )
             
+            # مالکی که ربات مادر را آزاد کرده است: ادامه رله ربات‌هایش
+            if await self.mark_owner_reachable(user_id):
+                await self.bot.send_message(message.chat.id, self.render_config['owner_resumed'])
+            
             # پاک کردن مرحله قبلی
             self.step_manager.clear_step(user_id)
         
+        @self.bot.my_chat_member_handler()
+        async def my_chat_member_handler(update):
+            """مسدود/آزاد شدن ربات مادر توسط کاربر در چت خصوصی"""
+            if update.chat.type != 'private':
+                return
+            status = update.new_chat_member.status
+            if status == 'kicked':
+                await self.mark_owner_unreachable(update.from_user.id)
+            elif status == 'member':
+                await self.mark_owner_reachable(update.from_user.id)
+        
         @self.bot.message_handler(commands=['addbot', 'newbot'])
         async def add_bot_handler(message):
             """هندلر افزودن ربات جدید"""
@@ -390,36 +2451,15 @@ class AnonymousChatBot:
             """هندلر مشاهده ربات‌های کاربر"""
             user_id = message.from_user.id
             
-            if user_id not in self.user_bots or not self.user_bots[user_id]:
+            rendered = self.render_bot_list_page(user_id, 0)
+            if not rendered:
                 await self.bot.send_message(
                     message.chat.id,
                     self.render_config['no_bots_found']
                 )
                 return
             
-            bot_list = self.render_config['bot_list']
-            user_bots_info = self.user_bots[user_id]
-            
-            for idx, bot_info in enumerate(user_bots_info, 1):
-                username = bot_info.get('username', 'نامشخص')
-                status = "✅ فعال" if bot_info.get('active', True) else "❌ غیرفعال"
-                created = bot_info.get('created_at', 'نامشخص')
-                
-                bot_list += f"**{idx}. @{username}**\n"
-                bot_list += f"   وضعیت: {status}\n"
-                bot_list += f"   ایجاد: {created}\n\n"
-            
-            # ایجاد اینلاین کیبورد برای مدیریت
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            
-            for idx, bot_info in enumerate(user_bots_info, 1):
-                username = bot_info['username']
-                btn = types.InlineKeyboardButton(
-                    f"@{username}",
-                    callback_data=f"manage_{username}"
-                )
-                markup.add(btn)
-            
+            bot_list, markup = rendered
             await self.bot.send_message(
                 message.chat.id,
                 bot_list,
@@ -445,11 +2485,7 @@ class AnonymousChatBot:
             # if user_id != YOUR_USER_ID:  # می‌توانید ID خود را اینجا قرار دهید
             #     return
             
-            stats_text = "📊 **آمار سیستم:**\n\n"
-            stats_text += f"تعداد کاربران: {len(self.user_bots)}\n"
-            stats_text += f"تعداد ربات‌های فرزند: {len(self.child_manager.child_bots)}\n"
-            stats_text += f"کاربران مسدود شده: {len(self.blocked_users)}\n"
-            stats_text += f"Thread های فعال: {threading.active_count()}\n"
+            stats_text, _ = self.stats.rendered('stats_command', self.render_stats_text)
             
             await self.bot.send_message(
                 message.chat.id,
@@ -457,6 +2493,50 @@ class AnonymousChatBot:
                 parse_mode='Markdown'
             )
         
+        @self.bot.message_handler(commands=['inbox'])
+        async def inbox_handler(message):
+            """هندلر مرور صندوق پیام (اختیاری: /inbox @bot)"""
+            args = message.text.split(maxsplit=1)
+            bot_username = args[1].strip().lstrip('@') if len(args) > 1 else None
+            await self.show_inbox(message.from_user.id, None, bot_username)
+        
+        @self.bot.message_handler(commands=['search'])
+        async def search_handler(message):
+            """هندلر جستجو در صندوق پیام"""
+            args = message.text.split(maxsplit=1)
+            if len(args) < 2 or not args[1].strip():
+                await self.bot.send_message(message.chat.id, self.render_config['search_usage'])
+                return
+            await self.show_inbox(message.from_user.id, args[1].strip(), None)
+        
+        @self.bot.message_handler(commands=['broadcast'])
+        async def broadcast_handler(message):
+            """هندلر ارسال همگانی به فرستندگان ربات"""
+            user_id = message.from_user.id
+            user_bots_info = self.user_bots.get(user_id, [])
+            
+            if not user_bots_info:
+                await self.bot.send_message(message.chat.id, self.render_config['no_bots_found'])
+                return
+            
+            if len(user_bots_info) == 1:
+                await self.prompt_broadcast_text(user_id, user_bots_info[0].username)
+                return
+            
+            markup = types.InlineKeyboardMarkup(row_width=1)
+            for bot_info in user_bots_info:
+                username = bot_info.username
+                markup.add(types.InlineKeyboardButton(
+                    f"@{username} ({self.sender_index.count(username)})",
+                    callback_data=f"bcast_{username}"
+                ))
+            
+            await self.bot.send_message(
+                message.chat.id,
+                self.render_config['broadcast_choose_bot'],
+                reply_markup=markup
+            )
+        
         @self.bot.message_handler(func=lambda message: True)
         async def text_handler(message):
             """هندلر پیام‌های متنی"""
@@ -464,6 +2544,14 @@ class AnonymousChatBot:
             text = message.text
             chat_id = message.chat.id
             
+            # پاسخ مستقیم (reply-to) به یک پیام ناشناس رله‌شده
+            if message.reply_to_message is not None:
+                target = self.reply_index.get(chat_id, message.reply_to_message.message_id)
+                if target:
+                    target_user_id, bot_username = target
+                    await self.process_reply_step(message, target_user_id, bot_username, confirm=False)
+                    return
+            
             # بررسی مرحله کاربر
             current_step = self.step_manager.get_step(user_id)
             
@@ -482,6 +2570,14 @@ class AnonymousChatBot:
                 self.step_manager.clear_step(user_id)
                 return
             
+            elif current_step == 'awaiting_broadcast':
+                # شروع ارسال همگانی با متن دریافتی
+                bot_username = self.step_manager.get_data(user_id, 'bot_username')
+                self.step_manager.clear_step(user_id)
+                if bot_username:
+                    await self.start_broadcast(user_id, bot_username, text)
+                return
+            
             # پردازش دکمه‌های کیبورد
             if text == "➕ ساخت ربات جدید" or text == "ربات جدید":
                 await add_bot_handler(message)
@@ -526,20 +2622,29 @@ class AnonymousChatBot:
             self.step_manager.clear_step(user_id)
             return
         
+        # بررسی سهمیه تعداد ربات‌های مالک
+        max_bots = self.quotas.get(user_id, 'max_bots')
+        if len(self.user_bots.get(user_id, [])) >= max_bots:
+            await self.bot.edit_message_text(
+                self.render_config['max_bots_reached'].format(max_bots),
+                chat_id,
+                processing_msg.message_id
+            )
+            self.step_manager.clear_step(user_id)
+            return
+        
         try:
             # ایجاد ربات جدید با توکن کاربر
-            user_bot = AsyncTeleBot(token)
+            user_bot = AdmittedTeleBot(token, admission=self.admission)
             
             # بررسی صحت توکن
             bot_info = await user_bot.get_me()
             bot_username = bot_info.username
+            user_bot.ingress_key = bot_username
             
             # بررسی اینکه ربات قبلاً ساخته نشده باشد
-            if user_id not in self.user_bots:
-                self.user_bots[user_id] = []
-            
-            for existing_bot in self.user_bots[user_id]:
-                if existing_bot.get('username') == bot_username:
+            for existing_bot in self.user_bots.get(user_id, []):
+                if existing_bot.username == bot_username:
                     await self.bot.edit_message_text(
                         f"⚠️ ربات @{bot_username} قبلاً اضافه شده است.",
                         chat_id,
@@ -549,23 +2654,32 @@ class AnonymousChatBot:
                     return
             
             # ذخیره اطلاعات ربات
-            bot_data = {
-                'bot_instance': user_bot,
-                'token': token[:10] + '...',  # فقط بخشی از توکن ذخیره شود
-                'username': bot_username,
-                'owner_id': user_id,
-                'active': True,
-                'created_at': datetime.now().strftime('%Y/%m/%d %H:%M'),
-                'full_token': token  # ذخیره کامل توکن برای استفاده
-            }
-            
-            self.user_bots[user_id].append(bot_data)
+            bot_data = BotRecord(
+                username=bot_username,
+                owner_id=user_id,
+                token=token,
+                bot_id=bot_info.id,
+                client=user_bot
+            )
             
-            # راه‌اندازی ربات فرزند
-            await self.setup_user_bot(bot_data)
+            # همگام‌سازی دوره‌ای تا اضافه شدن به مدیر ربات‌ها این ربات را
+            # نادیده می‌گیرد (وگرنه رکورد ذخیره شده دوباره ثبت و poll می‌شود)
+            self._pending_bots.add(bot_username)
+            try:
+                self._register_owner_bot(bot_data)
+                self.stats.incr('bots_created')
+                await self.store.save_bot(bot_data.to_dict())
+                
+                # راه‌اندازی ربات فرزند
+                await self.setup_user_bot(bot_data)
+                
+                # اضافه کردن به مدیر ربات‌های فرزند برای polling
+                self.child_manager.add_bot(bot_data)
+            finally:
+                self._pending_bots.discard(bot_username)
             
-            # اضافه کردن به مدیر ربات‌های فرزند برای polling
-            self.child_manager.add_bot(bot_data)
+            # ادامه ارسال همگانی نیمه‌تمام (در صورت وجود)
+            await self.resume_broadcast(bot_username)
             
             # پیام موفقیت
             success_msg = self.render_config['bot_added_success'].format(bot_username)
@@ -593,10 +2707,10 @@ class AnonymousChatBot:
                 
                 await user_bot.send_message(user_id, test_msg, parse_mode='Markdown')
             except Exception as e:
-                logger.warning(f"نتوانستم پیام تست به مالک ارسال کنم: {e}")
+                logger.warning("نتوانستم پیام تست به مالک ارسال کنم: %s", e)
             
         except Exception as e:
-            logger.error(f"خطا در ایجاد ربات کاربر: {e}")
+            logger.error("خطا در ایجاد ربات کاربر: %s", e)
             error_msg = f"❌ **خطا در ایجاد ربات:**\n\n{str(e)[:200]}"
             
             if "409" in str(e):
@@ -620,111 +2734,32 @@ class AnonymousChatBot:
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('reply_'))
         async def reply_callback_handler(call):
             """هندلر پاسخ به پیام"""
-            try:
-                data_parts = call.data.split('_')
-                if len(data_parts) < 3:
-                    await self.bot.answer_callback_query(call.id, "خطا در پردازش")
-                    return
-                
-                target_user_id = int(data_parts[1])
-                bot_username = data_parts[2]
-                
-                await self.bot.answer_callback_query(call.id, "آماده دریافت پاسخ...")
-                
-                # تنظیم مرحله برای دریافت پاسخ
-                self.step_manager.set_step(
-                    call.from_user.id,
-                    'awaiting_reply',
-                    {
-                        'target_user_id': target_user_id,
-                        'bot_username': bot_username
-                    }
-                )
-                
-                # درخواست پاسخ
-                await self.bot.send_message(
-                    call.from_user.id,
-                    f"✍️ **پاسخ به کاربر با آیدی {target_user_id}**\n\n"
-                    "لطفاً پاسخ خود را ارسال کنید:",
-                    parse_mode='Markdown'
-                )
-                
-            except Exception as e:
-                logger.error(f"خطا در reply callback: {e}")
-                await self.bot.answer_callback_query(call.id, "خطا!")
+            await self.owner_reply_callback(self.bot, call)
         
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('block_'))
         async def block_callback_handler(call):
             """هندلر مسدود کردن کاربر"""
-            try:
-                data_parts = call.data.split('_')
-                if len(data_parts) < 3:
-                    await self.bot.answer_callback_query(call.id, "خطا")
-                    return
-                
-                target_user_id = int(data_parts[1])
-                bot_username = data_parts[2]
-                owner_id = call.from_user.id
-                
-                # بررسی مالکیت
-                user_bots = self.user_bots.get(owner_id, [])
-                user_has_bot = any(bot['username'] == bot_username for bot in user_bots)
-                
-                if not user_has_bot:
-                    await self.bot.answer_callback_query(call.id, self.render_config['no_permission'])
-                    return
-                
-                # مسدود کردن کاربر
-                self.blocked_users.add((target_user_id, bot_username))
-                
-                await self.bot.answer_callback_query(call.id, self.render_config['user_blocked'])
-                
-                # اطلاع به مالک
-                await self.bot.send_message(
-                    owner_id,
-                    f"✅ کاربر با آیدی `{target_user_id}` در ربات @{bot_username} مسدود شد.",
-                    parse_mode='Markdown'
-                )
-                
-            except Exception as e:
-                logger.error(f"خطا در block callback: {e}")
-                await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
+            await self.owner_block_callback(self.bot, call, block=True)
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('inboxpg_'))
+        async def inbox_page_callback(call):
+            """صفحه بعد صندوق پیام یا جستجو (cursor صفر یعنی جدیدترین)"""
+            owner_id = call.from_user.id
+            cursor = int(call.data[len('inboxpg_'):] or 0)
+            query, bot_username = self.inbox_queries.get(owner_id, (None, None))
+            await self.bot.answer_callback_query(call.id)
+            await self.show_inbox(owner_id, query, bot_username, before=cursor or None,
+                                  edit_message_id=call.message.message_id)
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('blockall_'))
+        async def block_all_callback_handler(call):
+            """هندلر مسدود کردن کاربر در همه ربات‌های مالک"""
+            await self.owner_block_callback(self.bot, call, block=True, everywhere=True)
         
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('unblock_'))
         async def unblock_callback_handler(call):
             """هندلر آزاد کردن کاربر"""
-            try:
-                data_parts = call.data.split('_')
-                if len(data_parts) < 3:
-                    await self.bot.answer_callback_query(call.id, "خطا")
-                    return
-                
-                target_user_id = int(data_parts[1])
-                bot_username = data_parts[2]
-                owner_id = call.from_user.id
-                
-                # بررسی مالکیت
-                user_bots = self.user_bots.get(owner_id, [])
-                user_has_bot = any(bot['username'] == bot_username for bot in user_bots)
-                
-                if not user_has_bot:
-                    await self.bot.answer_callback_query(call.id, self.render_config['no_permission'])
-                    return
-                
-                # آزاد کردن کاربر
-                self.blocked_users.discard((target_user_id, bot_username))
-                
-                await self.bot.answer_callback_query(call.id, self.render_config['user_unblocked'])
-                
-                await self.bot.send_message(
-                    owner_id,
-                    f"✅ کاربر با آیدی `{target_user_id}` در ربات @{bot_username} آزاد شد.",
-                    parse_mode='Markdown'
-                )
-                
-            except Exception as e:
-                logger.error(f"خطا در unblock callback: {e}")
-                await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
+            await self.owner_block_callback(self.bot, call, block=False)
         
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('delete_'))
         async def delete_bot_callback_handler(call):
@@ -738,21 +2773,15 @@ class AnonymousChatBot:
                 bot_username = data_parts[1]
                 owner_id = call.from_user.id
                 
-                # حذف ربات از لیست کاربر
-                if owner_id in self.user_bots:
-                    self.user_bots[owner_id] = [
-                        bot for bot in self.user_bots[owner_id] 
-                        if bot.get('username') != bot_username
-                    ]
-                
-                # حذف از مدیر ربات‌های فرزند
-                self.child_manager.remove_bot(bot_username)
-                
-                # حذف کاربران مسدود شده مرتبط
-                self.blocked_users = {
-                    (uid, uname) for (uid, uname) in self.blocked_users 
-                    if uname != bot_username
-                }
+                # حذف ربات از لیست کاربر، مدیر ربات‌های فرزند و ذخیره‌سازی
+                # (همگام‌سازی دوره‌ای تا پایان حذف این ربات را نادیده می‌گیرد)
+                self._pending_bots.add(bot_username)
+                try:
+                    self.forget_bot(owner_id, bot_username)
+                    await self.store.delete_bot(bot_username)
+                finally:
+                    self._pending_bots.discard(bot_username)
+                self.stats.incr('bots_deleted')
                 
                 await self.bot.answer_callback_query(call.id, self.render_config['bot_deleted'])
                 
@@ -763,14 +2792,14 @@ class AnonymousChatBot:
                 )
                 
             except Exception as e:
-                logger.error(f"خطا در delete callback: {e}")
+                logger.error("خطا در delete callback: %s", e)
                 await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
         
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('manage_'))
         async def manage_bot_callback_handler(call):
             """هندلر مدیریت ربات"""
             try:
-                bot_username = call.data.split('_')[1]
+                bot_username = call.data[len('manage_'):]
                 owner_id = call.from_user.id
                 
                 # بررسی مالکیت
@@ -778,7 +2807,7 @@ class AnonymousChatBot:
                 target_bot = None
                 
                 for bot in user_bots:
-                    if bot['username'] == bot_username:
+                    if bot.username == bot_username:
                         target_bot = bot
                         break
                 
@@ -803,15 +2832,28 @@ class AnonymousChatBot:
                 
                 back_btn = types.InlineKeyboardButton(
                     self.render_config['back_btn'],
-                    callback_data="back_to_list"
+                    callback_data=f"botspage_{self.bot_pages.page_of(user_bots.index(target_bot))}"
+                )
+                
+                digest_btn = types.InlineKeyboardButton(
+                    self.render_config['digest_on_btn'] if target_bot.digest_enabled
+                    else self.render_config['digest_off_btn'],
+                    callback_data=f"digest_{bot_username}"
+                )
+                
+                analytics_btn = types.InlineKeyboardButton(
+                    self.render_config['analytics_btn'],
+                    callback_data=f"analytics_{bot_username}"
                 )
                 
                 markup.add(delete_btn, test_msg_btn)
+                markup.add(digest_btn)
+                markup.add(analytics_btn)
                 markup.add(back_btn)
                 
                 info_text = f"⚙️ **مدیریت ربات @{bot_username}**\n\n"
-                info_text += f"• وضعیت: {'فعال ✅' if target_bot.get('active', True) else 'غیرفعال ❌'}\n"
-                info_text += f"• تاریخ ایجاد: {target_bot.get('created_at', 'نامشخص')}\n"
+                info_text += f"• وضعیت: {'فعال ✅' if target_bot.active else 'غیرفعال ❌'}\n"
+                info_text += f"• تاریخ ایجاد: {target_bot.created_at_text}\n"
                 info_text += f"• کاربران مسدود شده: {len([u for u in self.blocked_users if u[1] == bot_username])}\n\n"
                 info_text += "**گزینه‌های مدیریت:**"
                 
@@ -826,14 +2868,127 @@ class AnonymousChatBot:
                 await self.bot.answer_callback_query(call.id, "منوی مدیریت")
                 
             except Exception as e:
-                logger.error(f"خطا در manage callback: {e}")
+                logger.error("خطا در manage callback: %s", e)
                 await self.bot.answer_callback_query(call.id, "خطا!")
         
-        @self.bot.callback_query_handler(func=lambda call: call.data == 'back_to_list')
-        async def back_to_list_handler(call):
-            """بازگشت به لیست ربات‌ها"""
-            await my_bots_handler(call.message)
-            await self.bot.answer_callback_query(call.id, "بازگشت")
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('digest_'))
+        async def digest_toggle_handler(call):
+            """روشن/خاموش کردن حالت خلاصه"""
+            try:
+                bot_username = call.data[len('digest_'):]
+                owner_id = call.from_user.id
+                
+                target_bot = None
+                for bot in self.user_bots.get(owner_id, []):
+                    if bot.username == bot_username:
+                        target_bot = bot
+                        break
+                
+                if not target_bot:
+                    await self.bot.answer_callback_query(call.id, self.render_config['bot_not_found'])
+                    return
+                
+                target_bot.digest_enabled = not target_bot.digest_enabled
+                self.bot_pages.invalidate(owner_id)
+                await self.store.save_bot(target_bot.to_dict())
+                if not target_bot.digest_enabled:
+                    self.digest.forget(bot_username)
+                
+                await self.bot.answer_callback_query(
+                    call.id,
+                    self.render_config['digest_enabled'] if target_bot.digest_enabled
+                    else self.render_config['digest_disabled']
+                )
+                
+                # به‌روزرسانی منوی مدیریت
+                call.data = f"manage_{bot_username}"
+                await manage_bot_callback_handler(call)
+                
+            except Exception as e:
+                logger.error("خطا در digest callback: %s", e)
+                await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('bcast_'))
+        async def broadcast_bot_callback_handler(call):
+            """انتخاب ربات برای ارسال همگانی"""
+            await self.bot.answer_callback_query(call.id)
+            await self.prompt_broadcast_text(call.from_user.id, call.data[len('bcast_'):])
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('bcastcancel_'))
+        async def broadcast_cancel_callback_handler(call):
+            """لغو ارسال همگانی"""
+            job = self.broadcast_jobs.get(call.data[len('bcastcancel_'):])
+            if not job or job.owner_id != call.from_user.id:
+                await self.bot.answer_callback_query(call.id, self.render_config['no_permission'])
+                return
+            job.cancelled = True
+            await self.bot.answer_callback_query(call.id, self.render_config['broadcast_cancelled'])
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('analytics_'))
+        async def analytics_callback_handler(call):
+            """نمایش آمار ترافیک یک ربات"""
+            try:
+                bot_username = call.data[len('analytics_'):]
+                if not self._find_owner_bot(call.from_user.id, bot_username):
+                    await self.bot.answer_callback_query(call.id, self.render_config['bot_not_found'])
+                    return
+                
+                summary = self.analytics.summary(bot_username)
+                text = self.render_config['analytics_title'].format(bot_username)
+                text += self.render_config['analytics_body'].format(
+                    sparkline=sparkline(summary['hourly']), **summary
+                )
+                
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton(
+                    self.render_config['back_btn'],
+                    callback_data=f"manage_{bot_username}"
+                ))
+                
+                await self.bot.edit_message_text(
+                    text,
+                    call.message.chat.id,
+                    call.message.message_id,
+                    reply_markup=markup,
+                    parse_mode='Markdown'
+                )
+                await self.bot.answer_callback_query(call.id)
+                
+            except Exception as e:
+                logger.error("خطا در analytics callback: %s", e)
+                await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
+        
+        @self.bot.callback_query_handler(
+            func=lambda call: call.data == 'back_to_list' or call.data.startswith('botspage_')
+        )
+        async def bot_list_page_handler(call):
+            """نمایش یک صفحه از فهرست ربات‌ها (بازگشت و قبلی/بعدی)"""
+            try:
+                page = int(call.data[len('botspage_'):]) if call.data.startswith('botspage_') else 0
+                rendered = self.render_bot_list_page(call.from_user.id, page)
+                if not rendered:
+                    await self.bot.edit_message_text(
+                        self.render_config['no_bots_found'],
+                        call.message.chat.id,
+                        call.message.message_id
+                    )
+                else:
+                    bot_list, markup = rendered
+                    await self.bot.edit_message_text(
+                        bot_list,
+                        call.message.chat.id,
+                        call.message.message_id,
+                        reply_markup=markup,
+                        parse_mode='Markdown'
+                    )
+                await self.bot.answer_callback_query(call.id)
+            except Exception as e:
+                logger.error("خطا در نمایش صفحه ربات‌ها: %s", e)
+                await self.bot.answer_callback_query(call.id, self.render_config['error_occurred'])
+        
+        @self.bot.callback_query_handler(func=lambda call: call.data == 'noop')
+        async def noop_callback_handler(call):
+            await self.bot.answer_callback_query(call.id)
         
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('test_'))
         async def test_message_handler(call):
@@ -847,16 +3002,20 @@ class AnonymousChatBot:
                 target_bot_data = None
                 
                 for bot in user_bots:
-                    if bot['username'] == bot_username:
+                    if bot.username == bot_username:
                         target_bot_data = bot
                         break
                 
-                if not target_bot_data or 'full_token' not in target_bot_data:
+                if not target_bot_data:
                     await self.bot.answer_callback_query(call.id, "ربات یافت نشد")
                     return
                 
+                if self.admission.should_shed('test'):
+                    await self.bot.answer_callback_query(call.id, self.render_config['overloaded'])
+                    return
+                
                 # ایجاد ربات موقت برای ارسال پیام
-                test_bot = AsyncTeleBot(target_bot_data['full_token'])
+                test_bot = AsyncTeleBot(target_bot_data.token)
                 
                 test_msg = "✅ **پیام تست از ربات شما**\n\n"
                 test_msg += "این پیام نشان می‌دهد که ربات شما به درستی کار می‌کند.\n"
@@ -867,168 +3026,994 @@ class AnonymousChatBot:
                 await self.bot.answer_callback_query(call.id, "پیام تست ارسال شد")
                 
             except Exception as e:
-                logger.error(f"خطا در ارسال پیام تست: {e}")
+                logger.error("خطا در ارسال پیام تست: %s", e)
                 await self.bot.answer_callback_query(call.id, f"خطا: {str(e)[:50]}")
     
-    async def process_reply_step(self, message, target_user_id: int, bot_username: str):
-        """پردازش پاسخ به کاربر"""
-        owner_id = message.from_user.id
-        
-        # پیدا کردن ربات مربوطه
-        user_bots = self.user_bots.get(owner_id, [])
-        target_bot_data = None
-        
-        for bot_data in user_bots:
-            if bot_data['username'] == bot_username:
-                target_bot_data = bot_data
-                break
-        
-        if not target_bot_data or 'full_token' not in target_bot_data:
-            await self.bot.send_message(
-                owner_id,
-                self.render_config['bot_not_found']
-            )
-            return
+    async def owner_reply_callback(self, via: AsyncTeleBot, call):
+        """
+        دکمه پاسخ روی اعلان رله‌شده
         
+        Args:
+            via: رباتی که callback را دریافت کرده (ربات مادر یا ربات فرزند)
+        """
         try:
-            # ایجاد ربات موقت برای ارسال پاسخ
-            reply_bot = AsyncTeleBot(target_bot_data['full_token'])
-            
-            # بررسی مسدود بودن
-            if (target_user_id, bot_username) in self.blocked_users:
-                await self.bot.send_message(
-                    owner_id,
-                    "⚠️ این کاربر مسدود شده است. ابتدا کاربر را آزاد کنید."
-                )
+            data_parts = call.data.split('_', 2)
+            if len(data_parts) < 3:
+                await via.answer_callback_query(call.id, "خطا در پردازش")
                 return
             
-            # ارسال پاسخ
-            reply_text = f"📬 **پاسخ از مالک:**\n\n{message.text}"
+            target_user_id = int(data_parts[1])
+            bot_username = data_parts[2]
             
-            await reply_bot.send_message(
-                target_user_id,
-                reply_text,
-                parse_mode='Markdown'
-            )
+            await via.answer_callback_query(call.id, "آماده دریافت پاسخ...")
             
-            await self.bot.send_message(
-                owner_id,
-                self.render_config['reply_sent']
+            # تنظیم مرحله برای دریافت پاسخ
+            self.step_manager.set_step(
+                call.from_user.id,
+                'awaiting_reply',
+                {
+                    'target_user_id': target_user_id,
+                    'bot_username': bot_username
+                }
             )
             
-        except Exception as e:
-            logger.error(f"خطا در ارسال پاسخ: {e}")
-            error_msg = f"❌ **خطا در ارسال پاسخ:**\n\n"
-            
-            if "bot was blocked" in str(e).lower():
-                error_msg += "کاربر ربات را مسدود کرده است."
-            elif "user not found" in str(e).lower():
-                error_msg += "کاربر یافت نشد."
-            else:
-                error_msg += str(e)[:100]
-            
-            await self.bot.send_message(
-                owner_id,
-                error_msg,
+            # درخواست پاسخ
+            await via.send_message(
+                call.from_user.id,
+                f"✍️ **پاسخ به کاربر با آیدی {target_user_id}**\n\n"
+                "لطفاً پاسخ خود را ارسال کنید:",
                 parse_mode='Markdown'
             )
+            
+        except Exception as e:
+            logger.error("خطا در reply callback: %s", e)
+            await via.answer_callback_query(call.id, "خطا!")
     
-    async def setup_user_bot(self, bot_data: Dict):
-        """راه‌اندازی و تنظیم ربات کاربر"""
-        user_bot = bot_data['bot_instance']
-        owner_id = bot_data['owner_id']
-        bot_username = bot_data['username']
-        full_token = bot_data['full_token']
+    async def owner_block_callback(self, via: AsyncTeleBot, call, block: bool, everywhere: bool = False):
+        """
+        دکمه مسدود/آزاد کردن فرستنده روی اعلان رله‌شده
+        
+        Args:
+            everywhere: مسدود کردن فرستنده در همه ربات‌های این مالک؛ آزاد
+                کردن همیشه هر دو مسدودی (این ربات و همه ربات‌ها) را برمی‌دارد.
+        """
+        try:
+            data_parts = call.data.split('_', 2)
+            if len(data_parts) < 3:
+                await via.answer_callback_query(call.id, "خطا")
+                return
+            
+            target_user_id = int(data_parts[1])
+            bot_username = data_parts[2]
+            owner_id = call.from_user.id
+            
+            # بررسی مالکیت
+            if not self._find_owner_bot(owner_id, bot_username):
+                await via.answer_callback_query(call.id, self.render_config['no_permission'])
+                return
+            
+            where = f"ربات @{bot_username}"
+            if block and everywhere:
+                # مسدود کردن کاربر در همه ربات‌های مالک
+                if self.blocklist.add(target_user_id, owner_id):
+                    await self.store.add_scoped_blocks([(owner_id, target_user_id)])
+                self.analytics.record(bot_username, 'blocks')
+                await via.answer_callback_query(call.id, self.render_config['user_blocked'])
+                done = "مسدود"
+                where = "همه ربات‌های شما"
+            elif block:
+                # مسدود کردن کاربر
+                self.blocked_users.add((target_user_id, bot_username))
+                await self.store.add_block(target_user_id, bot_username)
+                self.analytics.record(bot_username, 'blocks')
+                await via.answer_callback_query(call.id, self.render_config['user_blocked'])
+                done = "مسدود"
+            else:
+                # آزاد کردن کاربر
+                self.blocked_users.discard((target_user_id, bot_username))
+                await self.store.remove_block(target_user_id, bot_username)
+                if self.blocklist.discard(target_user_id, owner_id):
+                    await self.store.remove_scoped_blocks([(owner_id, target_user_id)])
+                    where = "همه ربات‌های شما"
+                await via.answer_callback_query(call.id, self.render_config['user_unblocked'])
+                done = "آزاد"
+            
+            # اطلاع به مالک
+            await via.send_message(
+                owner_id,
+                f"✅ کاربر با آیدی `{target_user_id}` در {where} {done} شد.",
+                parse_mode='Markdown'
+            )
+            
+        except Exception as e:
+            logger.error("خطا در %s callback: %s", 'block' if block else 'unblock', e)
+            await via.answer_callback_query(call.id, self.render_config['error_occurred'])
+    
+    async def handle_owner_in_child(self, bot_data: BotRecord, message):
+        """
+        پیام مالک به ربات فرزند خودش
+        
+        start کردن ربات یعنی اعلان‌ها می‌توانند از طریق همین ربات ارسال
+        شوند. پاسخ (reply-to یا پس از دکمه پاسخ) مستقیماً به فرستنده ناشناس
+        می‌رود و پیام مالک هرگز به خودش رله نمی‌شود.
+        """
+        user_bot = bot_data.client
+        owner_id = bot_data.owner_id
+        
+        if not bot_data.owner_via_child:
+            bot_data.owner_via_child = True
+            await self.store.save_bot(bot_data.to_dict())
+        
+        if message.content_type == 'text' and (message.text or '').startswith('/start'):
+            await self.send_limited(user_bot, bot_data.token, message.chat.id, self.render_config['child_owner_start'])
+            return
+        
+        if message.reply_to_message is not None:
+            target = self.reply_index.get(message.chat.id, message.reply_to_message.message_id, via=bot_data.bot_id)
+            if target:
+                await self.process_reply_step(message, target[0], target[1], confirm=False, via=user_bot)
+                return
+        
+        if (self.step_manager.get_step(owner_id) == 'awaiting_reply'
+                and self.step_manager.get_data(owner_id, 'bot_username') == bot_data.username):
+            target_user_id = self.step_manager.get_data(owner_id, 'target_user_id')
+            self.step_manager.clear_step(owner_id)
+            await self.process_reply_step(message, target_user_id, bot_data.username, via=user_bot)
+            return
+        
+        await self.send_limited(user_bot, bot_data.token, message.chat.id, self.render_config['child_owner_hint'])
+    
+    async def process_reply_step(self, message, target_user_id: int, bot_username: str, confirm: bool = True,
+                                 via: Optional[AsyncTeleBot] = None):
+        """
+        پردازش پاسخ به کاربر
+        
+        Args:
+            confirm: ارسال پیام تایید به مالک (در پاسخ مستقیم reply-to
+                غیرفعال است تا هر پاسخ فقط یک ارسال هزینه داشته باشد)
+            via: رباتی که پیام‌های تایید/خطا با آن به مالک ارسال می‌شود
+                (پیش‌فرض ربات مادر)
+        """
+        owner_id = message.from_user.id
+        via = via or self.bot
+        
+        # پیدا کردن ربات مربوطه
+        user_bots = self.user_bots.get(owner_id, [])
+        target_bot_data = None
+        
+        for bot_data in user_bots:
+            if bot_data.username == bot_username:
+                target_bot_data = bot_data
+                break
+        
+        if not target_bot_data:
+            await via.send_message(
+                owner_id,
+                self.render_config['bot_not_found']
+            )
+            return
+        
+        try:
+            # ایجاد ربات موقت برای ارسال پاسخ
+            reply_bot = AsyncTeleBot(target_bot_data.token)
+            
+            # بررسی مسدود بودن
+            if (target_user_id, bot_username) in self.blocked_users:
+                await via.send_message(
+                    owner_id,
+                    "⚠️ این کاربر مسدود شده است. ابتدا کاربر را آزاد کنید."
+                )
+                return
+            
+            # ارسال پاسخ (متن مالک escape می‌شود؛ سقف طول روی متن قابل نمایش است)
+            header = self.render_config['owner_reply_header']
+            reserve = len(header) + 2  # جای عنوان در سقف طول
+            if message.content_type == 'text':
+                await reply_bot.send_message(
+                    target_user_id,
+                    f"{header}\n\n{html.escape(_truncate(message.text or '', MAX_MESSAGE_LENGTH - reserve))}",
+                    parse_mode='HTML'
+                )
+            elif via is self.bot:
+                # فایل‌ها فقط از گفتگوی همان ربات فرزند قابل کپی هستند
+                await via.send_message(owner_id, self.render_config['reply_text_only'].format(bot_username))
+                return
+            elif message.content_type == 'sticker':
+                await reply_bot.send_message(target_user_id, header, parse_mode='HTML')
+                await reply_bot.copy_message(target_user_id, message.chat.id, message.message_id)
+            else:
+                caption = _truncate(message.caption or '', MAX_CAPTION_LENGTH - reserve)
+                await reply_bot.copy_message(
+                    target_user_id, message.chat.id, message.message_id,
+                    caption=f"{header}\n\n{html.escape(caption)}" if caption else header,
+                    parse_mode='HTML'
+                )
+            self.stats.incr('replies_sent')
+            self.analytics.record(bot_username, 'replies')
+            
+            if confirm:
+                await via.send_message(
+                    owner_id,
+                    self.render_config['reply_sent']
+                )
+            
+        except Exception as e:
+            logger.error("خطا در ارسال پاسخ: %s", e)
+            error_msg = "❌ <b>خطا در ارسال پاسخ:</b>\n\n"
+            
+            if "bot was blocked" in str(e).lower():
+                error_msg += "کاربر ربات را مسدود کرده است."
+            elif "user not found" in str(e).lower():
+                error_msg += "کاربر یافت نشد."
+            else:
+                error_msg += html.escape(str(e)[:100])
+            
+            await via.send_message(
+                owner_id,
+                error_msg,
+                parse_mode='HTML'
+            )
+    
+    async def attach_child_client(self, bot_data: BotRecord):
+        """ساخت مجدد کلاینت و هندلرهای ربات فرزند خوابیده"""
+        bot_data.client = AdmittedTeleBot(
+            bot_data.token, admission=self.admission,
+            ingress_key=bot_data.username, offset=bot_data.offset
+        )
+        await self.setup_user_bot(bot_data)
+    
+    async def setup_user_bot(self, bot_data: BotRecord):
+        """راه‌اندازی و تنظیم ربات کاربر"""
+        user_bot = bot_data.client
+        owner_id = bot_data.owner_id
+        bot_username = bot_data.username
+        
+        @user_bot.callback_query_handler(func=lambda call: True)
+        async def user_bot_callback_handler(call):
+            """دکمه‌های اعلان‌هایی که از طریق خود ربات فرزند به مالک رسیده‌اند"""
+            if call.from_user.id != owner_id:
+                await user_bot.answer_callback_query(call.id, self.render_config['no_permission'])
+                return
+            if call.data.startswith('reply_'):
+                await self.owner_reply_callback(user_bot, call)
+            elif call.data.startswith('block_'):
+                await self.owner_block_callback(user_bot, call, block=True)
+            elif call.data.startswith('blockall_'):
+                await self.owner_block_callback(user_bot, call, block=True, everywhere=True)
+            elif call.data.startswith('unblock_'):
+                await self.owner_block_callback(user_bot, call, block=False)
+            else:
+                await user_bot.answer_callback_query(call.id)
         
         @user_bot.message_handler(func=lambda m: True, content_types=['text', 'photo', 'video', 'document', 'voice', 'audio', 'sticker'])
         async def user_bot_message_handler(message):
             """هندلر پیام‌های دریافتی توسط ربات کاربر"""
+            context = bind_log_context(
+                bot=bot_username, owner=owner_id,
+                user=message.from_user.id if message.from_user else None,
+                message=message.message_id
+            )
             try:
-                sender_id = message.from_user.id
-                chat_id = message.chat.id
-                
-                # جلوگیری از پاسخ به پیام‌های خود ربات
-                try:
-                    bot_me = await user_bot.get_me()
-                    if sender_id == bot_me.id:
-                        return
-                except:
-                    pass
+                self.child_manager.touch(bot_username)
+                sender_id = message.from_user.id if message.from_user else 0
+                blocked_by = None
+                if sender_id != owner_id:
+                    blocked_by = self.blocklist.match(sender_id, owner_id, self.global_blocklist)
                 
-                # بررسی مسدود بودن کاربر
-                if (sender_id, bot_username) in self.blocked_users:
-                    await user_bot.send_message(
-                        chat_id,
-                        "⛔ شما توسط مالک ربات مسدود شده‌اید."
+                if sender_id == owner_id:
+                    await self.handle_owner_in_child(bot_data, message)
+                elif blocked_by:
+                    await self.reject_blocked_sender(bot_data, message, blocked_by)
+                elif message.media_group_id:
+                    # اعضای آلبوم جمع شده و یکجا رله می‌شوند
+                    self.media_groups.add(
+                        bot_username, message,
+                        lambda album: self.relay_album(bot_data, album)
                     )
+                else:
+                    await self.relay_deduplicated(bot_data, message)
+            except Exception as e:
+                logger.error("خطا در پردازش پیام کاربر: %s", e)
+            finally:
+                reset_log_context(context)
+    
+    def record_inbox(self, bot_data: BotRecord, message, album: Optional[List[Any]] = None):
+        """ثبت پیام در صندوق پیام (بدون انتظار؛ نوشتن در thread صندوق)"""
+        if self.inbox is None:
+            return
+        if album:
+            body, content_type = self.album_caption(album), 'album'
+        else:
+            body, content_type = message.text or message.caption or '', message.content_type
+        self.inbox.append(bot_data.owner_id, bot_data.username, message.from_user.id, content_type, body)
+    
+    async def show_inbox(self, owner_id: int, query: Optional[str], bot_username: Optional[str],
+                         before: Optional[int] = None, edit_message_id: Optional[int] = None):
+        """ارسال (یا ویرایش) یک صفحه از صندوق پیام یا نتایج جستجو"""
+        if self.inbox is None:
+            await self.bot.send_message(owner_id, self.render_config['inbox_disabled'])
+            return
+        if bot_username and not self._find_owner_bot(owner_id, bot_username):
+            await self.bot.send_message(owner_id, self.render_config['bot_not_found'])
+            return
+        
+        self.inbox_queries[owner_id] = (query, bot_username)
+        if query:
+            rows, cursor = await self.inbox.search(owner_id, query, before, self.inbox_page_size, bot_username)
+        else:
+            rows, cursor = await self.inbox.page(owner_id, before, self.inbox_page_size, bot_username)
+        
+        text, markup = self.render_inbox_page(rows, cursor, query, first_page=before is None)
+        if edit_message_id:
+            await self.bot.edit_message_text(text, owner_id, edit_message_id, reply_markup=markup, parse_mode='HTML')
+        else:
+            await self.bot.send_message(owner_id, text, reply_markup=markup, parse_mode='HTML')
+    
+    def render_inbox_page(self, rows: List[Dict[str, Any]], cursor: Optional[int], query: Optional[str],
+                          first_page: bool) -> Tuple[str, types.InlineKeyboardMarkup]:
+        """متن و دکمه‌های یک صفحه صندوق پیام"""
+        if query:
+            text = self.render_config['inbox_search_title'].format(_escape_limited(query, 200)) + "\n\n"
+        else:
+            text = self.render_config['inbox_title'] + "\n\n"
+        
+        if not rows:
+            text += self.render_config['inbox_empty']
+        # سهم هر سطر از سقف طول پیام؛ طول پس از escape سنجیده می‌شود (& و < تا ۵ برابر)
+        budget = (MAX_MESSAGE_LENGTH - len(text)) // max(1, len(rows))
+        for row in rows:
+            entry = f"🕒 {datetime.fromtimestamp(row['ts']).strftime('%Y/%m/%d %H:%M')} • @{row['bot']}\n"
+            entry += f"👤 <code>{row['sender_id']}</code> • {row['content_type']}\n"
+            if row['body']:
+                entry += _escape_limited(row['body'][:300], max(0, budget - len(entry) - 2)) + "\n"
+            text += entry + "\n"
+        
+        markup = types.InlineKeyboardMarkup()
+        nav = []
+        if not first_page:
+            nav.append(types.InlineKeyboardButton(self.render_config['inbox_newest_btn'], callback_data="inboxpg_0"))
+        if cursor:
+            nav.append(types.InlineKeyboardButton(self.render_config['inbox_older_btn'], callback_data=f"inboxpg_{cursor}"))
+        if nav:
+            markup.row(*nav)
+        return text, markup
+    
+    async def reject_blocked_sender(self, bot_data: BotRecord, message, blocked_by: str):
+        """
+        پیام فرستنده مسدود در فهرست سراسری یا فهرست مالک
+        
+        پیام‌های فهرست سراسری بدون پاسخ دور ریخته می‌شوند تا برای
+        اسپمرها فراخوانی API مصرف نشود.
+        """
+        self.stats.incr(f'blocked_{blocked_by}')
+        if blocked_by == 'owner':
+            await self.send_limited(
+                bot_data.client, bot_data.token, message.chat.id,
+                self.render_config['sender_blocked']
+            )
+    
+    async def relay_album(self, bot_data: BotRecord, album: List[Any]):
+        """رله یکجای اعضای یک آلبوم"""
+        try:
+            await self.relay_message(bot_data, album[0], album=album)
+        except Exception as e:
+            logger.error("خطا در رله آلبوم: %s", e)
+    
+    def build_owner_markup(self, sender_id: int, bot_username: str, owner_id: int) -> types.InlineKeyboardMarkup:
+        """ساخت کیبورد اینلاین پیام رله‌شده برای مالک"""
+        inline_markup = types.InlineKeyboardMarkup()
+        
+        # دکمه مشاهده پروفایل
+        profile_btn = types.InlineKeyboardButton(
+            self.render_config['view_profile_btn'],
+            url=f"tg://user?id={sender_id}"
+        )
+        
+        # دکمه پاسخ
+        reply_btn = types.InlineKeyboardButton(
+            self.render_config['reply_btn'],
+            callback_data=f"reply_{sender_id}_{bot_username}"
+        )
+        
+        # بررسی اینکه آیا کاربر مسدود شده یا نه
+        inline_markup.row(profile_btn)
+        if ((sender_id, bot_username) in self.blocked_users
+                or self.blocklist.contains(sender_id, owner_id)):
+            inline_markup.row(reply_btn, types.InlineKeyboardButton(
+                self.render_config['unblock_btn'],
+                callback_data=f"unblock_{sender_id}_{bot_username}"
+            ))
+        else:
+            inline_markup.row(reply_btn, types.InlineKeyboardButton(
+                self.render_config['block_btn'],
+                callback_data=f"block_{sender_id}_{bot_username}"
+            ))
+            inline_markup.row(types.InlineKeyboardButton(
+                self.render_config['block_all_btn'],
+                callback_data=f"blockall_{sender_id}_{bot_username}"
+            ))
+        return inline_markup
+    
+    async def send_limited(self, bot: AsyncTeleBot, token: str, chat_id: int, text: str, **kwargs):
+        """ارسال پیام با رعایت محدودیت نرخ توکن و چت"""
+        await self.outbound.acquire(token, chat_id)
+        return await bot.send_message(chat_id, text, **kwargs)
+    
+    def get_tenant_usage(self, bot_data: BotRecord) -> TenantUsage:
+        """شمارنده‌های مصرف یک ربات فرزند"""
+        usage = self.tenant_usage.get(bot_data.username)
+        if usage is None:
+            usage = self.tenant_usage[bot_data.username] = TenantUsage(bot_data.owner_id)
+            self.scheduler.set_weight(bot_data.username, self.quotas.get(bot_data.owner_id, 'weight'))
+        return usage
+    
+    async def send_to_owner(self, bot_data: BotRecord, text: str, **kwargs) -> Tuple[Any, bool]:
+        """
+        ارسال پیام به مالک
+        
+        در حالت OWNER_DELIVERY=child پیام با توکن خود ربات فرزند ارسال
+        می‌شود تا ظرفیت ارسال با تعداد ربات‌ها بالا برود. اگر مالک ربات را
+        start نکرده باشد (403 یا 400 «chat not found»)، پیام از طریق ربات
+        مادر با نوبت‌دهی عادلانه بین ربات‌ها ارسال می‌شود.
+        
+        Returns:
+            (پیام ارسال شده، آیا از طریق ربات فرزند ارسال شد)
+        """
+        usage = self.get_tenant_usage(bot_data)
+        
+        if (self.owner_delivery == 'child' and bot_data.owner_via_child is not False
+                and bot_data.client is not None):
+            try:
+                result = await self.send_limited(bot_data.client, bot_data.token, bot_data.owner_id, text, **kwargs)
+                if bot_data.owner_via_child is None:
+                    bot_data.owner_via_child = True
+                    await self.store.save_bot(bot_data.to_dict())
+                return result, True
+            except telebot.asyncio_helper.ApiTelegramException as e:
+                if not _recipient_gone(e):
+                    # خطای محتوا یا موقت: مالک همچنان از ربات فرزند قابل دسترسی است
+                    raise
+                # مالک گفتگو با ربات فرزند را شروع نکرده است
+                bot_data.owner_via_child = False
+                await self.store.save_bot(bot_data.to_dict())
+                logger.info("تحویل اعلان‌های @%s به ربات مادر برگشت", bot_data.username)
+        
+        start = time.perf_counter()
+        await self.scheduler.acquire(bot_data.username)
+        await self.outbound.acquire(self.master_token, bot_data.owner_id, per_token=False)
+        usage.queue_wait_ms += (time.perf_counter() - start) * 1000
+        usage.master_sends += 1
+        try:
+            return await self.bot.send_message(bot_data.owner_id, text, **kwargs), False
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            if e.error_code == 403:
+                # مالک ربات مادر را مسدود کرده یا حسابش حذف شده است
+                await self.mark_owner_unreachable(bot_data.owner_id)
+            raise
+    
+    def owner_paused(self, bot_data: BotRecord) -> bool:
+        """
+        آیا اعلان‌های این ربات راهی به مالک ندارند؟
+        
+        در حالت child، owner_via_child=None (هنوز امتحان نشده) مسیر ربات فرزند
+        را باز نگه می‌دارد؛ فقط False قطعی یعنی آن مسیر هم بسته است.
+        """
+        if bot_data.owner_id not in self.unreachable_owners:
+            return False
+        return not (self.owner_delivery == 'child' and bot_data.owner_via_child is not False)
+    
+    async def mark_owner_unreachable(self, owner_id: int):
+        """توقف رله ربات‌های مالکی که ربات مادر را مسدود کرده است"""
+        if owner_id in self.unreachable_owners:
+            return
+        self.unreachable_owners.add(owner_id)
+        self.bot_pages.invalidate(owner_id)
+        await self.store.set_owner_reachable(owner_id, False)
+        self.stats.incr('owners_paused')
+        logger.info("مالک %s در دسترس نیست؛ ربات‌هایش متوقف شدند", owner_id)
+    
+    async def mark_owner_reachable(self, owner_id: int) -> bool:
+        """ادامه رله پس از بازگشت مالک (True اگر متوقف بود)"""
+        if owner_id not in self.unreachable_owners:
+            return False
+        self.unreachable_owners.discard(owner_id)
+        self.bot_pages.invalidate(owner_id)
+        await self.store.set_owner_reachable(owner_id, True)
+        logger.info("مالک %s برگشت؛ رله ربات‌هایش ادامه پیدا کرد", owner_id)
+        return True
+    
+    def claim_fingerprint(self, bot_data: BotRecord, message):
+        """
+        بررسی تکراری بودن پیام در پنجره DEDUP_WINDOW
+        
+        Returns:
+            مدخل اعلان قبلی (پیام تکراری است)، اثر انگشت رزرو شده (پیام تازه
+            است و پس از ارسال اعلان bind می‌شود) یا None (بررسی نمی‌شود)
+        """
+        if self.duplicates is None or self.owner_paused(bot_data):
+            return None
+        sender_id = message.from_user.id
+        if (sender_id, bot_data.username) in self.blocked_users:
+            return None
+        fingerprint = self.duplicates.fingerprint(message)
+        if fingerprint is None:
+            return None
+        duplicate = self.duplicates.claim(bot_data.owner_id, fingerprint, sender_id, bot_data.username)
+        return duplicate if duplicate is not None else fingerprint
+    
+    async def relay_deduplicated(self, bot_data: BotRecord, message):
+        """رله پیام با بررسی تکراری بودن آن"""
+        fingerprint = self.claim_fingerprint(bot_data, message)
+        if isinstance(fingerprint, DuplicateEntry):
+            await self.collapse_duplicate(bot_data, message, fingerprint)
+            return
+        try:
+            await self.relay_message(bot_data, message, fingerprint=fingerprint)
+        finally:
+            if fingerprint is not None:
+                # رله بدون اعلان تمام شد (خطا، سهمیه، خلاصه): رزرو آزاد شود و
+                # تکرارهایی که منتظر این اعلان بودند دوباره و جداگانه رله شوند
+                held = self.duplicates.release(bot_data.owner_id, fingerprint, message.from_user.id)
+                for held_bot, held_message in held:
+                    try:
+                        await self.relay_deduplicated(held_bot, held_message)
+                    except Exception as e:
+                        logger.error("خطا در رله دوباره پیام تکراری: %s", e)
+    
+    async def collapse_duplicate(self, bot_data: BotRecord, message, entry: DuplicateEntry):
+        """تکرار یک محتوای رله‌شده: فقط شمارنده اعلان قبلی به‌روز می‌شود"""
+        if self.duplicates.hold(entry, (bot_data, message)):
+            # اعلان اول هنوز ارسال نشده: تایید پس از bind و در صورت شکست رله دوباره
+            return
+        sender_id = message.from_user.id
+        self.sender_index.add(bot_data.username, sender_id)
+        self.analytics.record(bot_data.username, 'inbound', sender_id)
+        self.stats.incr('duplicates_collapsed')
+        self.schedule_duplicate_edit(entry)
+        await self.ack_sender(bot_data, message.chat.id)
+    
+    def _log_slow_relay(self, record: Dict[str, Any]):
+        """هوک tracer: ثبت رله‌هایی که از RELAY_SLOW_MS کندتر بوده‌اند"""
+        spans = record['spans_ms']
+        if spans.get('total', 0) < self.relay_slow_ms:
+            return
+        self.stats.incr('relays_slow')
+        logger.warning(
+            "رله کند ربات @%s: %s",
+            record['bot'],
+            ', '.join(f"{stage}={duration:.1f}ms" for stage, duration in spans.items())
+        )
+    
+    async def ack_sender(self, bot_data: BotRecord, chat_id: int):
+        """تایید دریافت به فرستنده (در زمان فشار کنار گذاشته می‌شود)"""
+        if self.admission.should_shed('ack', bot_data.username):
+            return None
+        return await self.send_limited(
+            bot_data.client, bot_data.token, chat_id,
+            "✅ پیام شما دریافت شد و به صورت ناشناس ارسال گردید."
+        )
+    
+    def schedule_duplicate_edit(self, entry: DuplicateEntry):
+        """به‌روزرسانی شمارنده حداکثر یک بار در هر DEDUP_EDIT_INTERVAL ثانیه"""
+        if self.admission.should_shed('dedup_edit', entry.bot_username):
+            return
+        if self.duplicates.begin_edit(entry):
+            asyncio.ensure_future(self.edit_duplicate_counter(entry))
+    
+    async def edit_duplicate_counter(self, entry: DuplicateEntry):
+        """افزودن ردیف شمارنده تکرار به کیبورد اعلان قبلی (متن اعلان دست نمی‌خورد)"""
+        await asyncio.sleep(self.dedup_edit_interval)
+        # تکرارهایی که حین ویرایش برسند ویرایش بعدی را زمان‌بندی می‌کنند
+        self.duplicates.end_edit(entry)
+        bot_data = self.child_manager.get_bot(entry.bot_username)
+        if bot_data is None:
+            return
+        markup = self.build_owner_markup(entry.sender_id, entry.bot_username, entry.owner_id)
+        markup.row(types.InlineKeyboardButton(
+            self.render_config['duplicate_counter'].format(count=entry.count, senders=entry.sender_count),
+            callback_data="noop"
+        ))
+        try:
+            if entry.via_child:
+                if bot_data.client is None:
                     return
-                
-                # ذخیره نگاشت چت
-                self.chat_mapping[sender_id] = owner_id
-                
-                # ایجاد پیام برای مالک
-                message_text = self.prepare_message_for_owner(message, bot_username)
-                
-                # ایجاد اینلاین کیبورد
-                inline_markup = types.InlineKeyboardMarkup()
-                
-                # دکمه مشاهده پروفایل
-                profile_btn = types.InlineKeyboardButton(
-                    self.render_config['view_profile_btn'],
-                    url=f"tg://user?id={sender_id}"
+                await self.outbound.acquire(bot_data.token, entry.owner_id)
+                await bot_data.client.edit_message_reply_markup(
+                    entry.owner_id, entry.message_id, reply_markup=markup
                 )
-                
-                # دکمه پاسخ
-                reply_btn = types.InlineKeyboardButton(
-                    self.render_config['reply_btn'],
-                    callback_data=f"reply_{sender_id}_{bot_username}"
+            else:
+                await self.outbound.acquire(self.master_token, entry.owner_id, per_token=False)
+                await self.bot.edit_message_reply_markup(
+                    entry.owner_id, entry.message_id, reply_markup=markup
                 )
-                
-                # بررسی اینکه آیا کاربر مسدود شده یا نه
-                if (sender_id, bot_username) in self.blocked_users:
-                    block_btn = types.InlineKeyboardButton(
-                        self.render_config['unblock_btn'],
-                        callback_data=f"unblock_{sender_id}_{bot_username}"
-                    )
-                else:
-                    block_btn = types.InlineKeyboardButton(
-                        self.render_config['block_btn'],
-                        callback_data=f"block_{sender_id}_{bot_username}"
+            self.stats.incr('duplicate_edits')
+        except Exception as e:
+            logger.debug("خطا در به‌روزرسانی شمارنده تکرار: %s", e)
+    
+    async def relay_message(self, bot_data: BotRecord, message, album: Optional[List[Any]] = None,
+                            fingerprint: Optional[Fingerprint] = None):
+        """
+        رله پیام ناشناس به مالک
+        
+        مراحل به صورت pipeline اجرا می‌شوند: دریافت و بررسی، رندر پیام،
+        ارسال به مالک و فقط پس از تحویل موفق، تایید به فرستنده (تا فرستنده
+        پیش از معلوم شدن نتیجه «ارسال شد» و سپس خطا دریافت نکند).
+        زمان هر مرحله در tracer ثبت می‌شود.
+        
+        Args:
+            album: همه اعضای آلبوم (message اولین عضو است)؛ برای کل آلبوم
+                یک اعلان و یک تایید ارسال می‌شود.
+            fingerprint: اثر انگشت رزرو شده در ایندکس تکراری‌ها؛ پس از
+                ارسال اعلان به شناسه آن متصل می‌شود.
+        """
+        user_bot = bot_data.client
+        owner_id = bot_data.owner_id
+        bot_username = bot_data.username
+        child_token = bot_data.token
+        trace = self.tracer.start(bot_username)
+        
+        with trace.stage('receive'):
+            sender_id = message.from_user.id
+            chat_id = message.chat.id
+            
+            # جلوگیری از پاسخ به پیام‌های خود ربات (شناسه ربات هنگام ساخت ذخیره شده)
+            if sender_id == bot_data.bot_id:
+                return
+            
+            blocked = (sender_id, bot_username) in self.blocked_users
+            if not blocked:
+                self.sender_index.add(bot_username, sender_id)
+                self.analytics.record(bot_username, 'inbound', sender_id)
+        
+        # بررسی مسدود بودن کاربر
+        if blocked:
+            await self.send_limited(
+                user_bot, child_token, chat_id,
+                self.render_config['sender_blocked']
+            )
+            return
+        
+        # مالک در دسترس نیست: پاسخ محلی بدون رندر و ارسال به مالک
+        if self.owner_paused(bot_data):
+            self.record_inbox(bot_data, message, album)
+            self.stats.incr('relays_paused')
+            await self.send_limited(
+                user_bot, child_token, chat_id,
+                self.render_config['owner_unreachable_saved' if self.inbox else 'owner_unreachable']
+            )
+            return
+        
+        # بررسی سهمیه رله مالک (مشترک بین همه ربات‌های او)
+        if not self.get_tenant_usage(bot_data).record_relay(self.quotas.allow_relay(owner_id)):
+            await self.send_limited(
+                user_bot, child_token, chat_id,
+                self.render_config['relay_throttled']
+            )
+            return
+        
+        self.record_inbox(bot_data, message, album)
+        
+        # ربات‌های پرترافیک با حالت خلاصه: بافر کردن به جای ارسال جداگانه
+        if bot_data.digest_enabled and self.digest.should_buffer(bot_username):
+            await self.buffer_for_digest(bot_data, message, album)
+            self.stats.incr('messages_received')
+            await trace.timed('ack_sender', self.ack_sender(bot_data, chat_id))
+            self.tracer.finish(trace, owner_id=owner_id, digest=True)
+            return
+        
+        with trace.stage('render'):
+            # ایجاد پیام و کیبورد برای مالک
+            message_text = self.prepare_message_for_owner(message, bot_username, album)
+            inline_markup = self.build_owner_markup(sender_id, bot_username, owner_id)
+        
+        # ارسال به مالک؛ تایید به فرستنده فقط پس از تحویل
+        try:
+            notify_result = await trace.timed('notify_owner', self.send_to_owner(
+                bot_data, message_text,
+                reply_markup=inline_markup,
+                parse_mode='HTML'
+            ))
+        except Exception as e:
+            notify_result = e
+        
+        if not isinstance(notify_result, Exception):
+            notify_message, via_child = notify_result
+            self.reply_index.put(
+                owner_id, notify_message.message_id, sender_id, bot_username,
+                via=bot_data.bot_id if via_child else 0
+            )
+            
+            # تایید به فرستنده و تایید تکرارهای نگه‌داشته شده به صورت همزمان
+            followups = [trace.timed('ack_sender', self.ack_sender(bot_data, chat_id))]
+            if fingerprint is not None:
+                entry = self.duplicates.bind(owner_id, fingerprint, sender_id, notify_message.message_id, via_child)
+                if entry is not None and entry.count > 1:
+                    # تکرارهایی که پیش از ارسال این اعلان رسیده‌اند
+                    self.schedule_duplicate_edit(entry)
+                    followups.extend(
+                        self.collapse_duplicate(held_bot, held_message, entry)
+                        for held_bot, held_message in self.duplicates.take_held(entry)
                     )
+            for result in await asyncio.gather(*followups, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.warning("خطا در ارسال تایید به فرستنده: %s", result)
+        else:
+            logger.error("خطا در ارسال پیام به مالک: %s", notify_result)
+            # اگر نتوانستیم به مالک پیام بدهیم، حداقل به کاربر اطلاع دهیم
+            if self.owner_paused(bot_data):
+                notice = self.render_config['owner_unreachable_saved' if self.inbox else 'owner_unreachable']
+            else:
+                notice = "⚠️ خطایی در ارسال پیام رخ داد. لطفاً بعداً تلاش کنید."
+            try:
+                await self.send_limited(user_bot, child_token, chat_id, notice)
+            except Exception:
+                pass
+        
+        self.tracer.finish(trace, owner_id=owner_id, delivered=not isinstance(notify_result, Exception))
+        self.stats.incr('messages_received')
+        logger.info("پیام به مالک ربات @%s رله شد", bot_username, extra={'sample': 'relay'})
+    
+    def _find_owner_bot(self, owner_id: int, bot_username: str) -> Optional[BotRecord]:
+        """یافتن ربات یک مالک با username"""
+        for bot_data in self.user_bots.get(owner_id, []):
+            if bot_data.username == bot_username:
+                return bot_data
+        return None
+    
+    async def prompt_broadcast_text(self, owner_id: int, bot_username: str):
+        """درخواست متن پیام همگانی از مالک"""
+        if not self._find_owner_bot(owner_id, bot_username):
+            await self.bot.send_message(owner_id, self.render_config['bot_not_found'])
+            return
+        
+        if bot_username in self.broadcast_jobs:
+            await self.bot.send_message(owner_id, self.render_config['broadcast_running'])
+            return
+        
+        count = self.sender_index.count(bot_username)
+        if not count:
+            await self.bot.send_message(owner_id, self.render_config['broadcast_no_senders'])
+            return
+        
+        self.step_manager.set_step(owner_id, 'awaiting_broadcast', {'bot_username': bot_username})
+        await self.bot.send_message(
+            owner_id,
+            self.render_config['broadcast_enter_text'].format(count, bot_username)
+        )
+    
+    async def start_broadcast(self, owner_id: int, bot_username: str, text: str):
+        """ساخت و شروع کار ارسال همگانی"""
+        if not self._find_owner_bot(owner_id, bot_username):
+            await self.bot.send_message(owner_id, self.render_config['bot_not_found'])
+            return
+        if bot_username in self.broadcast_jobs:
+            await self.bot.send_message(owner_id, self.render_config['broadcast_running'])
+            return
+        if not text.strip() or len(text) > MAX_MESSAGE_LENGTH:
+            await self.bot.send_message(
+                owner_id, self.render_config['broadcast_invalid_text'].format(MAX_MESSAGE_LENGTH)
+            )
+            return
+        
+        job = BroadcastJob(
+            bot_username=bot_username,
+            owner_id=owner_id,
+            text=text,
+            recipients=self.sender_index.snapshot(bot_username),
+            store=self.store
+        )
+        job.save()
+        self.broadcast_jobs[bot_username] = job
+        asyncio.create_task(self.run_broadcast_job(job))
+    
+    async def resume_broadcast(self, bot_username: str):
+        """ادامه ارسال همگانی نیمه‌تمام یک ربات (پس از راه‌اندازی مجدد)"""
+        if bot_username in self.broadcast_jobs:
+            return
+        try:
+            job = await BroadcastJob.load(self.store, bot_username)
+        except Exception as e:
+            logger.warning("بارگذاری کار ارسال همگانی @%s ناموفق بود: %s", bot_username, e)
+            return
+        if job is None or bot_username in self.broadcast_jobs:
+            return
+        self.broadcast_jobs[bot_username] = job
+        logger.info("ادامه ارسال همگانی @%s از %s/%s", bot_username, job.position, job.total)
+        asyncio.create_task(self.run_broadcast_job(job))
+    
+    async def _report_broadcast_progress(self, job: BroadcastJob, final_text: str = None):
+        """نمایش پیشرفت ارسال همگانی به مالک (با ویرایش یک پیام)"""
+        text = self.render_config['broadcast_progress'].format(
+            job.bot_username, job.position, job.total, job.sent, job.pruned, job.failed
+        )
+        markup = None
+        if final_text:
+            text += f"\n\n{final_text}"
+        else:
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton(
+                self.render_config['broadcast_cancel_btn'],
+                callback_data=f"bcastcancel_{job.bot_username}"
+            ))
+        
+        try:
+            if job.progress_message_id is None:
+                msg = await self.bot.send_message(job.owner_id, text, reply_markup=markup)
+                job.progress_message_id = msg.message_id
+            else:
+                await self.bot.edit_message_text(
+                    text, job.owner_id, job.progress_message_id, reply_markup=markup
+                )
+        except Exception as e:
+            logger.warning("خطا در نمایش پیشرفت ارسال همگانی: %s", e)
+    
+    async def run_broadcast_job(self, job: BroadcastJob):
+        """
+        اجرای کار ارسال همگانی
+        
+        ارسال از طریق توکن خود ربات فرزند و فقط با ظرفیت اضافی سطل
+        نرخ آن توکن انجام می‌شود تا ترافیک زنده رله تحت تاثیر قرار نگیرد.
+        خطای 429 با انتظار retry_after و خطای 403 (ربات مسدود شده) یا
+        400 «chat not found» با حذف فرستنده از فهرست مدیریت می‌شود؛ بقیه
+        خطاهای 400 (مثلاً محتوای نامعتبر) فقط ناموفق شمرده می‌شوند.
+        """
+        bot_data = self._find_owner_bot(job.owner_id, job.bot_username)
+        if not bot_data:
+            self.broadcast_jobs.pop(job.bot_username, None)
+            job.discard()
+            return
+        
+        token = bot_data.token
+        sender_bot = AsyncTeleBot(token)
+        last_report = 0.0
+        await self._report_broadcast_progress(job)
+        
+        try:
+            while not job.done and not job.cancelled:
+                if self.admission.should_shed('broadcast'):
+                    # ترافیک زنده اولویت دارد؛ ارسال همگانی صبر می‌کند
+                    await asyncio.sleep(0.5)
+                    continue
+                if not self.outbound.try_reserve(token):
+                    await asyncio.sleep(0.05)
+                    continue
                 
-                inline_markup.row(profile_btn)
-                inline_markup.row(reply_btn, block_btn)
-                
-                # ارسال پیام به مالک
+                recipient = job.recipients[job.position]
                 try:
-                    await self.bot.send_message(
-                        owner_id,
-                        message_text,
-                        reply_markup=inline_markup,
-                        parse_mode='HTML'
-                    )
-                    
-                    # تایید دریافت به کاربر
-                    await user_bot.send_message(
-                        chat_id,
-                        "✅ پیام شما دریافت شد و به صورت ناشناس ارسال گردید."
-                    )
-                    
-                except Exception as send_error:
-                    logger.error(f"خطا در ارسال پیام به مالک: {send_error}")
-                    # اگر نتوانستیم به مالک پیام بدهیم، حداقل به کاربر اطلاع دهیم
-                    try:
-                        await user_bot.send_message(
-                            chat_id,
-                            "⚠️ خطایی در ارسال پیام رخ داد. لطفاً بعداً تلاش کنید."
-                        )
-                    except:
-                        pass
+                    await sender_bot.send_message(recipient, job.text)
+                    job.sent += 1
+                except telebot.asyncio_helper.ApiTelegramException as e:
+                    if e.error_code == 429:
+                        retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if _recipient_gone(e):
+                        # ربات مسدود شده یا چت وجود ندارد (نه خطای محتوای پیام)
+                        self.sender_index.remove(job.bot_username, recipient)
+                        job.pruned += 1
+                    else:
+                        job.failed += 1
+                except Exception as e:
+                    logger.warning("خطا در ارسال همگانی به %s: %s", recipient, e)
+                    job.failed += 1
                 
-            except Exception as e:
-                logger.error(f"خطا در پردازش پیام کاربر: {e}")
+                job.position += 1
+                if job.position % BroadcastJob.CHECKPOINT_EVERY == 0:
+                    job.checkpoint()
+                
+                now = time.monotonic()
+                if now - last_report > 3:
+                    last_report = now
+                    await self._report_broadcast_progress(job)
+            
+            await self._report_broadcast_progress(
+                job,
+                self.render_config['broadcast_cancelled'] if job.cancelled
+                else self.render_config['broadcast_done']
+            )
+            job.discard()
+            
+        except asyncio.CancelledError:
+            # توقف سرویس: ذخیره پیشرفت برای ادامه در اجرای بعدی
+            job.checkpoint()
+            raise
+        except Exception as e:
+            logger.error("خطا در اجرای ارسال همگانی @%s: %s", job.bot_username, e)
+            job.checkpoint()
+        finally:
+            self.broadcast_jobs.pop(job.bot_username, None)
+    
+    def prepare_digest_line(self, message, album: Optional[List[Any]] = None) -> str:
+        """خلاصه یک خطی پیام برای حالت خلاصه"""
+        sender = message.from_user
+        full_name = f"{sender.first_name or ''} {sender.last_name or ''}".strip() or "ناشناس"
+        
+        if album:
+            body = f"[album x{len(album)}] {self.album_caption(album)}".strip()
+        elif message.content_type == 'text':
+            body = message.text or ""
+        else:
+            body = f"[{message.content_type}] {message.caption or ''}".strip()
+        if len(body) > 300:
+            body = body[:300] + "…"
+        
+        return f"<b>{html.escape(full_name)}</b> (<code>{sender.id}</code>): {html.escape(body)}"
+    
+    async def buffer_for_digest(self, bot_data: BotRecord, message, album: Optional[List[Any]] = None):
+        """افزودن پیام به بافر خلاصه و زمان‌بندی ارسال آن"""
+        bot_username = bot_data.username
+        full = self.digest.add(bot_username, message.from_user.id, self.prepare_digest_line(message, album))
+        
+        if full:
+            self.digest.cancel_flush(bot_username)
+            await self.flush_digest(bot_data)
+        else:
+            self.digest.schedule_flush(bot_username, lambda: self.flush_digest(bot_data))
+    
+    async def flush_digest(self, bot_data: BotRecord):
+        """ارسال موارد بافر شده به صورت یک پیام خلاصه"""
+        bot_username = bot_data.username
+        items = self.digest.take(bot_username)
+        if not items:
+            return
+        
+        text = self.render_config['digest_header'].format(bot_username)
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        
+        for idx, (sender_id, line) in enumerate(items, 1):
+            text += f"{idx}. {line}\n\n"
+            markup.row(
+                types.InlineKeyboardButton(
+                    f"↪️ {idx}",
+                    callback_data=f"reply_{sender_id}_{bot_username}"
+                ),
+                types.InlineKeyboardButton(
+                    f"🚫 {idx}",
+                    callback_data=f"block_{sender_id}_{bot_username}"
+                )
+            )
+        
+        try:
+            await self.send_to_owner(
+                bot_data, text,
+                reply_markup=markup,
+                parse_mode='HTML'
+            )
+            self.digest.delivered_items += len(items)
+            self.digest.delivered_messages += 1
+        except Exception as e:
+            logger.error("خطا در ارسال خلاصه به مالک: %s", e)
+            if isinstance(e, telebot.asyncio_helper.ApiTelegramException) and _recipient_gone(e):
+                return
+            # موارد به بافر برمی‌گردند و در پنجره بعد دوباره ارسال می‌شوند
+            dropped = self.digest.requeue(bot_username, items)
+            if dropped:
+                logger.warning("%s مورد قدیمی از خلاصه ربات %s کنار گذاشته شد", dropped, bot_username)
+            self.digest.schedule_flush(bot_username, lambda: self.flush_digest(bot_data))
     
-    def prepare_message_for_owner(self, message, bot_username: str) -> str:
+    @staticmethod
+    def album_caption(album: List[Any]) -> str:
+        """کپشن آلبوم (تلگرام کپشن را معمولاً روی یکی از اعضا قرار می‌دهد)"""
+        for item in album:
+            if item.caption:
+                return item.caption
+        return ""
+    
+    def prepare_album_content(self, album: List[Any]) -> str:
+        """بخش محتوای اعلان یک آلبوم"""
+        labels = {'photo': "عکس", 'video': "ویدیو", 'document': "فایل", 'audio': "فایل صوتی"}
+        counts: Dict[str, int] = {}
+        for item in album:
+            counts[item.content_type] = counts.get(item.content_type, 0) + 1
+        parts = "، ".join(f"{count} {labels.get(kind, kind)}" for kind, count in counts.items())
+        
+        content = f"🗂 <b>آلبوم {len(album)} موردی</b> ({parts})\n"
+        caption = self.album_caption(album)
+        if caption:
+            content += f"📌 <b>کپشن:</b> {html.escape(caption)}"
+        return content
+    
+    def prepare_message_for_owner(self, message, bot_username: str, album: Optional[List[Any]] = None) -> str:
         """آماده‌سازی پیام برای نمایش به مالک"""
         sender = message.from_user
         sender_name = sender.first_name or ""
@@ -1037,8 +4022,8 @@ class AnonymousChatBot:
         if not full_name:
             full_name = "ناشناس"
         
-        # ایجاد نام نمایشی
-        display_name = f"<b>{full_name}</b>" if full_name else "<i>ناشناس</i>"
+        # ایجاد نام نمایشی (محتوای کاربر پیش از درج در HTML escape می‌شود)
+        display_name = f"<b>{html.escape(full_name)}</b>" if full_name else "<i>ناشناس</i>"
         
         message_text = self.render_config['message_received']
         message_text += f"👤 از: {display_name}\n"
@@ -1049,21 +4034,23 @@ class AnonymousChatBot:
         
         content_type = message.content_type
         
-        if content_type == 'text':
-            message_text += f"📝 <b>پیام:</b>\n{message.text}"
+        if album:
+            message_text += self.prepare_album_content(album)
+        elif content_type == 'text':
+            message_text += f"📝 <b>پیام:</b>\n{html.escape(message.text or '')}"
         elif content_type == 'photo':
             caption = message.caption or ""
             message_text += f"🖼 <b>عکس ارسال شده</b>\n"
             if caption:
-                message_text += f"📌 <b>کپشن:</b> {caption}"
+                message_text += f"📌 <b>کپشن:</b> {html.escape(caption)}"
         elif content_type == 'video':
             caption = message.caption or ""
             message_text += f"🎬 <b>ویدیو ارسال شده</b>\n"
             if caption:
-                message_text += f"📌 <b>کپشن:</b> {caption}"
+                message_text += f"📌 <b>کپشن:</b> {html.escape(caption)}"
         elif content_type == 'document':
             file_name = message.document.file_name if message.document else "فایل"
-            message_text += f"📎 <b>فایل:</b> {file_name}"
+            message_text += f"📎 <b>فایل:</b> {html.escape(file_name or 'فایل')}"
         elif content_type == 'voice':
             message_text += "🎤 <b>پیام صوتی</b>"
         elif content_type == 'audio':
@@ -1075,78 +4062,604 @@ class AnonymousChatBot:
         
         return message_text
     
-    def start_flask_server(self):
-        """شروع سرور Flask"""
-        logger.info(f"🚀 شروع سرور Flask روی پورت {self.port}")
-        self.app.run(
-            host='0.0.0.0',
-            port=self.port,
-            debug=False,
-            threaded=True
+    def _register_owner_bot(self, bot_data: BotRecord):
+        """افزودن ربات به فهرست ربات‌های مالک"""
+        self.user_bots.setdefault(bot_data.owner_id, []).append(bot_data)
+        self.bot_pages.invalidate(bot_data.owner_id)
+    
+    def _unregister_owner_bot(self, owner_id: int, bot_username: str):
+        """حذف ربات از فهرست مالک (مالک بدون ربات از فهرست حذف می‌شود)"""
+        remaining = [
+            bot for bot in self.user_bots.get(owner_id, [])
+            if bot.username != bot_username
+        ]
+        if remaining:
+            self.user_bots[owner_id] = remaining
+        else:
+            self.user_bots.pop(owner_id, None)
+        self.bot_pages.invalidate(owner_id)
+    
+    def forget_bot(self, owner_id: int, bot_username: str):
+        """
+        حذف ربات از حافظه این نمونه
+        
+        polling متوقف و وضعیت وابسته به ربات (فهرست مالک، کش‌ها، فرستنده‌ها،
+        ارسال همگانی و کاربران مسدود) پاک می‌شود؛ رکورد ذخیره‌سازی را
+        فراخواننده حذف می‌کند.
+        """
+        self._unregister_owner_bot(owner_id, bot_username)
+        self.child_manager.remove_bot(bot_username)
+        self.digest.forget(bot_username)
+        self.reply_index.discard_bot(bot_username)
+        self.sender_index.drop_bot(bot_username)
+        self.tenant_usage.pop(bot_username, None)
+        self.analytics.forget(bot_username)
+        self.media_groups.forget(bot_username)
+        if self.inbox:
+            self.inbox.forget_bot(bot_username)
+        if self.duplicates:
+            self.duplicates.forget_bot(bot_username)
+        job = self.broadcast_jobs.get(bot_username)
+        if job:
+            job.cancelled = True
+        
+        # حذف کاربران مسدود شده مرتبط
+        self.blocked_users = {
+            (uid, uname) for (uid, uname) in self.blocked_users
+            if uname != bot_username
+        }
+    
+    def render_bot_list_page(self, owner_id: int, page: int) -> Optional[Tuple[str, types.InlineKeyboardMarkup]]:
+        """متن و کیبورد یک صفحه از فهرست ربات‌های مالک (از کش در صورت وجود)"""
+        user_bots_info = self.user_bots.get(owner_id)
+        if not user_bots_info:
+            return None
+        
+        pages = self.bot_pages.page_count(len(user_bots_info))
+        page = min(max(page, 0), pages - 1)
+        cached = self.bot_pages.get(owner_id, page)
+        if cached:
+            return cached
+        
+        start = page * self.bot_pages.page_size
+        page_bots = user_bots_info[start:start + self.bot_pages.page_size]
+        
+        bot_list = self.render_config['bot_list']
+        for idx, bot_info in enumerate(page_bots, start + 1):
+            status = "✅ فعال" if bot_info.active else "❌ غیرفعال"
+            if self.owner_paused(bot_info):
+                status = "⏸ متوقف (ربات مادر مسدود شده)"
+            if bot_info.digest_enabled:
+                status += " | 📦 خلاصه"
+            
+            bot_list += f"**{idx}. @{bot_info.username}**\n"
+            bot_list += f"   وضعیت: {status}\n"
+            bot_list += f"   ایجاد: {bot_info.created_at_text}\n\n"
+        
+        # ایجاد اینلاین کیبورد برای مدیریت
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        for bot_info in page_bots:
+            markup.add(types.InlineKeyboardButton(
+                f"@{bot_info.username}",
+                callback_data=f"manage_{bot_info.username}"
+            ))
+        
+        if pages > 1:
+            bot_list += self.render_config['bot_list_page'].format(page + 1, pages, len(user_bots_info))
+            nav = []
+            if page > 0:
+                nav.append(types.InlineKeyboardButton(
+                    self.render_config['prev_page_btn'], callback_data=f"botspage_{page - 1}"
+                ))
+            nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+            if page < pages - 1:
+                nav.append(types.InlineKeyboardButton(
+                    self.render_config['next_page_btn'], callback_data=f"botspage_{page + 1}"
+                ))
+            markup.row(*nav)
+        
+        rendered = (bot_list, markup)
+        self.bot_pages.put(owner_id, page, rendered)
+        return rendered
+    
+    async def import_bots(self, text: str, owner_id: Optional[int] = None,
+                          ignore_quota: bool = False) -> Dict[str, Any]:
+        """
+        ورود دسته‌ای توکن‌ها (API و خط فرمان ادمین)
+        
+        ربات‌های معتبر در دسته‌ها با یک عملیات ذخیره می‌شوند و بدون thread
+        polling (مانند ربات خوابیده) ثبت می‌شوند تا با اولین آپدیت بیدار شوند.
+        """
+        entries, malformed = parse_entries(text, owner_id)
+        registered = list(self.child_manager.child_bots.values())
+        owned: Dict[int, int] = {}
+        
+        def admit(owner: int) -> bool:
+            if owner not in owned:
+                owned[owner] = len(self.user_bots.get(owner, []))
+            if not ignore_quota and owned[owner] >= self.quotas.get(owner, 'max_bots'):
+                return False
+            owned[owner] += 1
+            return True
+        
+        async def register(batch: List[Dict[str, Any]]):
+            records = [BotRecord(**item) for item in batch]
+            await self.store.execute([
+                ('put', NS_BOTS, record.username, json.dumps(record.to_dict(), ensure_ascii=False))
+                for record in records
+            ])
+            for record in records:
+                self._register_owner_bot(record)
+                self.child_manager.add_hibernated(record)
+            self.stats.incr('bots_created', len(records))
+            logger.info("ورود دسته‌ای: %s ربات ثبت شد", len(records))
+        
+        importer = BulkImporter(concurrency=self.import_concurrency)
+        report = await importer.run(
+            entries,
+            known_tokens={record.token for record in registered},
+            known_usernames={record.username for record in registered},
+            register=register,
+            admit=admit
+        )
+        report['results'] = sorted(malformed + report['results'], key=lambda r: r['line'])
+        report['invalid'] += len(malformed)
+        report['total'] += len(malformed)
+        return report
+    
+    async def update_global_blocklist(self, add: List[int], remove: List[int]):
+        """افزودن و حذف دسته‌ای شناسه‌ها در فهرست مسدودی سراسری"""
+        remove = set(remove)
+        added = await asyncio.get_running_loop().run_in_executor(
+            None, self.blocklist.update,
+            [(GLOBAL_SCOPE, user_id) for user_id in add if user_id not in remove]
         )
+        # فقط شناسه‌های تازه ذخیره می‌شوند (نه کل دسته ورودی)
+        removed = [(GLOBAL_SCOPE, user_id) for user_id in remove if self.blocklist.discard(user_id)]
+        if added:
+            await self.store.add_scoped_blocks(added)
+        if removed:
+            await self.store.remove_scoped_blocks(removed)
+        logger.info("فهرست مسدودی سراسری: %s افزوده، %s حذف شد", len(added), len(removed))
+    
+    async def fetch_master_profile(self):
+        """دریافت یک‌باره username ربات مادر برای صفحه وضعیت"""
+        try:
+            me = await self.bot.get_me()
+            self.stats.set_info('master_username', me.username)
+        except Exception as e:
+            logger.warning("دریافت اطلاعات ربات مادر ناموفق بود: %s", e)
+    
+    async def restore_state(self):
+        """بازگردانی ربات‌ها، کاربران مسدود و مراحل از ذخیره‌سازی و شروع polling"""
+        records = await self.store.load_bots()
+        offsets = await self.store.load_offsets()
+        self.blocked_users.update(await self.store.load_blocks())
+        self.unreachable_owners.update(await self.store.load_unreachable_owners())
+        # ساخت Bloom filter برای فهرست‌های بزرگ بیرون از event loop
+        scoped_blocks = await self.store.load_scoped_blocks()
+        await asyncio.get_running_loop().run_in_executor(None, self.blocklist.update, scoped_blocks)
+        self.step_manager.restore(await self.store.load_steps())
+        self.sender_index.restore(await self.store.load_senders([data['username'] for data in records]))
+        
+        for data in records:
+            bot_data = BotRecord.from_dict(data)
+            bot_data.offset = max(bot_data.offset, offsets.get(bot_data.username, 0))
+            self._register_owner_bot(bot_data)
+            # کلاینت در thread خود ربات ساخته می‌شود و polling از offset ادامه پیدا می‌کند
+            self.child_manager.add_bot(bot_data, fresh=False)
+        
+        if records:
+            logger.info("%s ربات از ذخیره‌سازی (%s) بازگردانی شد", len(records), self.store.name)
+    
+    async def sync_bots_from_store(self):
+        """
+        همگام‌سازی فهرست ربات‌ها با ذخیره‌سازی مشترک
+        
+        ربات‌هایی که روی نمونه دیگری ساخته یا حذف شده‌اند اینجا اضافه/حذف
+        می‌شوند تا نمونه دارنده lease بتواند آن‌ها را poll کند. روی loop ربات
+        مادر اجرا می‌شود تا با ساخت و حذف ربات در هندلرها تداخل نداشته باشد؛
+        ربات‌هایی که ثبت یا حذفشان روی همین نمونه در جریان است رد می‌شوند.
+        """
+        try:
+            stored = await self.store.get_all(NS_BOTS)
+        except Exception as e:
+            logger.warning("خطا در همگام‌سازی ربات‌ها: %s", e)
+            return
+        
+        added = [
+            BotRecord.from_dict(json.loads(raw)) for username, raw in stored.items()
+            if username not in self.child_manager.child_bots and username not in self._pending_bots
+        ]
+        if added:
+            self.sender_index.restore(await self.store.load_senders([bot_data.username for bot_data in added]))
+        for bot_data in added:
+            # ربات ممکن است در حین خواندن فرستنده‌ها ثبت شده باشد
+            if bot_data.username in self.child_manager.child_bots or bot_data.username in self._pending_bots:
+                continue
+            self._register_owner_bot(bot_data)
+            self.child_manager.add_bot(bot_data, fresh=False)
+        
+        for username in list(self.child_manager.child_bots):
+            if username not in stored and username not in self._pending_bots:
+                self.forget_bot(self.child_manager.child_bots[username].owner_id, username)
+    
+    def _on_lease_acquired(self, name: str):
+        self._run_lease_hook(self._lease_acquired, name)
+    
+    def _on_lease_released(self, name: str):
+        self._run_lease_hook(self._lease_released, name)
+    
+    def _run_lease_hook(self, hook: Callable[[str], None], name: str):
+        """اجرای هوک lease در worker هوک‌ها (خارج از thread تمدید lease)"""
+        try:
+            future = self.lease_hooks.submit(hook, name)
+        except RuntimeError:
+            # worker پس از خاموشی بسته شده است
+            return
+        future.add_done_callback(
+            lambda done: done.exception() and logger.error("خطا در هوک lease %s: %s", name, done.exception())
+        )
+    
+    def _lease_acquired(self, name: str):
+        """شروع polling ربات مادر یا ربات‌های یک شارد پس از گرفتن lease"""
+        if name == LeaseManager.MASTER:
+            if not self.use_webhook:
+                self.start_master_polling()
+            return
+        
+        if self.store.name != 'memory':
+            self.submit(self.sync_bots_from_store()).result()
+        self.child_manager.start_polling_where(lambda username: self.leases.shard_of(username) == name)
     
-    def start_polling_sync(self):
-        """شروع polling ربات مادر"""
+    def _lease_released(self, name: str):
+        """توقف polling پس از از دست دادن lease"""
+        if name == LeaseManager.MASTER:
+            if self.master_polling:
+                loop, task = self.master_polling
+                try:
+                    loop.call_soon_threadsafe(task.cancel)
+                except RuntimeError:
+                    pass
+            return
+        
+        self.child_manager.stop_polling_where(lambda username: self.leases.shard_of(username) == name)
+    
+    def _bot_sync_loop(self):
+        """همگام‌سازی دوره‌ای فهرست ربات‌ها با ذخیره‌سازی مشترک"""
+        while not self._stop_event.wait(self.bot_sync_interval):
+            if self.draining:
+                return
+            self.submit(self.sync_bots_from_store())
+    
+    def _mark_startup(self, stage: str):
+        """ثبت زمان رسیدن به یک مرحله راه‌اندازی (میلی‌ثانیه از ساخت سرویس)"""
+        self.startup_timings[stage] = round((time.perf_counter() - self._started_at) * 1000, 1)
+        logger.info("راه‌اندازی: %s پس از %sms", stage, self.startup_timings[stage])
+    
+    def readiness(self) -> Dict[str, bool]:
+        """بررسی‌های آمادگی سرویس"""
+        if self.use_webhook:
+            updates = self.webhook_active
+        elif self.leases and not self.leases.owns_master():
+            # نمونه آماده به کار: دریافت آپدیت با نمونه دارنده lease است
+            updates = True
+        else:
+            updates = self.master_polling is not None
+        return {
+            'http': self.http_server is not None,
+            'event_loop': self.master_loop is not None and self.master_loop.is_running(),
+            'state_restored': self.state_restored,
+            'telegram_api': bool(self.stats.snapshot()[0].get('master_username')),
+            'receiving_updates': updates,
+            'accepting': not self.draining,
+        }
+
+    # ساختارهای وضعیت که در /debug/memory اندازه‌گیری می‌شوند
+    MEMORY_STRUCTURES = (
+        'user_bots', 'blocked_users', 'unreachable_owners', 'blocklist',
+        'reply_index', 'sender_index', 'broadcast_jobs', 'inbox_queries', 'tenant_usage',
+        'duplicates', 'digest', 'media_groups', 'analytics', 'tracer', 'outbound',
+        'scheduler', 'bot_pages', 'admission',
+    )
+    
+    def memory_report(self, client_sample: int = 20) -> Dict[str, Any]:
+        """
+        اندازه تقریبی ساختارهای وضعیت، سربار کلاینت هر ربات و threadها
+        
+        کلاینت‌ها (AsyncTeleBot و closureهای هندلرها) فقط برای حداکثر
+        client_sample ربات اندازه‌گیری و میانگین آن‌ها به همه ربات‌های فعال
+        تعمیم داده می‌شود.
+        """
+        clients = [
+            bot_data.client for bot_data in list(self.child_manager.child_bots.values())
+            if bot_data.client is not None
+        ]
+        # اشیاء مشترک (هندلرها به سرویس ارجاع دارند) جزو هیچ ساختاری شمرده نمی‌شوند
+        shared = [self, self.child_manager, self.store, self.admission, self.loop_monitor,
+                  self.stats, self.bot] + clients
+        structures = {}
+        for name in self.MEMORY_STRUCTURES:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            structures[name] = {
+                'entries': len(value) if hasattr(value, '__len__') else None,
+                'approx_bytes': approx_size(value, exclude=[obj for obj in shared if obj is not value]),
+            }
+        structures['user_steps'] = {
+            'entries': len(self.step_manager.user_steps),
+            'approx_bytes': approx_size(self.step_manager.user_steps, exclude=shared),
+        }
+        manager = self.child_manager
+        structures['child_manager'] = {
+            'entries': len(manager.child_bots),
+            'approx_bytes': approx_size(
+                [manager.child_bots, manager.last_activity, manager.hibernated, manager.polling_active],
+                exclude=shared
+            ),
+        }
+        
+        sizes, handlers = [], []
+        for client in clients[:client_sample]:
+            sizes.append(approx_size(client, exclude=[c for c in shared if c is not client]))
+            handlers.append(sum(
+                len(value) for key, value in vars(client).items()
+                if key.endswith('_handlers') and isinstance(value, list)
+            ))
+        per_client = sum(sizes) // len(sizes) if sizes else 0
+        
+        threads: Dict[str, int] = {}
+        for thread in threading.enumerate():
+            name = 'bot_*' if thread.name.startswith('bot_') else thread.name.split(' (')[0].rstrip('0123456789-')
+            threads[name] = threads.get(name, 0) + 1
+        
+        tasks = {}
+        for username, (loop, _) in list(manager.polling_loops.items())[:client_sample]:
+            try:
+                tasks[username] = len(asyncio.all_tasks(loop))
+            except RuntimeError:
+                continue
+        
+        return {
+            'process': process_memory(),
+            'structures': structures,
+            'clients': {
+                'active': len(clients),
+                'sampled': len(sizes),
+                'approx_bytes_per_client': per_client,
+                'approx_bytes_total': per_client * len(clients),
+                'handlers_per_client': max(handlers, default=0),
+                'http_sessions': len(self.sessions),
+            },
+            'threads': {
+                'total': threading.active_count(),
+                'by_name': threads,
+                # هر thread فضای پشته مجازی جداگانه رزرو می‌کند
+                'stack_size_bytes': threading.stack_size() or None,
+            },
+            'loop_tasks': tasks,
+            'tracemalloc': self.memory_tracker.status(),
+        }
+
+    def start_http_server(self):
+        """شروع تنها سرور HTTP سرویس (وب هوک، سلامت، API)"""
+        from werkzeug.serving import make_server
+        
+        self.http_server = make_server('0.0.0.0', self.port, self.app, threaded=True)
+        threading.Thread(
+            target=self.http_server.serve_forever,
+            daemon=True,
+            name="http_server"
+        ).start()
+        logger.info("🚀 سرور HTTP روی پورت %s", self.port)
+    
+    def start_master_loop(self):
+        """شروع event loop دائمی ربات مادر در thread خودش"""
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(started.set)
+            loop.run_forever()
+        
+        threading.Thread(target=run_loop, daemon=True, name="master_loop").start()
+        started.wait()
+        self.master_loop = loop
+        self.loop_monitor.register(loop, "master")
+    
+    def submit(self, coro) -> concurrent.futures.Future:
+        """اجرای coroutine روی loop ربات مادر (از هر thread)"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.master_loop)
+        future.add_done_callback(_log_future_error)
+        return future
+    
+    async def startup(self):
+        """بازگردانی وضعیت و آماده‌سازی ربات مادر روی loop آن"""
+        await self.restore_state()
+        self.state_restored = True
+        self._mark_startup('state_restored')
+        
+        await self.fetch_master_profile()
+        self._mark_startup('telegram_api')
+        
+        # ادامه ارسال‌های همگانی نیمه‌تمام ربات‌های بازگردانی شده
+        for username in list(self.child_manager.child_bots):
+            await self.resume_broadcast(username)
+    
+    async def set_master_webhook(self):
+        """تنظیم webhook ربات مادر"""
+        logger.info("تنظیم webhook: %s/webhook/master", self.webhook_url)
+        await self.bot.remove_webhook()
+        await self.bot.set_webhook(
+            url=f"{self.webhook_url}/webhook/master",
+            drop_pending_updates=False  # آپدیت‌های زمان استقرار مجدد از دست نروند
+        )
+        self.webhook_active = True
+        self._mark_startup('webhook_set')
+    
+    async def master_polling_main(self):
+        """polling ربات مادر روی loop آن تا زمان لغو"""
         logger.info("🔄 شروع polling ربات مادر...")
-        asyncio.run(self.bot.polling(
+        # offset نمونه قبلی هنگام خاموشی تایید شده است؛ آپدیت‌های معوق پردازش می‌شوند
+        task = asyncio.create_task(self.bot.polling(
             non_stop=True,
             timeout=60,
-            skip_pending=True
+            skip_pending=False
         ))
+        self.master_polling = (asyncio.get_running_loop(), task)
+        self._mark_startup('polling_started')
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info("polling ربات مادر متوقف شد")
+        finally:
+            self.master_polling = None
+    
+    def start_master_polling(self):
+        """شروع polling ربات مادر (اگر در حال اجرا نیست)"""
+        if self.master_polling is None:
+            self.submit(self.master_polling_main())
     
     def run(self, use_webhook: bool = False):
-        """اجرای ربات"""
+        """
+        اجرای سرویس
+        
+        ترتیب راه‌اندازی: سرور HTTP (تا پورت سریع باز شود و /ready تا پایان
+        راه‌اندازی 503 بدهد)، loop ربات مادر، بازگردانی وضعیت، و سپس
+        webhook یا polling. thread اصلی تا دریافت سیگنال توقف منتظر می‌ماند.
+        """
         logger.info("🚀 راه‌اندازی ربات چت ناشناس...")
+        # SIGTERM (استقرار مجدد) و SIGINT خاموشی هماهنگ را شروع می‌کنند
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._stop_event.set())
+        self.use_webhook = bool(use_webhook and self.webhook_url)
+        logger.info("حالت: %s", 'Webhook' if self.use_webhook else 'Polling')
         
-        # نمایش اطلاعات
-        logger.info(f"ربات مادر: فعال")
-        logger.info(f"حالت: {'Webhook' if use_webhook else 'Polling'}")
-        logger.info(f"پورت Flask: {self.port}")
+        self.start_http_server()
+        self._mark_startup('http_bound')
+        self.start_master_loop()
+        self.submit(self.startup()).result()
         
-        # شروع سرور Flask در thread جداگانه
-        flask_thread = threading.Thread(
-            target=self.start_flask_server,
-            daemon=True,
-            name="flask_server"
-        )
-        flask_thread.start()
+        # انتخاب رهبر: polling فقط برای leaseهای در اختیار این نمونه
+        if self.leases:
+            self.leases.on_acquire = self._on_lease_acquired
+            self.leases.on_release = self._on_lease_released
+            logger.info("انتخاب رهبر فعال است (نمونه %s، %s شارد)", self.leases.instance_id, self.leases.shards)
         
-        # اگر از webhook استفاده می‌شود
-        if use_webhook and self.webhook_url:
-            logger.info(f"تنظیم webhook: {self.webhook_url}/webhook/master")
-            
-            async def set_webhook():
-                await self.bot.remove_webhook()
-                await self.bot.set_webhook(
-                    url=f"{self.webhook_url}/webhook/master",
-                    drop_pending_updates=True
-                )
-                logger.info("Webhook تنظیم شد")
-            
-            asyncio.run(set_webhook())
-        else:
-            # شروع polling ربات مادر در thread جداگانه
-            polling_thread = threading.Thread(
-                target=self.start_polling_sync,
-                daemon=True,
-                name="master_bot_polling"
-            )
-            polling_thread.start()
-            logger.info("Polling ربات مادر شروع شد")
+        if self.use_webhook:
+            self.submit(self.set_master_webhook()).result()
+        elif not self.leases:
+            # با انتخاب رهبر، polling ربات مادر با گرفتن lease شروع می‌شود
+            self.start_master_polling()
         
-        # نگه داشتن برنامه اصلی
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("🛑 توقف ربات...")
-            self.child_manager.stop_all()
+        # polling ربات‌های فرزند (و ربات مادر) با گرفتن lease شروع می‌شود
+        if self.leases:
+            self.leases.start()
+            if self.store.name != 'memory' and self.bot_sync_interval > 0:
+                threading.Thread(target=self._bot_sync_loop, daemon=True, name="bot_sync").start()
+        
+        # نگه داشتن برنامه اصلی تا درخواست توقف
+        self._stop_event.wait()
+        
+        self.shutdown()
+    
+    def shutdown(self):
+        """
+        خاموشی هماهنگ بدون از دست رفتن پیام
+        
+        ترتیب: webhook و /ready پاسخ 503 می‌دهند، polling همه ربات‌ها متوقف
+        می‌شود، آپدیت‌های دریافت‌شده تا SHUTDOWN_TIMEOUT پردازش (و بقیه لغو)
+        می‌شوند، offset اولین آپدیت پردازش‌نشده نزد تلگرام تایید و ذخیره
+        می‌شود، leaseها آزاد و در پایان وضعیت‌ها flush و بسته می‌شوند.
+        آپدیت‌های لغو شده (و آپدیت‌های تمام‌شده پس از آن‌ها) در اجرای بعدی
+        دوباره دریافت می‌شوند؛ تحویل حداقل یک بار است.
+        """
+        started = time.monotonic()
+        deadline = started + self.shutdown_timeout
+        logger.info("🛑 توقف ربات: تخلیه کارهای در جریان (حداکثر %s ثانیه)...", self.shutdown_timeout)
+        self.draining = True
+        
+        master = self.submit(self.drain_master(deadline)) if self.master_loop else None
+        stuck = self.child_manager.stop_all(deadline)
+        if master is not None:
+            try:
+                master.result(max(0.0, deadline - time.monotonic()) + 2)
+            except Exception as e:
+                logger.warning("تخلیه ربات مادر کامل نشد: %s", e)
+        
+        # offsetها نوشته شده‌اند؛ آزاد کردن lease (هوک‌های آن offset ذخیره
+        # می‌کنند) پیش از بستن ذخیره‌سازی تا نمونه بعدی فوراً از همان‌جا ادامه دهد
+        if self.leases:
+            self.leases.release_all()
+            # هوک‌های آزادسازی offsetها را پیش از بستن ذخیره‌سازی می‌نویسند
+            self.lease_hooks.shutdown(wait=True)
+        self.store.flush_pending()
+        self.reply_index.close()
+        if self.inbox:
+            self.inbox.close()
+        self.store.close()
+        if self.http_server is not None:
+            self.http_server.shutdown()
+        if self.master_loop is not None:
+            self.master_loop.call_soon_threadsafe(self.master_loop.stop)
+        logger.info("✅ توقف کامل در %.1f ثانیه (%s ربات در مهلت متوقف نشد)",
+                    time.monotonic() - started, stuck)
+    
+    async def drain_master(self, deadline: float):
+        """توقف polling ربات مادر، پایان آپدیت‌های در جریان و تایید offset"""
+        polling = self.master_polling
+        if polling is not None:
+            polling[1].cancel()
+        
+        while self.admission.per_bot.get(MASTER_KEY) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        
+        # کارهای باقی‌مانده (ارسال همگانی با checkpoint، ویرایش‌ها) لغو می‌شوند
+        current = asyncio.current_task()
+        others = [task for task in asyncio.all_tasks() if task is not current and not task.done()]
+        for task in others:
+            task.cancel()
+        await asyncio.gather(*others, return_exceptions=True)
+        
+        if polling is not None:
+            try:
+                offset = await self.bot.commit_offset()
+                logger.info("offset ربات مادر تایید شد: %s", offset)
+            except Exception as e:
+                logger.warning("تایید offset ربات مادر ناموفق بود: %s", e)
+        await self.sessions.close_loop_session()
+    
+    async def drain_child_bot(self, bot_data: BotRecord):
+        """ارسال فوری خلاصه بافر شده ربات (بدون انتظار برای پایان پنجره)"""
+        self.digest.cancel_flush(bot_data.username)
+        await self.flush_digest(bot_data)
 
 
 # ========== تابع اصلی اجرا ==========
+def configure_api_url(api_url: Optional[str]):
+    """تنظیم آدرس پایه Bot API برای کلاینت‌های sync و async"""
+    if api_url:
+        api_url = api_url.rstrip('/') + '/bot{0}/{1}'
+        telebot.apihelper.API_URL = api_url
+        telebot.asyncio_helper.API_URL = api_url
+
+
 def main():
     """تابع اصلی اجرای ربات"""
     
+    # لاگ از طریق صف محدود و thread پس‌زمینه
+    setup_logging(
+        level=os.environ.get('LOG_LEVEL', 'INFO'),
+        fmt=os.environ.get('LOG_FORMAT', 'json'),
+        queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+        sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', 0.1))
+    )
+    
+    # آدرس جایگزین Bot API (سرور Bot API محلی یا API جعلی بنچمارک‌ها)
+    configure_api_url(os.environ.get('TELEGRAM_API_URL'))
+    
     # خواندن توکن
     token = os.environ.get('MASTER_BOT_TOKEN')
     
@@ -1212,5 +4725,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("\n👋 ربات متوقف شد.")
     except Exception as e:
-        logger.error(f"خطای اصلی: {e}")
+        logger.error("خطای اصلی: %s", e)
         print(f"❌ خطا: {e}")
+    finally:
+        shutdown_logging()
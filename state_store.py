@@ -0,0 +1,753 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+لایه ذخیره‌سازی وضعیت ربات چت ناشناس
+
+وضعیت (ربات‌ها، کاربران مسدود، مراحل، offsetها، فرستندگان
+هر ربات و کارهای ارسال همگانی) در چند
+فضای نام (namespace) کلید-مقدار نگه داشته می‌شود تا بتوان آن را بیرون از
+پروسه و مشترک بین چند نمونه اجرا کرد. سه پیاده‌سازی وجود دارد:
+
+    memory://                 حافظه پروسه (پیش‌فرض)
+    sqlite:///path/state.db   فایل SQLite
+    redis://host:port/0       هر سرور سازگار با پروتکل Redis (RESP)
+
+همه عملیات async هستند و از هر event loop (thread ربات‌های فرزند) قابل
+فراخوانی‌اند؛ هر backend عملیات را به صورت دسته‌ای (یک تراکنش یا یک
+pipeline) اجرا می‌کند.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# (عملیات, فضای نام, کلید, مقدار)
+Op = Tuple[str, str, Optional[str], Optional[str]]
+
+NS_BOTS = 'bots'
+NS_BLOCKS = 'blocks'
+NS_STEPS = 'steps'
+NS_OFFSETS = 'offsets'
+NS_SCOPED_BLOCKS = 'scoped_blocks'
+NS_UNREACHABLE = 'unreachable_owners'
+NS_BROADCASTS = 'broadcasts'
+
+
+def senders_ns(bot_username: str) -> str:
+    """فضای نام فرستندگان یک ربات (یکی برای هر ربات)"""
+    return f"senders:{bot_username}"
+
+
+# ========== کلاس پایه ==========
+class StateStore:
+    """
+    رابط ذخیره‌سازی وضعیت
+
+    هر backend فقط _submit_ops را پیاده‌سازی می‌کند که فهرستی از عملیات
+    ('get', 'put', 'delete', 'get_all') را دسته‌ای اجرا کرده و یک
+    concurrent.futures.Future با فهرست نتایج برمی‌گرداند. بقیه متدها روی
+    همین پایه ساخته شده‌اند.
+
+    برای نوشتن‌های پرتکرار (فرستندگان تازه، offset، مراحل) از write_behind
+    استفاده می‌شود: نوشتن‌ها در حافظه تجمیع (و برای هر کلید فقط آخرین
+    مقدار نگه داشته) و هر flush_interval ثانیه در یک دسته ارسال می‌شوند.
+    """
+
+    name = 'base'
+
+    def __init__(self, flush_interval: float = 0.05, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[Tuple[str, str], Optional[str]] = {}
+        self._pending_lock = threading.Lock()
+        self._pending_event = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._closed = False
+
+    # ---------- عملیات پایه ----------
+    def _submit_ops(self, ops: List[Op]) -> concurrent.futures.Future:
+        raise NotImplementedError
+
+    async def execute(self, ops: List[Op]) -> List[Any]:
+        """اجرای دسته‌ای عملیات"""
+        if not ops:
+            return []
+        return await asyncio.wrap_future(self._submit_ops(ops))
+
+    async def get(self, ns: str, key: str) -> Optional[str]:
+        return (await self.execute([('get', ns, key, None)]))[0]
+
+    async def put(self, ns: str, key: str, value: str):
+        await self.execute([('put', ns, key, value)])
+
+    async def delete(self, ns: str, key: str):
+        await self.execute([('delete', ns, key, None)])
+
+    async def get_all(self, ns: str) -> Dict[str, str]:
+        return (await self.execute([('get_all', ns, None, None)]))[0]
+
+    # ---------- مقایسه و تنظیم اتمیک ----------
+    def _submit_cas(self, ns: str, key: str, expected: Optional[str],
+                    value: Optional[str]) -> concurrent.futures.Future:
+        raise NotImplementedError
+
+    async def compare_and_set(self, ns: str, key: str, expected: Optional[str], value: Optional[str]) -> bool:
+        """
+        تنظیم اتمیک مقدار فقط اگر مقدار فعلی برابر expected باشد
+
+        expected=None یعنی کلید نباید وجود داشته باشد و value=None یعنی حذف.
+        """
+        return await asyncio.wrap_future(self._submit_cas(ns, key, expected, value))
+
+    def compare_and_set_sync(self, ns: str, key: str, expected: Optional[str],
+                             value: Optional[str], timeout: float = 5.0) -> bool:
+        """نسخه همگام compare_and_set (برای threadهای بدون event loop)"""
+        return self._submit_cas(ns, key, expected, value).result(timeout)
+
+    def get_sync(self, ns: str, key: str, timeout: float = 5.0) -> Optional[str]:
+        """نسخه همگام get"""
+        return self._submit_ops([('get', ns, key, None)]).result(timeout)[0]
+
+    def get_all_sync(self, ns: str, timeout: float = 10.0) -> Dict[str, str]:
+        """نسخه همگام get_all"""
+        return self._submit_ops([('get_all', ns, None, None)]).result(timeout)[0]
+
+    # ---------- نوشتن با تاخیر ----------
+    def write_behind(self, ns: str, key: str, value: Optional[str]):
+        """ثبت نوشتن (یا حذف با value=None) برای ارسال دسته‌ای بعدی"""
+        with self._pending_lock:
+            self._pending[(ns, key)] = value
+            size = len(self._pending)
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, daemon=True, name=f"state_store_{self.name}"
+                )
+                self._flusher.start()
+        if size >= self.max_pending:
+            self._pending_event.set()
+
+    def _take_pending(self) -> List[Op]:
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        return [
+            ('delete', ns, key, None) if value is None else ('put', ns, key, value)
+            for (ns, key), value in pending.items()
+        ]
+
+    def flush_pending(self, timeout: float = 10.0):
+        """ارسال فوری نوشتن‌های معوق (به صورت همگام)"""
+        ops = self._take_pending()
+        if ops:
+            self._submit_ops(ops).result(timeout)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._pending_event.wait(self.flush_interval)
+            self._pending_event.clear()
+            try:
+                self.flush_pending()
+            except Exception as e:
+                logger.error("خطا در نوشتن دسته‌ای وضعیت (%s): %s", self.name, e)
+
+    def close(self):
+        """ارسال نوشتن‌های معوق و بستن backend"""
+        self.flush_pending()
+        self._closed = True
+        self._pending_event.set()
+
+    # ---------- ربات‌ها ----------
+    async def save_bot(self, record: Dict[str, Any]):
+        await self.put(NS_BOTS, record['username'], json.dumps(record, ensure_ascii=False))
+
+    async def delete_bot(self, bot_username: str):
+        """حذف ربات و همه کاربران مسدود و offset آن"""
+        blocks = await self.get_all(NS_BLOCKS)
+        ops: List[Op] = [
+            ('delete', NS_BOTS, bot_username, None),
+            ('delete', NS_OFFSETS, bot_username, None),
+        ]
+        prefix = f"{bot_username}:"
+        ops.extend(('delete', NS_BLOCKS, key, None) for key in blocks if key.startswith(prefix))
+        await self.execute(ops)
+
+    async def load_bots(self) -> List[Dict[str, Any]]:
+        return [json.loads(value) for value in (await self.get_all(NS_BOTS)).values()]
+
+    # ---------- کاربران مسدود ----------
+    @staticmethod
+    def _block_key(user_id: int, bot_username: str) -> str:
+        return f"{bot_username}:{user_id}"
+
+    async def add_block(self, user_id: int, bot_username: str):
+        await self.put(NS_BLOCKS, self._block_key(user_id, bot_username), '1')
+
+    async def remove_block(self, user_id: int, bot_username: str):
+        await self.delete(NS_BLOCKS, self._block_key(user_id, bot_username))
+
+    async def is_blocked(self, user_id: int, bot_username: str) -> bool:
+        return await self.get(NS_BLOCKS, self._block_key(user_id, bot_username)) is not None
+
+    async def load_blocks(self) -> List[Tuple[int, str]]:
+        result = []
+        for key in (await self.get_all(NS_BLOCKS)):
+            bot_username, _, user_id = key.rpartition(':')
+            result.append((int(user_id), bot_username))
+        return result
+
+    # ---------- فهرست مسدودی سراسری و سطح مالک ----------
+    async def add_scoped_blocks(self, entries: List[Tuple[int, int]]):
+        """(scope, user_id)؛ scope صفر یعنی فهرست سراسری"""
+        await self.execute([('put', NS_SCOPED_BLOCKS, f"{scope}:{user_id}", '1') for scope, user_id in entries])
+
+    async def remove_scoped_blocks(self, entries: List[Tuple[int, int]]):
+        await self.execute([('delete', NS_SCOPED_BLOCKS, f"{scope}:{user_id}", None) for scope, user_id in entries])
+
+    async def load_scoped_blocks(self) -> List[Tuple[int, int]]:
+        result = []
+        for key in (await self.get_all(NS_SCOPED_BLOCKS)):
+            scope, _, user_id = key.partition(':')
+            result.append((int(scope), int(user_id)))
+        return result
+
+    # ---------- مالکان غیرقابل دسترس ----------
+    async def set_owner_reachable(self, owner_id: int, reachable: bool):
+        if reachable:
+            await self.delete(NS_UNREACHABLE, str(owner_id))
+        else:
+            await self.put(NS_UNREACHABLE, str(owner_id), '1')
+
+    async def load_unreachable_owners(self) -> List[int]:
+        return [int(key) for key in (await self.get_all(NS_UNREACHABLE))]
+
+    # ---------- مراحل ----------
+    def save_step(self, user_id: int, step: Optional[str], data: Optional[Dict] = None):
+        """ذخیره مرحله کاربر (با تاخیر)؛ step=None یعنی پاک کردن"""
+        value = None if step is None else json.dumps({'step': step, 'data': data or {}}, ensure_ascii=False)
+        self.write_behind(NS_STEPS, str(user_id), value)
+
+    async def load_steps(self) -> Dict[int, Dict[str, Any]]:
+        return {int(k): json.loads(v) for k, v in (await self.get_all(NS_STEPS)).items()}
+
+    # ---------- offsetها ----------
+    def save_offset(self, bot_username: str, offset: int):
+        self.write_behind(NS_OFFSETS, bot_username, str(offset))
+
+    async def load_offsets(self) -> Dict[str, int]:
+        return {k: int(v) for k, v in (await self.get_all(NS_OFFSETS)).items()}
+
+    # ---------- فرستندگان هر ربات ----------
+    def add_sender(self, bot_username: str, sender_id: int, seen_at: int):
+        """ثبت فرستنده تازه (با تاخیر)؛ seen_at ترتیب فهرست را پس از بارگذاری حفظ می‌کند"""
+        self.write_behind(senders_ns(bot_username), str(sender_id), str(seen_at))
+
+    def remove_sender(self, bot_username: str, sender_id: int):
+        self.write_behind(senders_ns(bot_username), str(sender_id), None)
+
+    async def load_senders(self, bot_usernames: List[str]) -> Dict[str, List[int]]:
+        """فرستندگان ربات‌ها به ترتیب اولین پیام (همه در یک دسته)"""
+        results = await self.execute([('get_all', senders_ns(name), None, None) for name in bot_usernames])
+        return {
+            name: [int(k) for k, _ in sorted(rows.items(), key=lambda item: int(item[1]))]
+            for name, rows in zip(bot_usernames, results) if rows
+        }
+
+    # ---------- کارهای ارسال همگانی ----------
+    @staticmethod
+    def _recipients_key(bot_username: str) -> str:
+        return f"{bot_username}/recipients"
+
+    def save_broadcast(self, bot_username: str, state: Dict[str, Any], recipients: List[int]):
+        """
+        ثبت کار تازه (با تاخیر)؛ فهرست گیرندگان فقط یک بار نوشته می‌شود
+
+        همه نوشتن‌های این فضای نام از write_behind می‌گذرند تا حذف معوق کار
+        قبلی روی کار تازه همان ربات ننشیند.
+        """
+        self.write_behind(NS_BROADCASTS, self._recipients_key(bot_username), json.dumps(recipients))
+        self.write_behind(NS_BROADCASTS, bot_username, json.dumps(state, ensure_ascii=False))
+
+    def checkpoint_broadcast(self, bot_username: str, state: Dict[str, Any]):
+        """ذخیره پیشرفت کار (با تاخیر)"""
+        self.write_behind(NS_BROADCASTS, bot_username, json.dumps(state, ensure_ascii=False))
+
+    def delete_broadcast(self, bot_username: str):
+        self.write_behind(NS_BROADCASTS, bot_username, None)
+        self.write_behind(NS_BROADCASTS, self._recipients_key(bot_username), None)
+
+    async def load_broadcast(self, bot_username: str) -> Optional[Tuple[Dict[str, Any], List[int]]]:
+        """(وضعیت، گیرندگان) کار نیمه‌تمام یک ربات یا None"""
+        state, recipients = await self.execute([
+            ('get', NS_BROADCASTS, bot_username, None),
+            ('get', NS_BROADCASTS, self._recipients_key(bot_username), None),
+        ])
+        if state is None or recipients is None:
+            return None
+        return json.loads(state), json.loads(recipients)
+
+
+# ========== backend حافظه ==========
+class MemoryStateStore(StateStore):
+    """نگهداری وضعیت در حافظه پروسه"""
+
+    name = 'memory'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._data: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def _apply(self, ops: List[Op]) -> List[Any]:
+        results = []
+        with self._lock:
+            for op, ns, key, value in ops:
+                table = self._data.setdefault(ns, {})
+                if op == 'get':
+                    results.append(table.get(key))
+                elif op == 'put':
+                    table[key] = value
+                    results.append(None)
+                elif op == 'delete':
+                    table.pop(key, None)
+                    results.append(None)
+                elif op == 'get_all':
+                    results.append(dict(table))
+                else:
+                    raise ValueError(f"عملیات نامعتبر: {op}")
+        return results
+
+    def _submit_ops(self, ops: List[Op]) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            future.set_result(self._apply(ops))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _submit_cas(self, ns: str, key: str, expected: Optional[str],
+                    value: Optional[str]) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._lock:
+            table = self._data.setdefault(ns, {})
+            if table.get(key) != expected:
+                future.set_result(False)
+                return future
+            if value is None:
+                table.pop(key, None)
+            else:
+                table[key] = value
+        future.set_result(True)
+        return future
+
+
+# ========== backend SQLite ==========
+class SQLiteStateStore(StateStore):
+    """
+    نگهداری وضعیت در SQLite
+
+    همه عملیات روی یک thread اختصاصی اجرا می‌شوند (اتصال SQLite به thread
+    وابسته است) و هر دسته در یک تراکنش واحد commit می‌شود.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite_store')
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def _apply(self, ops: List[Op]) -> List[Any]:
+        conn = self._conn
+        results = []
+        with conn:
+            for op, ns, key, value in ops:
+                if op == 'get':
+                    row = conn.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+                    results.append(row[0] if row else None)
+                elif op == 'put':
+                    conn.execute("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+                    results.append(None)
+                elif op == 'delete':
+                    conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+                    results.append(None)
+                elif op == 'get_all':
+                    results.append(dict(conn.execute("SELECT key, value FROM kv WHERE ns = ?", (ns,)).fetchall()))
+                else:
+                    raise ValueError(f"عملیات نامعتبر: {op}")
+        return results
+
+    def _submit_ops(self, ops: List[Op]) -> concurrent.futures.Future:
+        return self._executor.submit(self._apply, ops)
+
+    def _cas(self, ns: str, key: str, expected: Optional[str], value: Optional[str]) -> bool:
+        conn = self._conn
+        # BEGIN IMMEDIATE قفل نوشتن را قبل از خواندن می‌گیرد تا بین پروسه‌ها اتمیک باشد
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            if (row[0] if row else None) != expected:
+                conn.rollback()
+                return False
+            if value is None:
+                conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+            else:
+                conn.execute("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _submit_cas(self, ns: str, key: str, expected: Optional[str],
+                    value: Optional[str]) -> concurrent.futures.Future:
+        return self._executor.submit(self._cas, ns, key, expected, value)
+
+    def close(self):
+        super().close()
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown()
+
+
+# ========== backend پروتکل Redis ==========
+class RedisStateStore(StateStore):
+    """
+    نگهداری وضعیت در سرور سازگار با پروتکل Redis (RESP)
+
+    هر فضای نام یک hash با پیشوند prefix است. کلاینت RESP حداقلی روی
+    asyncio در یک event loop اختصاصی اجرا می‌شود و هر دسته به صورت
+    pipeline (ارسال همه فرمان‌ها و سپس خواندن پاسخ‌ها) فرستاده می‌شود.
+    """
+
+    name = 'redis'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, prefix: str = 'anonchat', **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._io_lock: Optional[asyncio.Lock] = None
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name='redis_store')
+        self._thread.start()
+
+    def _hash(self, ns: str) -> str:
+        return f"{self.prefix}:{ns}"
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("اتصال Redis بسته شد")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RuntimeError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"پاسخ RESP نامعتبر: {line!r}")
+
+    async def _ensure_connection(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._writer.write(b"".join(self._encode(*cmd) for cmd in setup))
+            await self._writer.drain()
+            for _ in setup:
+                await self._read_reply()
+
+    async def _pipeline(self, ops: List[Op]) -> List[Any]:
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+
+        commands = []
+        for op, ns, key, value in ops:
+            if op == 'get':
+                commands.append(('HGET', self._hash(ns), key))
+            elif op == 'put':
+                commands.append(('HSET', self._hash(ns), key, value))
+            elif op == 'delete':
+                commands.append(('HDEL', self._hash(ns), key))
+            elif op == 'get_all':
+                commands.append(('HGETALL', self._hash(ns)))
+            else:
+                raise ValueError(f"عملیات نامعتبر: {op}")
+
+        async with self._io_lock:
+            try:
+                await self._ensure_connection()
+                self._writer.write(b"".join(self._encode(*cmd) for cmd in commands))
+                await self._writer.drain()
+                replies = [await self._read_reply() for _ in commands]
+            except BaseException:
+                # خطای RESP (-ERR)، قطع اتصال یا لغو وسط خواندن پاسخ‌ها: پاسخ‌های
+                # خوانده نشده در سوکت می‌مانند و اتصال نباید دوباره استفاده شود
+                self._reset_connection()
+                raise
+
+        results = []
+        for (op, _, _, _), reply in zip(ops, replies):
+            if op == 'get':
+                results.append(reply)
+            elif op == 'get_all':
+                reply = reply or []
+                results.append(dict(zip(reply[0::2], reply[1::2])))
+            else:
+                results.append(None)
+        return results
+
+    def _submit_ops(self, ops: List[Op]) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self._pipeline(ops), self._loop)
+
+    def _reset_connection(self):
+        """بستن اتصال؛ Redis با قطع اتصال WATCH و MULTI باز را کنار می‌گذارد"""
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+
+    async def _command(self, *args):
+        self._writer.write(self._encode(*args))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _cas(self, ns: str, key: str, expected: Optional[str], value: Optional[str]) -> bool:
+        """مقایسه و تنظیم با WATCH/MULTI/EXEC"""
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        name = self._hash(ns)
+
+        async with self._io_lock:
+            await self._ensure_connection()
+            try:
+                # WATCH کل hash را زیر نظر دارد؛ تغییر کلیدهای دیگر باعث تکرار می‌شود
+                for _ in range(3):
+                    await self._command('WATCH', name)
+                    if await self._command('HGET', name, key) != expected:
+                        await self._command('UNWATCH')
+                        return False
+                    await self._command('MULTI')
+                    if value is None:
+                        await self._command('HDEL', name, key)
+                    else:
+                        await self._command('HSET', name, key, value)
+                    if await self._command('EXEC') is not None:
+                        return True
+                return False
+            except BaseException:
+                # خطا یا لغو وسط تراکنش: اتصال ممکن است در MULTI مانده یا پاسخ‌های
+                # خوانده نشده داشته باشد و نباید برای فرمان بعدی استفاده شود
+                self._reset_connection()
+                raise
+
+    def _submit_cas(self, ns: str, key: str, expected: Optional[str],
+                    value: Optional[str]) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(self._cas(ns, key, expected, value), self._loop)
+
+    def close(self):
+        super().close()
+
+        async def shutdown():
+            if self._writer is not None:
+                self._writer.close()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+# ========== سرور جایگزین محلی Redis ==========
+class RespStandInServer:
+    """
+    سرور حداقلی پروتکل RESP برای تست و بنچمارک RedisStateStore بدون Redis
+
+    فقط فرمان‌های PING, SELECT, AUTH, HGET, HSET, HDEL, HGETALL و
+    WATCH/UNWATCH/MULTI/EXEC پشتیبانی می‌شوند.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self._data: Dict[str, Dict[str, str]] = {}
+        self._versions: Dict[str, int] = {}
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'RespStandInServer':
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True, name='resp_stand_in')
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    @staticmethod
+    def _bulk(value: Optional[str]) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode('utf-8')
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = {'watched': {}, 'queued': None}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                count = int(line[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode('utf-8'))
+                writer.write(self._transaction(session, args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _transaction(self, session: Dict, args: List[str]) -> bytes:
+        """مدیریت WATCH/MULTI/EXEC برای هر اتصال"""
+        command = args[0].upper()
+        if command == 'WATCH':
+            for name in args[1:]:
+                session['watched'][name] = self._versions.get(name, 0)
+            return b"+OK\r\n"
+        if command == 'UNWATCH':
+            session['watched'] = {}
+            return b"+OK\r\n"
+        if command == 'MULTI':
+            session['queued'] = []
+            return b"+OK\r\n"
+        if command == 'EXEC':
+            queued, session['queued'] = session['queued'] or [], None
+            watched, session['watched'] = session['watched'], {}
+            if any(self._versions.get(name, 0) != version for name, version in watched.items()):
+                return b"*-1\r\n"
+            replies = [self._dispatch(cmd) for cmd in queued]
+            return b"*%d\r\n" % len(replies) + b"".join(replies)
+        if session['queued'] is not None:
+            session['queued'].append(args)
+            return b"+QUEUED\r\n"
+        return self._dispatch(args)
+
+    def _dispatch(self, args: List[str]) -> bytes:
+        command = args[0].upper()
+        if command in ('PING', 'SELECT', 'AUTH'):
+            return b"+OK\r\n" if command != 'PING' else b"+PONG\r\n"
+        if command == 'HGET':
+            return self._bulk(self._data.get(args[1], {}).get(args[2]))
+        if command == 'HSET':
+            table = self._data.setdefault(args[1], {})
+            self._versions[args[1]] = self._versions.get(args[1], 0) + 1
+            added = 0
+            for i in range(2, len(args), 2):
+                added += args[i] not in table
+                table[args[i]] = args[i + 1]
+            return b":%d\r\n" % added
+        if command == 'HDEL':
+            table = self._data.get(args[1], {})
+            self._versions[args[1]] = self._versions.get(args[1], 0) + 1
+            removed = sum(1 for key in args[2:] if table.pop(key, None) is not None)
+            return b":%d\r\n" % removed
+        if command == 'HGETALL':
+            table = self._data.get(args[1], {})
+            parts = [b"*%d\r\n" % (len(table) * 2)]
+            for key, value in table.items():
+                parts.append(self._bulk(key))
+                parts.append(self._bulk(value))
+            return b"".join(parts)
+        return f"-ERR unknown command '{command}'\r\n".encode()
+
+
+# ========== ساخت backend از آدرس ==========
+def create_state_store(url: Optional[str] = None) -> StateStore:
+    """
+    ساخت backend ذخیره‌سازی از روی آدرس
+
+    Args:
+        url: memory:// یا sqlite:///path یا redis://[:password@]host:port/db
+    """
+    if not url or url.startswith('memory:'):
+        return MemoryStateStore()
+
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        path = parsed.path
+        if url.startswith('sqlite:///') and not url.startswith('sqlite:////'):
+            path = path.lstrip('/')
+        return SQLiteStateStore(path or 'state.db')
+    if parsed.scheme == 'redis':
+        return RedisStateStore(
+            host=parsed.hostname or '127.0.0.1',
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip('/') or 0),
+            password=parsed.password
+        )
+    raise ValueError(f"آدرس ذخیره‌سازی نامعتبر: {url}")